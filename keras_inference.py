@@ -30,7 +30,7 @@ keras.backend.set_learning_phase(0)
 
 
 def correct_box(box_xy: tf.Tensor, box_wh: tf.Tensor, input_shape: list, image_shape: list) -> tf.Tensor:
-    """rescae predict box to orginal image scale
+    """rescae predict box to orginal image scale, use the same letterbox parameter as `Helper._resize_img`
 
     Parameters
     ----------
@@ -50,10 +50,11 @@ def correct_box(box_xy: tf.Tensor, box_wh: tf.Tensor, input_shape: list, image_s
     """
     box_yx = box_xy[..., ::-1]
     box_hw = box_wh[..., ::-1]
+    new_wh, _, translation = Helper.letterbox_param(np.array(image_shape), np.array(input_shape))
     input_shape = tf.cast(input_shape, tf.float32)
     image_shape = tf.cast(image_shape, tf.float32)
-    new_shape = tf.round(image_shape * tf.reduce_min(input_shape / image_shape))
-    offset = (input_shape - new_shape) / 2. / input_shape
+    new_shape = tf.cast(new_wh[::-1], tf.float32)
+    offset = tf.cast(translation[::-1], tf.float32) / input_shape
     scale = input_shape / new_shape
     box_yx = (box_yx - offset) * scale
     box_hw *= scale
@@ -2,8 +2,9 @@ import tensorflow.python as tf
 from tensorflow.contrib.data import assert_element_shape
 from tensorflow.python import keras
 from tensorflow.python.keras.callbacks import TensorBoard, LearningRateScheduler
-from tools.utils import Helper, create_loss_fn, INFO, ERROR, NOTE
+from tools.utils import Helper, StageTimer, StageTimerCallback, create_loss_fn, create_fused_loss_fn, tf_concat_layers, tf_batch_box_to_label, INFO, ERROR, NOTE
 from tools.custom import Yolo_Precision, Yolo_Recall
+from tools.trainer import Trainer
 from models.yolonet import *
 import os
 from pathlib import Path
@@ -38,7 +39,7 @@ def main(args, train_set, class_num, pre_ckpt, model_def,
          batch_size, rand_seed, max_nrof_epochs, init_learning_rate,
          learning_rate_decay_factor, obj_weight, noobj_weight,
          wh_weight, obj_thresh, iou_thresh, vaildation_split, log_dir,
-         is_prune, initial_sparsity, final_sparsity, end_epoch, frequency):
+         is_prune, initial_sparsity, final_sparsity, end_epoch, frequency, is_cache, parser, interpolation, num_workers, data_format, shuffle_buffer, label_mode, image_dtype, normlize, is_timing, timing_period, reduce_decode, augment_mode, bank_num, box_chunk, loss_mode, sparse_loss, trainer):
     # Build path
     log_dir = (Path(log_dir) / datetime.strftime(datetime.now(), '%Y%m%d-%H%M%S'))  # type: Path
     print(INFO, 'log_dir:', log_dir)
@@ -49,9 +50,22 @@ def main(args, train_set, class_num, pre_ckpt, model_def,
     write_arguments_to_file(args, str(log_dir / 'args.txt'))
 
     # Build utils
-    h = Helper(f'data/{train_set}_img_ann.npy', class_num, f'data/{train_set}_anchor.npy',
-               np.reshape(np.array(image_size), (-1, 2)), np.reshape(np.array(output_size), (-1, 2)), vaildation_split)
-    h.set_dataset(batch_size, rand_seed, data_augment=(is_augmenter == 'True'))
+    if data_format == 'tfrecord':
+        image_ann = f'data/{train_set}_tfrecord/index.json'
+    elif data_format == 'store':
+        image_ann = f'data/{train_set}_ann'
+    else:
+        image_ann = f'data/{train_set}_img_ann.npy'
+    h = Helper(image_ann, class_num, f'data/{train_set}_anchor.npy',
+               np.reshape(np.array(image_size), (-1, 2)), np.reshape(np.array(output_size), (-1, 2)), vaildation_split, interpolation,
+               reduce_decode == 'True', augment_mode, rand_seed)
+    assert is_augmenter != 'True' or augment_mode != 'none', 'the augmenter need augment_mode iaa or fused'
+    assert label_mode == 'dense' or trainer == 'custom', 'box label mode need the custom trainer, the labels are built in the train step'
+    if is_timing == 'True':
+        h.timer = StageTimer()
+    h.set_dataset(batch_size, rand_seed, data_augment=(is_augmenter == 'True'), is_cache=(is_cache == 'True'), parser=parser,
+                  num_workers=num_workers, shuffle_buffer=shuffle_buffer,
+                  label_mode=label_mode, image_dtype=image_dtype, bank_num=bank_num)
 
     # Build network
     network = eval(model_def)  # type :yolo_mobilev2
@@ -78,18 +92,44 @@ def main(args, train_set, class_num, pre_ckpt, model_def,
     else:
         train_model = yolo_model_warpper
 
-    train_model.compile(
-        keras.optimizers.Adam(
-            lr=init_learning_rate,
-            decay=learning_rate_decay_factor),
-        loss=[create_loss_fn(h, obj_thresh, iou_thresh, obj_weight, noobj_weight, wh_weight, layer)
-              for layer in range(len(train_model.output) if isinstance(train_model.output, list) else 1)],
-        metrics=[Yolo_Precision(obj_thresh, name='p'), Yolo_Recall(obj_thresh, name='r')])
+    if image_dtype == 'uint8':
+        """ NOTE normlize the uint8 image in model, the saved yolo_model still take float image """
+        assert is_prune != 'True', 'uint8 image not support prune'
+        _, train_model = uint8_input(yolo_model, train_model, normlize)
 
-    """ NOTE fix the dataset output shape """
-    shapes = (train_model.input.shape, tuple(h.output_shapes))
-    h.train_dataset = h.train_dataset.apply(assert_element_shape(shapes))
-    h.test_dataset = h.test_dataset.apply(assert_element_shape(shapes))
+    if loss_mode == 'fused':
+        """ NOTE concat the output layers, one loss function compute all layers and report the loss terms """
+        assert is_prune != 'True', 'fused loss not support prune'
+        train_model = concat_output(train_model)
+        loss = create_fused_loss_fn(h, obj_thresh, iou_thresh, obj_weight, noobj_weight, wh_weight, box_chunk, sparse_loss == 'True')
+    else:
+        loss = [create_loss_fn(h, obj_thresh, iou_thresh, obj_weight, noobj_weight, wh_weight, layer, box_chunk, sparse_loss == 'True')
+                for layer in range(len(train_model.output) if isinstance(train_model.output, list) else 1)]
+    metrics = [Yolo_Precision(obj_thresh, name='p'), Yolo_Recall(obj_thresh, name='r')]
+    optimizer = keras.optimizers.Adam(
+        lr=init_learning_rate,
+        decay=learning_rate_decay_factor)
+
+    if trainer == 'keras':
+        train_model.compile(
+            optimizer,
+            loss=loss,
+            metrics=metrics + (loss.metrics if loss_mode == 'fused' else []))
+
+    if label_mode == 'box':
+        """ NOTE the dataset only carry the padded boxes, the labels are scattered in the train step """
+        def label_fn(true_box, box_num):
+            labels = tf_batch_box_to_label(true_box, box_num, h)
+            return tf_concat_layers(labels) if loss_mode == 'fused' else tuple(labels)
+    else:
+        label_fn = None
+        """ NOTE fix the dataset output shape """
+        shapes = (train_model.input.shape, tuple(h.output_shapes))
+        h.train_dataset = h.train_dataset.apply(assert_element_shape(shapes))
+        h.test_dataset = h.test_dataset.apply(assert_element_shape(shapes))
+        if loss_mode == 'fused':
+            h.train_dataset = h.train_dataset.map(lambda img, labels: (img, tf_concat_layers(labels)))
+            h.test_dataset = h.test_dataset.map(lambda img, labels: (img, tf_concat_layers(labels)))
 
     """ Callbacks """
     if is_prune == 'True':
@@ -98,12 +138,20 @@ def main(args, train_set, class_num, pre_ckpt, model_def,
             sparsity.PruningSummaries(log_dir=str(log_dir), profile_batch=0)]
     else:
         cbs = [TensorBoard(str(log_dir), update_freq='batch', profile_batch=3)]
+    if is_timing == 'True':
+        cbs.append(StageTimerCallback(h.timer, str(log_dir), timing_period))
 
     # Training
     try:
-        train_model.fit(h.train_dataset, epochs=max_nrof_epochs,
-                        steps_per_epoch=h.train_epoch_step, callbacks=cbs,
-                        validation_data=h.test_dataset, validation_steps=h.train_epoch_step) # int(h.test_epoch_step * h.validation_split))
+        if trainer == 'keras':
+            train_model.fit(h.train_dataset, epochs=max_nrof_epochs,
+                            steps_per_epoch=h.train_epoch_step, callbacks=cbs,
+                            validation_data=h.test_dataset, validation_steps=h.train_epoch_step) # int(h.test_epoch_step * h.validation_split))
+        else:
+            """ NOTE the train step is compiled by tf.function, the loss terms are logged when use the fused loss """
+            Trainer(train_model, optimizer, loss, metrics, cbs, label_fn).fit(
+                h.train_dataset, max_nrof_epochs, h.train_epoch_step,
+                validation_data=h.test_dataset, validation_steps=h.train_epoch_step)
     except KeyboardInterrupt as e:
         pass
 
@@ -146,6 +194,24 @@ if __name__ == "__main__":
     parser.add_argument('--prune_final_sparsity', type=float, help='prune final sparsity range = [0 ~ 1]', default=0.9)
     parser.add_argument('--prune_end_epoch', type=int, help='prune epochs NOTE: must < train epochs', default=5)
     parser.add_argument('--prune_frequency', type=int, help='how many steps for prune once', default=100)
+    parser.add_argument('--cache', type=str, help='cache the resized images beside the annotation file', choices=['True', 'False'], default='False')
+    parser.add_argument('--parser', type=str, help='dataset parser, native parser only use graph ops', choices=['py', 'native'], default='py')
+    parser.add_argument('--interpolation', type=str, help='letterbox resize interpolation', choices=['nearest', 'bilinear', 'area', 'bicubic'], default='bilinear')
+    parser.add_argument('--num_workers', type=int, help='sample loader process number, 0 for not use', default=0)
+    parser.add_argument('--data_format', type=str, help='npy: data/{train_set}_img_ann.npy, tfrecord: data/{train_set}_tfrecord/index.json, store: data/{train_set}_ann_*.npy', choices=['npy', 'tfrecord', 'store'], default='npy')
+    parser.add_argument('--shuffle_buffer', type=int, help='decoded sample shuffle buffer size, 0 for only permute the sample index every epoch', default=0)
+    parser.add_argument('--label_mode', type=str, help='dense: host build the labels, box: only feed the padded boxes, build the labels in the train step, need custom trainer', choices=['dense', 'box'], default='dense')
+    parser.add_argument('--image_dtype', type=str, help='pipeline image dtype, uint8 image is normlized by the model first layer', choices=['float32', 'uint8'], default='float32')
+    parser.add_argument('--normlize', type=str, help='uint8 image normlize, max: divide by the image max, 255: divide by 255', choices=['max', '255'], default='max')
+    parser.add_argument('--timing', type=str, help='time the data pipeline stages, write to TensorBoard and log_dir/pipeline.json', choices=['True', 'False'], default='False')
+    parser.add_argument('--augment_mode', type=str, help='none: no augment, iaa: letterbox then imgaug, fused: letterbox and augment in one warp, NOTE native parser and tfrecord only support fused', choices=['none', 'iaa', 'fused'], default='fused')
+    parser.add_argument('--reduce_decode', type=str, help='decode jpeg at the smallest 1/2^n scale still cover the input size', choices=['True', 'False'], default='False')
+    parser.add_argument('--timing_period', type=int, help='pipeline timing write period (steps)', default=100)
+    parser.add_argument('--box_chunk', type=int, help='true box number of one ignore mask iou loop, bound the loss peak memory', default=16)
+    parser.add_argument('--loss_mode', type=str, help='layer: one loss function per output layer, fused: one loss function for all output layers', choices=['layer', 'fused'], default='layer')
+    parser.add_argument('--sparse_loss', type=str, help='compute the xy, wh, obj and cls loss only on the positive cells', choices=['True', 'False'], default='False')
+    parser.add_argument('--trainer', type=str, help='keras: keras Model.fit, custom: tf.function compiled train step and explicit dataset loop', choices=['keras', 'custom'], default='keras')
+    parser.add_argument('--bank_num', type=int, help='train on the augmentation bank with bank_num variants of every image, build by make_aug_bank.py or at the first run, 0 for not use', default=0)
 
     args = parser.parse_args(sys.argv[1:])
 
@@ -159,4 +225,22 @@ if __name__ == "__main__":
          args.prune_initial_sparsity,
          args.prune_final_sparsity,
          args.prune_end_epoch,
-         args.prune_frequency)
+         args.prune_frequency,
+         args.cache,
+         args.parser,
+         args.interpolation,
+         args.num_workers,
+         args.data_format,
+         args.shuffle_buffer,
+         args.label_mode,
+         args.image_dtype,
+         args.normlize,
+         args.timing,
+         args.timing_period,
+         args.reduce_decode,
+         args.augment_mode,
+         args.bank_num,
+         args.box_chunk,
+         args.loss_mode,
+         args.sparse_loss,
+         args.trainer)
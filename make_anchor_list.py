@@ -1,5 +1,6 @@
 import numpy as np
 from tools.utils import Helper, INFO, ERROR, NOTE
+from tools.store import AnnStore
 import matplotlib.pyplot as plt
 from scipy.spatial.distance import cdist
 import sys
@@ -179,26 +180,29 @@ def runkMeans(X: np.ndarray, initial_centroids: np.ndarray, max_iters: int,
 
 def main(train_set: str, max_iters: int, in_hw: tuple, out_hw: tuple,
          anchor_num: int, is_random: bool, is_plot: bool, low: list, high: list):
-    X = np.load(f'data/{train_set}_img_ann.npy', allow_pickle=True)
     in_wh = np.array(in_hw[::-1])
     low = np.array(low)
     high = np.array(high)
-    # NOTE correct boxes
-    for i in range(len(X)):
-        # X[i, 1], X[i, 2]
-        img_wh = X[i, 2][::-1]
-
-        """ calculate the affine transform factor """
-        scale = in_wh / img_wh  # NOTE affine tranform sacle is [w,h]
-        scale[:] = np.min(scale)
-        # NOTE translation is [w offset,h offset]
-        translation = ((in_wh - img_wh * scale) / 2).astype(int)
-
-        """ calculate the box transform matrix """
-        X[i, 1][:, 1:3] = (X[i, 1][:, 1:3] * img_wh * scale + translation) / in_wh
-        X[i, 1][:, 3:5] = (X[i, 1][:, 3:5] * img_wh * scale) / in_wh
-
-    x = np.vstack(X[:, 1])
+    if AnnStore.exists(f'data/{train_set}_ann'):
+        """ the columnar store, correct all boxes at once """
+        x, img_hw = AnnStore(f'data/{train_set}_ann').boxes()
+        x = x.astype('float64')
+        new_wh, _, translation = Helper.letterbox_param(img_hw, in_hw)
+        x[:, 1:3] = (x[:, 1:3] * new_wh + translation) / in_wh
+        x[:, 3:5] = (x[:, 3:5] * new_wh) / in_wh
+    else:
+        X = np.load(f'data/{train_set}_img_ann.npy', allow_pickle=True)
+        # NOTE correct boxes
+        for i in range(len(X)):
+            # X[i, 1], X[i, 2]
+            """ use the same letterbox parameter as training """
+            new_wh, _, translation = Helper.letterbox_param(X[i, 2], in_hw)
+
+            """ calculate the box transform """
+            X[i, 1][:, 1:3] = (X[i, 1][:, 1:3] * new_wh + translation) / in_wh
+            X[i, 1][:, 3:5] = (X[i, 1][:, 3:5] * new_wh) / in_wh
+
+        x = np.vstack(X[:, 1])
     x = x[:, 3:]
     layers = len(out_hw) // 2
     if is_random == 'True':
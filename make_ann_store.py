@@ -0,0 +1,23 @@
+import numpy as np
+import sys
+import argparse
+from tools.store import AnnStore
+from tools.utils import INFO, NOTE
+
+
+def main(image_ann: str, prefix: str):
+    ann_list = np.load(image_ann, allow_pickle=True)
+    store = AnnStore.build(prefix, ann_list)
+    print(INFO, f'Convert {len(store)} annotations with {len(store.box)} boxes to {prefix}_*.npy')
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('image_ann', type=str, help='annotation npy file, such as data/voc_img_ann.npy')
+    parser.add_argument('prefix', type=str, help=NOTE + 'store file prefix, keras_train.py use data/{train_set}_ann')
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_arguments(sys.argv[1:])
+    main(args.image_ann, args.prefix)
@@ -0,0 +1,37 @@
+import os
+import sys
+import argparse
+import numpy as np
+from tools.utils import Helper, INFO, NOTE
+
+
+def main(image_ann: str, class_num: int, anchors: str, image_size: list, output_size: list, interpolation: str,
+         reduce_decode: bool, augment_mode: str, bank_num: int, rand_seed: int, num_workers: int, vaildation_split: float):
+    # NOTE same split as keras_train.py with the same `rand_seed` and `vaildation_split`, only the train split is augmented
+    h = Helper(image_ann, class_num, anchors, np.reshape(np.array(image_size), (-1, 2)),
+               np.reshape(np.array(output_size), (-1, 2)), vaildation_split, interpolation, reduce_decode, augment_mode, rand_seed)
+    bank = h.build_bank(bank_num, rand_seed, num_workers)
+    print(INFO, f'Bank {len(bank)} images, {bank.img.nbytes / 2**20:.1f} MB')
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('image_ann', type=str, help='annotation npy file or store prefix, such as data/voc_img_ann.npy')
+    parser.add_argument('--class_num', type=int, help='trian class num', default=20)
+    parser.add_argument('--anchors', type=str, help='anchor file, such as data/voc_anchor.npy', default='data/voc_anchor.npy')
+    parser.add_argument('--image_size', type=int, help='net work input image size', default=(224, 320), nargs='+')
+    parser.add_argument('--output_size', type=int, help='net work output image size', default=(7, 10, 14, 20), nargs='+')
+    parser.add_argument('--interpolation', type=str, help='letterbox resize interpolation', choices=['nearest', 'bilinear', 'area', 'bicubic'], default='bilinear')
+    parser.add_argument('--reduce_decode', type=str, help='decode jpeg at the smallest 1/2^n scale still cover the input size', choices=['True', 'False'], default='False')
+    parser.add_argument('--augment_mode', type=str, help='iaa: letterbox then imgaug, fused: letterbox and augment in one warp', choices=['iaa', 'fused'], default='fused')
+    parser.add_argument('--bank_num', type=int, help=NOTE + 'augmented variant num of every image, the bank size is bank_num * image num * image_size', default=8)
+    parser.add_argument('--rand_seed', type=int, help='random seed of the augmentation and the split', default=6)
+    parser.add_argument('--vaildation_split', type=float, help='vaildation split factor, same as keras_train.py', default=0.1)
+    parser.add_argument('--num_workers', type=int, help='build process number', default=os.cpu_count())
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_arguments(sys.argv[1:])
+    main(args.image_ann, args.class_num, args.anchors, args.image_size, args.output_size, args.interpolation,
+         args.reduce_decode == 'True', args.augment_mode, args.bank_num, args.rand_seed, args.num_workers, args.vaildation_split)
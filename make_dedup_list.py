@@ -0,0 +1,209 @@
+import os
+import sys
+import json
+import argparse
+import numpy as np
+from multiprocessing import Pool
+from PIL import Image
+from tools.utils import INFO, ERROR, NOTE
+
+
+def dhash(img_path: str, hash_size=8) -> int:
+    """ difference hash of the image, compare the adjacent pixels of a (hash_size + 1) x hash_size gray image
+
+    Parameters
+    ----------
+    img_path : str
+
+    hash_size : int
+        the hash have hash_size * hash_size bits
+
+    Returns
+    -------
+    int
+        hash value
+    """
+    with Image.open(img_path) as img:
+        # NOTE jpeg draft decode at reduced size, much faster than full decode
+        img.draft('L', (hash_size * 8, hash_size * 8))
+        pixels = np.asarray(img.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR), 'int16')
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int(''.join(['1' if b else '0' for b in bits]), 2)
+
+
+def file_key(img_path: str) -> list:
+    st = os.stat(img_path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def load_hashes(paths: list, cache_file: str, num_workers: int) -> np.ndarray:
+    """ load the image hash from cache, only hash the new or changed image
+
+    Parameters
+    ----------
+    paths : list
+        image path list
+    cache_file : str
+        hash cache json, value = {path: [size, mtime_ns, hash]}
+    num_workers : int
+        process number
+
+    Returns
+    -------
+    np.ndarray
+        uint64 hash, shape = [n]
+    """
+    cache = {}
+    if os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+    hashes = np.zeros(len(paths), np.uint64)
+    todo = []
+    for i, path in enumerate(paths):
+        key = file_key(path)
+        if path in cache and cache[path][:2] == key:
+            hashes[i] = cache[path][2]
+        else:
+            todo.append(i)
+    print(INFO, f'{len(paths) - len(todo)} hashes from cache, hash {len(todo)} images')
+    with Pool(num_workers) as pool:
+        for n, (i, h) in enumerate(zip(todo, pool.imap(dhash, [paths[i] for i in todo], chunksize=64))):
+            hashes[i] = h
+            cache[paths[i]] = file_key(paths[i]) + [h]
+            if (n + 1) % 1000 == 0 or n + 1 == len(todo):
+                print(f'\r{n + 1}/{len(todo)}', end='', flush=True)
+    if len(todo) > 0:
+        print()
+        with open(cache_file, 'w') as f:
+            json.dump(cache, f)
+    return hashes
+
+
+def hamming(a: np.uint64, b: np.ndarray) -> np.ndarray:
+    """ the hamming distance between hash a and hashes b """
+    x = np.bitwise_xor(b, a)
+    return np.unpackbits(x.view(np.uint8).reshape(-1, 8), axis=1).sum(1)
+
+
+def box_similarity(box_a: np.ndarray, box_b: np.ndarray) -> float:
+    """ the box similarity of two annotation, 0 when box num or classes are different,
+        else the min mean iou of every box with its best same class box in the other annotation
+
+    Parameters
+    ----------
+    box_a : np.ndarray
+        annotation shape :[n,5] value :[n*[p,x,y,w,h]]
+    box_b : np.ndarray
+        annotation shape :[m,5] value :[m*[p,x,y,w,h]]
+
+    Returns
+    -------
+    float
+        similarity range = [0 ~ 1]
+    """
+    if len(box_a) != len(box_b):
+        return 0.
+    if len(box_a) == 0:
+        return 1.
+    if not np.array_equal(np.sort(box_a[:, 0]), np.sort(box_b[:, 0])):
+        return 0.
+    a_min, a_max = box_a[:, None, 1:3] - box_a[:, None, 3:5] / 2, box_a[:, None, 1:3] + box_a[:, None, 3:5] / 2
+    b_min, b_max = box_b[None, :, 1:3] - box_b[None, :, 3:5] / 2, box_b[None, :, 1:3] + box_b[None, :, 3:5] / 2
+    inter = np.prod(np.clip(np.minimum(a_max, b_max) - np.maximum(a_min, b_min), 0, None), -1)
+    iou = inter / (np.prod(box_a[:, None, 3:5], -1) + np.prod(box_b[None, :, 3:5], -1) - inter)
+    iou = np.where(box_a[:, None, 0] == box_b[None, :, 0], iou, 0.)
+    return float(min(np.mean(np.max(iou, 1)), np.mean(np.max(iou, 0))))
+
+
+def thin(ann_list: np.ndarray, hashes: np.ndarray, max_distance: int, min_box_similarity: float, band_num: int) -> np.ndarray:
+    """ greedy thinning, keep the image when no kept image is near-duplicate of it,
+        so every dropped image is near-duplicate of a kept image and the slow scene change never chain together.
+
+        the candidates are found by LSH bands : split the hash bits to `band_num` bands,
+        when hamming distance < `band_num`, the two hashes must have a same band.
+
+    Parameters
+    ----------
+    ann_list : np.ndarray
+        annotation list, value = [n*[image path, box, image shape]]
+    hashes : np.ndarray
+        uint64 hash, shape = [n]
+    max_distance : int
+        max hamming distance of near-duplicate, NOTE must < band_num
+    min_box_similarity : float
+        min `box_similarity` of near-duplicate
+    band_num : int
+
+    Returns
+    -------
+    np.ndarray
+        keep index
+    """
+    band_bits = 64 // band_num
+    mask = np.uint64((1 << band_bits) - 1)
+    buckets = [{} for _ in range(band_num)]
+    keep = []
+    for i in range(len(ann_list)):
+        bands = [int((hashes[i] >> np.uint64(b * band_bits)) & mask) for b in range(band_num)]
+        cand = set()
+        for b, v in enumerate(bands):
+            cand.update(buckets[b].get(v, []))
+        cand = np.array(sorted(cand), np.int64)
+        is_dup = False
+        if len(cand) > 0:
+            near = cand[hamming(hashes[i], hashes[cand]) <= max_distance]
+            for j in near:
+                if box_similarity(np.reshape(ann_list[i][1], (-1, 5)), np.reshape(ann_list[j][1], (-1, 5))) >= min_box_similarity:
+                    is_dup = True
+                    break
+        if not is_dup:
+            keep.append(i)
+            for b, v in enumerate(bands):
+                buckets[b].setdefault(v, []).append(i)
+    return np.array(keep, np.int64)
+
+
+def main(image_ann: str, output_file: str, max_distance: int, min_box_similarity: float, band_num: int,
+         num_workers: int, epoch_time: float):
+    if os.path.abspath(image_ann) == os.path.abspath(output_file):
+        print(ERROR, 'output file must be different from the annotation file')
+        return
+    ann_list = np.load(image_ann, allow_pickle=True)
+    paths = [str(row[0]) for row in ann_list]
+    hashes = load_hashes(paths, os.path.splitext(image_ann)[0] + '_dhash.json', num_workers)
+    keep = thin(ann_list, hashes, max_distance, min_box_similarity, band_num)
+    np.save(output_file, ann_list[keep])
+
+    """ the epoch time is linear to the image num """
+    ratio = 1 - len(keep) / max(len(ann_list), 1)
+    report = {'image_ann': image_ann, 'output_file': output_file,
+              'max_distance': max_distance, 'min_box_similarity': min_box_similarity,
+              'total': len(ann_list), 'keep': len(keep), 'drop': len(ann_list) - len(keep),
+              'epoch_time_saved_ratio': ratio}
+    if epoch_time is not None:
+        report['epoch_time'] = epoch_time
+        report['epoch_time_saved'] = epoch_time * ratio
+    with open(os.path.splitext(output_file)[0] + '_report.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    print(INFO, f'Keep {len(keep)}/{len(ann_list)} images, save {ratio * 100:.1f}% epoch time'
+          + (f' ({epoch_time * ratio:.1f}s of {epoch_time:.1f}s)' if epoch_time is not None else ''))
+    print(INFO, f'Save thinned list to {output_file}')
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('image_ann', type=str, help='annotation npy file, such as data/voc_img_ann.npy')
+    parser.add_argument('output_file', type=str, help=NOTE + 'thinned annotation npy file, the report is {output_file}_report.json')
+    parser.add_argument('--max_distance', type=int, help='max hash hamming distance of near-duplicate, must < band_num', default=3)
+    parser.add_argument('--min_box_similarity', type=float, help='min box similarity of near-duplicate range = [0 ~ 1]', default=0.8)
+    parser.add_argument('--band_num', type=int, help='LSH band num', choices=[4, 8, 16], default=4)
+    parser.add_argument('--num_workers', type=int, help='process number', default=os.cpu_count())
+    parser.add_argument('--epoch_time', type=float, help='measured epoch time (s) of the original list, for the report', default=None)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_arguments(sys.argv[1:])
+    assert args.max_distance < args.band_num, 'max_distance must < band_num'
+    main(args.image_ann, args.output_file, args.max_distance, args.min_box_similarity, args.band_num,
+         args.num_workers, args.epoch_time)
@@ -0,0 +1,100 @@
+import numpy as np
+import tensorflow as tf
+import os
+import io
+import sys
+import json
+import argparse
+from PIL import Image
+from tools.utils import INFO, ERROR, NOTE
+
+
+def encode_example(img_path: str, true_box: np.ndarray, img_hw: np.ndarray) -> bytes:
+    """ pack the encoded image, boxes and original shape to tf.train.Example """
+    with open(img_path, 'rb') as f:
+        img_raw = f.read()
+    if img_raw[:2] != b'\xff\xd8':
+        # NOTE the reader only decode jpeg
+        buf = io.BytesIO()
+        Image.open(io.BytesIO(img_raw)).convert('RGB').save(buf, format='JPEG', quality=95)
+        img_raw = buf.getvalue()
+    example = tf.train.Example(features=tf.train.Features(feature={
+        'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[img_raw])),
+        'box': tf.train.Feature(float_list=tf.train.FloatList(value=np.reshape(true_box, (-1,)).tolist())),
+        'shape': tf.train.Feature(int64_list=tf.train.Int64List(value=np.array(img_hw, 'int64').tolist()))}))
+    return example.SerializeToString()
+
+
+def write_shards(ann_list: np.ndarray, output_dir: str, name: str, shard_size: int) -> dict:
+    """ write the annotation list to size-bounded shards
+
+    Parameters
+    ----------
+    ann_list : np.ndarray
+        annotation list, value = [n*[image path, box, image shape]]
+    output_dir : str
+
+    name : str
+        shard name prefix
+    shard_size : int
+        max shard bytes
+
+    Returns
+    -------
+    dict
+        shard index, {'shards': [shard file name], 'count': [record num], 'num': total record num}
+    """
+    shards, count = [], []
+    writer, size = None, 0
+    for i, (img_path, true_box, img_hw) in enumerate(ann_list):
+        record = encode_example(img_path, true_box, img_hw)
+        if writer is None or size + len(record) > shard_size:
+            if writer is not None:
+                writer.close()
+                print(f'\r{name} {i}/{len(ann_list)}', end='', flush=True)
+            shards.append(f'{name}-{len(shards):05d}.tfrecord')
+            count.append(0)
+            writer, size = tf.io.TFRecordWriter(os.path.join(output_dir, shards[-1])), 0
+        writer.write(record)
+        size += len(record)
+        count[-1] += 1
+    if writer is not None:
+        writer.close()
+    print(f'\r{name} {len(ann_list)}/{len(ann_list)}')
+    return {'shards': shards, 'count': count, 'num': len(ann_list)}
+
+
+def main(image_ann: str, output_dir: str, shard_size: int, validation_split: float, rand_seed: int):
+    ann_list = np.load(image_ann, allow_pickle=True)
+    np.random.RandomState(rand_seed).shuffle(ann_list)
+    num = int(len(ann_list) * validation_split)
+    # NOTE the reader can't read a split without shard
+    if num == 0 or num == len(ann_list):
+        print(ERROR, f'the {"test" if num == 0 else "train"} split of {len(ann_list)} annotations is empty, '
+                     f'change the vaildation split {validation_split}')
+        sys.exit(1)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    index = {'image_ann': image_ann,
+             'train': write_shards(ann_list[num:], output_dir, 'train', shard_size << 20),
+             'test': write_shards(ann_list[:num], output_dir, 'test', shard_size << 20)}
+    with open(os.path.join(output_dir, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+    print(INFO, f'Write {len(index["train"]["shards"])} train shards and {len(index["test"]["shards"])} test shards to {output_dir}')
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('image_ann', type=str, help='annotation npy file, such as data/voc_img_ann.npy')
+    parser.add_argument('output_dir', type=str, help=NOTE + 'output dir, keras_train.py use data/{train_set}_tfrecord')
+    parser.add_argument('--shard_size', type=int, help='max shard size (MB)', default=256)
+    parser.add_argument('--vaildation_split', type=float, help='vaildation split factor', default=0.1)
+    parser.add_argument('--rand_seed', type=int, help='random seed of the split', default=6)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_arguments(sys.argv[1:])
+    main(args.image_ann, args.output_dir, args.shard_size, args.vaildation_split, args.rand_seed)
@@ -3,10 +3,68 @@ import re
 import numpy as np
 import sys
 import argparse
-import skimage.io
+import json
+import hashlib
+from multiprocessing import Pool
+from PIL import Image
 
 
-def main(train_file: str, output_file: str):
+def read_ann(paths: tuple) -> list:
+    """ read the label file and the image [h, w] , only read the image header not decode the pixels
+
+    Parameters
+    ----------
+    paths : tuple
+        (image path, label path)
+
+    Returns
+    -------
+    list
+        [box shape, box bytes, (h, w)]
+    """
+    image_path, ann_path = paths
+    with Image.open(image_path) as img:
+        w, h = img.size
+    box = np.loadtxt(ann_path, dtype=float, ndmin=2)
+    return [box.shape, box.tobytes(), (h, w)]
+
+
+def file_sign(paths: tuple, compare: str) -> list:
+    """ the signature of the image and label file
+
+    Parameters
+    ----------
+    paths : tuple
+        (image path, label path)
+    compare : str
+        'stat' : [size, mtime_ns] of the two files
+        'hash' : md5 of the two files content
+
+    Returns
+    -------
+    list
+        signature
+    """
+    if compare == 'hash':
+        sign = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                sign.append(hashlib.md5(f.read()).hexdigest())
+        return sign
+    else:
+        sign = []
+        for path in paths:
+            st = os.stat(path)
+            sign += [st.st_size, st.st_mtime_ns]
+        return sign
+
+
+def stat_file(output_file: str) -> str:
+    """ the sidecar file of the output, record the file signature of every entry """
+    return os.path.splitext(output_file)[0] + '_stat.json'
+
+
+def main(train_file: str, output_file: str, num_workers: int, incremental: bool, compare: str):
     image_path_list = np.loadtxt(train_file, dtype=str)
 
     if not os.path.exists('data'):
@@ -17,23 +75,57 @@ def main(train_file: str, output_file: str):
     ann_list = [re.sub(r'images', 'labels', s) for s in ann_list]
     ann_list = [re.sub(r'.jpg', '.txt', s) for s in ann_list]
 
+    with Pool(num_workers) as pool:
+        signs = pool.starmap(file_sign, [(paths, compare) for paths in zip(image_path_list, ann_list)], chunksize=256)
+
+        """ reuse the unchanged entries of the last output """
+        results = [None] * len(ann_list)
+        if incremental and os.path.exists(output_file) and os.path.exists(stat_file(output_file)):
+            with open(stat_file(output_file)) as f:
+                stat = json.load(f)
+            if stat['compare'] == compare:
+                old = {str(path): (box, hw) for path, box, hw in np.load(output_file, allow_pickle=True)}
+                for i, path in enumerate(image_path_list):
+                    if path in old and stat['sign'].get(path) == signs[i]:
+                        box, hw = old[path]
+                        results[i] = [box.shape, box.astype(float).tobytes(), tuple(hw)]
+                print(f'Reuse {len(ann_list) - results.count(None)} entries, '
+                      f'drop {len(set(old.keys()) - set(image_path_list))} deleted entries')
+            else:
+                print(f'The last output compare by {stat["compare"]}, rebuild all entries')
+
+        todo = [i for i in range(len(ann_list)) if results[i] is None]
+        for n, (i, res) in enumerate(zip(todo, pool.imap(read_ann, [(image_path_list[i], ann_list[i]) for i in todo], chunksize=64))):
+            results[i] = res
+            if (n + 1) % 1000 == 0 or n + 1 == len(todo):
+                print(f'\r{n + 1}/{len(todo)}', end='', flush=True)
+        print()
+
+    # NOTE the unpickled array have a new dtype object, the pickled output will be different,
+    # so rebuild the array from bytes, the output is byte-identical to the sequential version
     lines = np.array([
         np.array([
             image_path_list[i],
-            np.loadtxt(ann_list[i], dtype=float, ndmin=2),
-            np.array(skimage.io.imread(image_path_list[i]).shape[0:2])]
+            np.frombuffer(results[i][1], dtype=float).reshape(results[i][0]).copy(),
+            np.array(results[i][2])]
         ) for i in range(len(ann_list))])
 
     np.save(output_file, lines)
+    with open(stat_file(output_file), 'w') as f:
+        json.dump({'compare': compare, 'sign': {str(path): sign for path, sign in zip(image_path_list, signs)}}, f)
+    print(f'Save {len(lines)} annotations to {output_file}')
 
 
 def parse_arguments(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument('train_file', type=str, help='trian.txt file path')
     parser.add_argument('output_file', type=str, help='output file path')
+    parser.add_argument('--num_workers', type=int, help='process number', default=os.cpu_count())
+    parser.add_argument('--incremental', type=str, help='reuse the unchanged entries of the existing output file', choices=['True', 'False'], default='False')
+    parser.add_argument('--compare', type=str, help='how to find the changed files, stat: size and mtime, hash: md5 of content', choices=['stat', 'hash'], default='stat')
     return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
     args = parse_arguments(sys.argv[1:])
-    main(args.train_file, args.output_file)
+    main(args.train_file, args.output_file, args.num_workers, args.incremental == 'True', args.compare)
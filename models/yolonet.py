@@ -191,6 +191,57 @@ def yolo(input_shape, anchor_num, class_num, **kwargs) -> [keras.Model, keras.Mo
     return yolo_model, yolo_model_warpper
 
 
+def uint8_input(yolo_model: keras.Model, yolo_model_warpper: keras.Model, normlize='max') -> [keras.Model, keras.Model]:
+    """ wrap the yolo models to take uint8 image, the first layer normlize the image in graph.
+        the wrapped models share the weights with the input models, so still use the input yolo_model to save.
+
+    Parameters
+    ----------
+    yolo_model : keras.Model
+
+    yolo_model_warpper : keras.Model
+
+    normlize : str
+        'max' : divide by the per-image max, same as `Helper._process_img`
+        '255' : divide by the fixed 255
+
+    Returns
+    -------
+    [keras.Model, keras.Model]
+        yolo_model,yolo_model_warpper which input is uint8
+    """
+    assert normlize in ['max', '255'], f'unknown normlize {normlize}'
+    inputs = keras.Input(yolo_model.input.shape[1:], dtype=tf.uint8)
+    if normlize == 'max':
+        x = Lambda(lambda img: tf.cast(img, tf.float32) /
+                   tf.cast(tf.reduce_max(img, axis=[1, 2, 3], keepdims=True), tf.float32), name='normlize')(inputs)
+    else:
+        x = Lambda(lambda img: tf.cast(img, tf.float32) / 255., name='normlize')(inputs)
+    return keras.Model(inputs, yolo_model(x)), keras.Model(inputs, yolo_model_warpper(x))
+
+
+def concat_output(yolo_model_warpper: keras.Model) -> keras.Model:
+    """ wrap the yolo model to output the flattened grids of all output layers in one tensor,
+        same order as `tools.utils.tf_concat_layers`, used by the fused loss.
+        the wrapped model share the weights with the input model.
+
+    Parameters
+    ----------
+    yolo_model_warpper : keras.Model
+
+    Returns
+    -------
+    keras.Model
+        output shape = [batch size, sum(h_n * w_n * anchors), class num + 5]
+    """
+    inputs = keras.Input(yolo_model_warpper.input.shape[1:], dtype=yolo_model_warpper.input.dtype)
+    x = yolo_model_warpper(inputs)
+    x = x if isinstance(x, list) else [x]
+    x = Lambda(lambda ys: tf.concat([tf.reshape(y, (tf.shape(y)[0], -1, y.shape[-1])) for y in ys], 1),
+               name='concat_output')(x)
+    return keras.Model(inputs, x)
+
+
 def resblock_body(x, num_filters, num_blocks):
     '''A series of resblocks starting with a downsampling Convolution2D'''
     # Darknet uses left and top padding instead of 'same' mode
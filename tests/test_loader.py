@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+from tools.bench import make_synthetic, make_anchors
+from tools.loader import ProcessLoader
+from tools.utils import Helper
+
+
+@pytest.fixture(scope='module')
+def image_ann(tmp_path_factory):
+    return make_synthetic(str(tmp_path_factory.mktemp('synthetic')), 16, [[120, 160], [240, 200]], 3, 4, 0)
+
+
+def test_iaa_worker_num(image_ann):
+    """ the imgaug augment only depend on (seed, epoch, index), not the worker number """
+    h = Helper(image_ann, 3, make_anchors(3, [7, 10, 14, 20]), np.array([[224, 320]]),
+               np.array([[7, 10], [14, 20]]), 0., augment_mode='iaa')
+    results = []
+    for num_workers in [1, 4]:
+        loader = ProcessLoader(h, h.train_list, True, True, 3, num_workers, shuffle=False, epochs=1)
+        try:
+            results.append(list(loader))
+        finally:
+            loader.close()
+    assert len(results[0]) == len(results[1]) == len(h.train_list)
+    for (img_a, labels_a), (img_b, labels_b) in zip(*results):
+        np.testing.assert_array_equal(img_a, img_b)
+        for label_a, label_b in zip(labels_a, labels_b):
+            np.testing.assert_array_equal(label_a, label_b)
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+import tensorflow.python as tf
+from tensorflow.python import keras
+from tools.bench import make_helper, random_label_pred, tiny_model, calc_ignore_mask_loop
+from tools.trainer import Trainer
+from tools.utils import create_loss_fn, create_fused_loss_fn, tf_concat_layers, calc_ignore_mask
+from models.yolonet import concat_output
+
+tf.enable_eager_execution()
+
+
+@pytest.fixture(scope='module')
+def h():
+    h = make_helper(3, 3, [64, 64], [4, 4, 8, 8])
+    h.batch_size = 4
+    return h
+
+
+def test_fused_loss(h):
+    """ the fused loss is same as the sum of the per layer loss """
+    labels, preds = random_label_pred(h, h.batch_size, 6, np.random.RandomState(0))
+    weights = (.7, .5, 5., .5, .5)
+    layer = sum([create_loss_fn(h, *weights, l)(labels[l], preds[l]).numpy() for l in range(h.output_number)])
+    loss = create_fused_loss_fn(h, *weights)
+    y_true, y_pred = tf_concat_layers(labels), tf_concat_layers(preds)
+    np.testing.assert_allclose(loss(y_true, y_pred).numpy(), layer, rtol=1e-5)
+    np.testing.assert_allclose(sum([v.numpy() for v in loss.terms(y_true, y_pred).values()]), layer, rtol=1e-5)
+
+
+@pytest.mark.parametrize('trainer', ['keras', 'custom'])
+def test_fused_term_metrics(h, trainer):
+    """ both trainers report the loss terms updated by the loss function, same as the terms of the batch """
+    labels, _ = random_label_pred(h, h.batch_size, 6, np.random.RandomState(0))
+    img = np.random.RandomState(1).uniform(0, 1, [h.batch_size] + list(h.in_hw[0]) + [3]).astype('float32')
+    y_true = tf_concat_layers(labels)
+    dataset = tf.data.Dataset.from_tensors((img, y_true)).repeat()
+
+    model = concat_output(tiny_model(h))
+    loss = create_fused_loss_fn(h, .7, .5, 5., .5, .5)
+    # NOTE zero learning rate, every step have the same terms
+    optimizer = keras.optimizers.SGD(lr=0.)
+    if trainer == 'keras':
+        model.compile(optimizer, loss=loss, metrics=loss.metrics)
+        logs = {k: v[-1] for k, v in model.fit(dataset, epochs=1, steps_per_epoch=3, verbose=0).history.items()}
+    else:
+        logs = Trainer(model, optimizer, loss, []).fit(dataset, 1, 3)[0]
+    terms = {k: v.numpy() for k, v in loss.terms(y_true, model(img)).items()}
+    for name, value in terms.items():
+        np.testing.assert_allclose(logs[name], value, rtol=1e-4)
+    np.testing.assert_allclose(logs['loss'], sum(terms.values()), rtol=1e-4)
+
+
+@pytest.mark.parametrize('box_chunk', [1, 4, 16])
+def test_ignore_mask(h, box_chunk):
+    """ the batch chunked ignore mask is same as the per-image loop, also when one image have no box """
+    labels, preds = random_label_pred(h, h.batch_size, 20, np.random.RandomState(2))
+    for label in labels:
+        label[0] = 0.
+    for l, (y, p) in enumerate(zip(labels, preds)):
+        inputs = (y[..., 0:2], y[..., 2:4], p[..., 0:2], p[..., 2:4], y[..., 4] > .7, .5, l, h)
+        np.testing.assert_array_equal(calc_ignore_mask(*inputs, box_chunk=box_chunk).numpy(),
+                                      calc_ignore_mask_loop(*inputs).numpy())
+
+
+@pytest.mark.parametrize('positive', [True, False])
+def test_sparse_loss(h, positive):
+    """ the sparse positive cell loss is same as the dense loss, also when no positive cell """
+    labels, preds = random_label_pred(h, h.batch_size, 6, np.random.RandomState(3))
+    if not positive:
+        labels = [np.zeros_like(label) for label in labels]
+    weights = (.7, .5, 5., .5, .5)
+    for l in range(h.output_number):
+        dense = create_loss_fn(h, *weights, l)(labels[l], preds[l]).numpy()
+        sparse = create_loss_fn(h, *weights, l, sparse=True)(labels[l], preds[l]).numpy()
+        np.testing.assert_allclose(sparse, dense, rtol=1e-5)
+    y_true, y_pred = tf_concat_layers(labels), tf_concat_layers(preds)
+    dense = create_fused_loss_fn(h, *weights)(y_true, y_pred).numpy()
+    sparse = create_fused_loss_fn(h, *weights, sparse=True)(y_true, y_pred).numpy()
+    np.testing.assert_allclose(sparse, dense, rtol=1e-5)
@@ -0,0 +1,20 @@
+import numpy as np
+from tools.store import AnnStore
+
+
+def test_ann_store_path(tmp_path):
+    """ the path column is utf-8 bytes with offsets, same path as the object array """
+    ann_list = np.empty((3, 3), object)
+    for i, path in enumerate(['/data/a.jpg', '/data/图片_1.jpg', '/a/much/longer/path/to/the/image.jpg']):
+        ann_list[i] = [path, np.full((i + 1, 5), i, np.float32), np.array([480, 640])]
+    store = AnnStore.build(str(tmp_path / 'ann'), ann_list)
+    assert store.path.dtype == np.uint8
+    for row, (path, box, shape) in zip(store, ann_list):
+        assert row[0] == path
+        np.testing.assert_array_equal(row[1], box)
+        np.testing.assert_array_equal(row[2], shape)
+
+    view = store[np.array([2, 0])]
+    blob, start, length = view.paths()
+    assert [blob[s:s + l].decode() for s, l in zip(start, length)] == [ann_list[2][0], ann_list[0][0]]
+    assert view[0][0] == ann_list[2][0]
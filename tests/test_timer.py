@@ -0,0 +1,21 @@
+import pytest
+
+pytest.importorskip('tensorflow')
+from tools.utils import StageTimer
+
+
+def test_verdict():
+    """ the ready batches are sampled after the step, before the next fetch """
+    starved = StageTimer()
+    for _ in range(10):
+        starved.mark_batch('train')  # NOTE the batch is produced only when the model ask it
+        starved.mark_consume()
+    assert starved.summary()['verdict'] == 'input-bound'
+
+    ahead = StageTimer()
+    for _ in range(3):
+        ahead.mark_batch('train')
+    for _ in range(10):
+        ahead.mark_batch('train')
+        ahead.mark_consume()
+    assert ahead.summary()['verdict'] == 'compute-bound'
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+import tensorflow.python as tf
+from tensorflow.python import keras
+from tools.bench import make_helper, random_box, random_label_pred, tiny_model
+from tools.custom import Yolo_Precision, Yolo_Recall
+from tools.trainer import Trainer
+from tools.utils import create_loss_fn, tf_batch_box_to_label
+
+tf.enable_eager_execution()
+
+
+@pytest.fixture(scope='module')
+def h():
+    h = make_helper(3, 3, [64, 64], [4, 4, 8, 8])
+    h.batch_size = 4
+    return h
+
+
+def make_dataset(h) -> tf.data.Dataset:
+    labels, _ = random_label_pred(h, h.batch_size, 6, np.random.RandomState(0))
+    img = np.random.RandomState(1).uniform(0, 1, [h.batch_size] + list(h.in_hw[0]) + [3]).astype('float32')
+    return tf.data.Dataset.from_tensors((img, tuple(labels))).repeat()
+
+
+def test_output_metrics(h):
+    """ every output have its own metrics, same as `keras.Model.fit` """
+    model = tiny_model(h)
+    loss = [create_loss_fn(h, .7, .5, 5., .5, .5, l) for l in range(h.output_number)]
+    trainer = Trainer(model, keras.optimizers.Adam(lr=1e-4), loss, [Yolo_Precision(.7, name='p'), Yolo_Recall(.7, name='r')])
+    logs = trainer.fit(make_dataset(h), 1, 2)[0]
+    for name in model.output_names:
+        assert f'{name}_p' in logs and f'{name}_r' in logs
+    assert trainer.metrics[0][0].thresholds == .7
+
+
+def test_pruning(h):
+    """ the pruning callbacks read `model.optimizer` """
+    sparsity = pytest.importorskip('tensorflow_model_optimization.python.core.api.sparsity').keras
+    model = sparsity.prune_low_magnitude(tiny_model(h), pruning_schedule=sparsity.PolynomialDecay(0., .5, 0, 4, frequency=1))
+    loss = [create_loss_fn(h, .7, .5, 5., .5, .5, l) for l in range(h.output_number)]
+    optimizer = keras.optimizers.Adam(lr=1e-4)
+    trainer = Trainer(model, optimizer, loss, [], [sparsity.UpdatePruningStep()])
+    trainer.fit(make_dataset(h), 1, 4)
+    assert model.optimizer is optimizer
+    assert int(optimizer.iterations.numpy()) == 4
+
+
+def test_label_fn(h):
+    """ the padded boxes dataset with the labels built in the train step, same loss as the dense labels """
+    true_box, box_num = random_box(h.batch_size, 6, h.class_num, np.random.RandomState(0))
+    labels = h.box_to_label_batch(true_box, box_num)
+    img = np.random.RandomState(1).uniform(0, 1, [h.batch_size] + list(h.in_hw[0]) + [3]).astype('float32')
+    loss = [create_loss_fn(h, .7, .5, 5., .5, .5, l) for l in range(h.output_number)]
+    model = tiny_model(h)
+    dense = Trainer(model, keras.optimizers.SGD(lr=0.), loss, [])
+    box = Trainer(model, keras.optimizers.SGD(lr=0.), loss, [],
+                  label_fn=lambda true_box, box_num: tuple(tf_batch_box_to_label(true_box, box_num, h)))
+    dense_logs = dense.fit(tf.data.Dataset.from_tensors((img, tuple(labels))).repeat(), 1, 1)[0]
+    box_logs = box.fit(tf.data.Dataset.from_tensors((img, true_box.astype('float32'), box_num.astype('int32'))).repeat(), 1, 1)[0]
+    np.testing.assert_allclose(box_logs['loss'], dense_logs['loss'], rtol=1e-5)
@@ -0,0 +1,699 @@
+""" data pipeline benchmarks, run with `python3 -m tools.bench <name> -h` """
+import numpy as np
+import os
+import sys
+import tempfile
+import argparse
+import time
+import json
+import subprocess
+import skimage.transform
+from PIL import Image
+import tensorflow.python as tf
+from tensorflow.python import keras
+from tensorflow.python.ops.io_ops import read_file
+import make_voc_list
+from tools.trainer import Trainer
+from tools.custom import Yolo_Precision, Yolo_Recall
+from tools.utils import Helper, tf_box_to_label, tf_batch_box_to_label, tf_xywh_to_all, tf_iou, calc_ignore_mask, \
+    create_loss_fn, create_fused_loss_fn, tf_concat_layers, INFO, ERROR, NOTE
+
+
+def timeit(fn, repeat: int) -> float:
+    """ run `fn` `repeat` times, return the mean seconds per call """
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def make_anchors(anchor_num: int, out_hw: list) -> str:
+    """ save the linspace anchors to a temp file, return the file path """
+    layers = len(out_hw) // 2
+    wh = np.vstack((np.linspace(0.05, 0.3, num=layers * anchor_num), np.linspace(0.05, 0.5, num=layers * anchor_num))).T
+    anchors = os.path.join(tempfile.mkdtemp(), 'anchor.npy')
+    np.save(anchors, np.reshape(np.array(sorted(wh, key=lambda x: (-x[0]))), (layers, anchor_num, 2)))
+    return anchors
+
+
+def make_helper(class_num: int, anchor_num: int, in_hw: list, out_hw: list, anchors: str = None) -> Helper:
+    """ make a Helper without annotation, when `anchors` is None use linspace anchors """
+    if anchors is None:
+        anchors = make_anchors(anchor_num, out_hw)
+    return Helper(None, class_num, anchors, np.reshape(np.array(in_hw), (-1, 2)), np.reshape(np.array(out_hw), (-1, 2)))
+
+
+def random_box(batch: int, max_box: int, class_num: int, rand: np.random.RandomState) -> [np.ndarray, np.ndarray]:
+    """ random padded annotation, return [true_box, box_num] """
+    box_num = rand.randint(1, max_box + 1, batch)
+    true_box = np.zeros((batch, max_box, 5))
+    for i in range(batch):
+        wh = rand.uniform(0.02, 0.6, (box_num[i], 2))
+        xy = rand.uniform(wh / 2, 1 - wh / 2)
+        true_box[i, :box_num[i]] = np.hstack((rand.randint(0, class_num, (box_num[i], 1)), xy, wh))
+    return true_box, box_num
+
+
+def box_to_label_loop(h: Helper, true_box: np.ndarray) -> list:
+    """ the per-box loop version of `Helper.box_to_label`, used as reference """
+    labels = [np.zeros((h.out_hw[i][0], h.out_hw[i][1], len(h.anchors[i]),
+                        5 + h.class_num), dtype='float32') for i in range(h.output_number)]
+    for box in true_box:
+        l, n = h._get_anchor_index(box[3:5])
+        idx, idy = h._xy_grid_index(box[1:3], l)
+        labels[l][idy, idx, n, 0:4] = np.clip(box[1:5], 1e-8, 1.)
+        labels[l][idy, idx, n, 4] = 1.
+        labels[l][idy, idx, n, 5 + int(box[0])] = 1.
+    return labels
+
+
+def bench_label(args):
+    h = make_helper(args.class_num, args.anchor_num, args.in_hw, args.out_hw, args.anchors)
+    rand = np.random.RandomState(args.rand_seed)
+    true_box, box_num = random_box(args.batch_size, args.max_box, args.class_num, rand)
+
+    """ check the result """
+    batch_labels = h.box_to_label_batch(true_box, box_num)
+    for i in range(args.batch_size):
+        ref_labels = box_to_label_loop(h, true_box[i, :box_num[i]])
+        for l in range(h.output_number):
+            if not np.array_equal(ref_labels[l], batch_labels[l][i]):
+                print(ERROR, f'batch label mismatch at image {i} layer {l}')
+                sys.exit(1)
+
+    tf_labels = tf_batch_box_to_label(tf.constant(true_box, tf.float32), tf.constant(box_num, tf.int32), h)
+    for l in range(h.output_number):
+        if not np.array_equal(batch_labels[l], tf_labels[l].numpy()):
+            print(ERROR, f'graph label mismatch at layer {l}')
+            sys.exit(1)
+
+    """ speed """
+    buffers = [np.zeros_like(label) for label in batch_labels]
+    loop_t = timeit(lambda: [box_to_label_loop(h, true_box[i, :box_num[i]]) for i in range(args.batch_size)], args.repeat)
+    batch_t = timeit(lambda: h.box_to_label_batch(true_box, box_num, buffers), args.repeat)
+    print(INFO, f'batch {args.batch_size} mean boxes {box_num.mean():.1f}')
+    print(INFO, f'loop  : {args.batch_size / loop_t:10.1f} img/s')
+    print(INFO, f'batch : {args.batch_size / batch_t:10.1f} img/s ({loop_t / batch_t:.1f}x)')
+    graph_t = timeit(lambda: tf_batch_box_to_label(tf.constant(true_box, tf.float32), tf.constant(box_num, tf.int32), h), args.repeat)
+    print(INFO, f'graph : {args.batch_size / graph_t:10.1f} img/s ({loop_t / graph_t:.1f}x)')
+    dense = sum([label.nbytes for label in batch_labels])
+    print(INFO, f'input pipeline bytes per batch : label_mode dense {dense} , '
+                f'label_mode box {true_box.astype("float32").nbytes + box_num.astype("int32").nbytes} (labels built in the train step)')
+
+
+def calc_ignore_mask_loop(t_xy_A: tf.Tensor, t_wh_A: tf.Tensor, p_xy: tf.Tensor, p_wh: tf.Tensor, obj_mask: tf.Tensor,
+                          iou_thresh: float, layer: int, helper: Helper) -> tf.Tensor:
+    """ the per-image loop version of `calc_ignore_mask`, used as reference """
+    pred_xy, pred_wh = tf_xywh_to_all(p_xy, p_wh, layer, helper)
+    ignore_mask = []
+    for bc in range(helper.batch_size):
+        vaild_xy = tf.boolean_mask(t_xy_A[bc], obj_mask[bc])
+        vaild_wh = tf.boolean_mask(t_wh_A[bc], obj_mask[bc])
+        iou_score = tf_iou(pred_xy[bc], pred_wh[bc], vaild_xy, vaild_wh)
+        best_iou = tf.reduce_max(iou_score, axis=-1, keepdims=True)
+        ignore_mask.append(tf.cast(best_iou < iou_thresh, tf.float32))
+    return tf.stack(ignore_mask)
+
+
+def random_label_pred(h: Helper, batch: int, max_box: int, rand: np.random.RandomState) -> [list, list]:
+    """ random labels and raw predictions of every output layer """
+    true_box, box_num = random_box(batch, max_box, h.class_num, rand)
+    labels = h.box_to_label_batch(true_box, box_num)
+    preds = [rand.normal(0, 0.5, label.shape).astype('float32') for label in labels]
+    return labels, preds
+
+
+def bench_ignore(args):
+    h = make_helper(args.class_num, args.anchor_num, args.in_hw, args.out_hw, args.anchors)
+    rand = np.random.RandomState(args.rand_seed)
+    for batch_size in args.batch_sizes:
+        h.batch_size = batch_size
+        labels, preds = random_label_pred(h, batch_size, args.max_box, rand)
+
+        def build(fn, y_trues, y_preds):
+            return [fn(y[..., 0:2], y[..., 2:4], p[..., 0:2], p[..., 2:4], y[..., 4] > args.obj_thresh, args.iou_thresh, l, h)
+                    for l, (y, p) in enumerate(zip(y_trues, y_preds))]
+
+        def chunk_mask(*inputs):
+            return calc_ignore_mask(*inputs, box_chunk=args.box_chunk)
+
+        """ check the result """
+        ref = build(calc_ignore_mask_loop, labels, preds)
+        out = build(chunk_mask, labels, preds)
+        for l in range(h.output_number):
+            if not np.array_equal(ref[l].numpy(), out[l].numpy()):
+                print(ERROR, f'batch {batch_size} ignore mask mismatch at layer {l}')
+                sys.exit(1)
+
+        """ graph build time and step time """
+        result = {}
+        for name, fn in [('loop', calc_ignore_mask_loop), ('batch', chunk_mask)]:
+            graph = tf.Graph()
+            with graph.as_default():
+                start = time.perf_counter()
+                y_trues = [tf.placeholder(tf.float32, label.shape) for label in labels]
+                y_preds = [tf.placeholder(tf.float32, pred.shape) for pred in preds]
+                masks = build(fn, y_trues, y_preds)
+                build_t = time.perf_counter() - start
+                feed = dict(zip(y_trues + y_preds, labels + preds))
+                with tf.Session(graph=graph) as sess:
+                    step_t = timeit(lambda: sess.run(masks, feed), args.repeat)
+            result[name] = step_t
+            print(INFO, f'batch {batch_size:4d} {name:5s}: {len(graph.get_operations()):6d} ops, '
+                        f'build {build_t * 1000:8.1f} ms, step {step_t * 1000:8.2f} ms')
+        print(INFO, f'batch {batch_size:4d} speedup {result["loop"] / result["batch"]:.1f}x')
+
+        """ the peak iou tensor bytes, dense [batch, pred num, max box num] vs chunked [batch, pred num, box_chunk] """
+        for l, label in enumerate(labels):
+            pred_num = np.prod(label.shape[1:4])
+            box_num = np.max(np.sum(label[..., 4] > args.obj_thresh, axis=(1, 2, 3)))
+            print(INFO, f'batch {batch_size:4d} layer {l} max box {box_num:3d} : iou bytes dense {batch_size * pred_num * box_num * 4} , '
+                        f'chunked {batch_size * pred_num * min(args.box_chunk, box_num) * 4}')
+
+
+def bench_loss(args):
+    h = make_helper(args.class_num, args.anchor_num, args.in_hw, args.out_hw, args.anchors)
+    h.batch_size = args.batch_size
+    rand = np.random.RandomState(args.rand_seed)
+    labels, preds = random_label_pred(h, args.batch_size, args.max_box, rand)
+    weights = (args.obj_thresh, args.iou_thresh, args.obj_weight, args.noobj_weight, args.wh_weight)
+
+    def make_layer_loss(sparse: bool):
+        loss_fns = [create_loss_fn(h, *weights, l, sparse=sparse) for l in range(h.output_number)]
+        return lambda y_trues, y_preds: tf.add_n([fn(y, p) for fn, y, p in zip(loss_fns, y_trues, y_preds)])
+
+    def make_fused_loss(sparse: bool):
+        fused_fn = create_fused_loss_fn(h, *weights, sparse=sparse)
+        return lambda y_trues, y_preds: fused_fn(tf_concat_layers(y_trues), tf_concat_layers(y_preds))
+
+    modes = [('layer', make_layer_loss(False)), ('layer sparse', make_layer_loss(True)),
+             ('fused', make_fused_loss(False)), ('fused sparse', make_fused_loss(True))]
+
+    """ check the result """
+    ref = modes[0][1](labels, preds).numpy()
+    terms = create_fused_loss_fn(h, *weights).terms(tf_concat_layers(labels), tf_concat_layers(preds))
+    print(INFO, f'positive cells {sum([np.sum(label[..., 4] > args.obj_thresh) for label in labels])} of '
+                f'{sum([np.prod(label.shape[:4]) for label in labels])}, loss {ref:.6f} terms '
+                + ' '.join([f'{k} {v.numpy():.4f}' for k, v in terms.items()]))
+    for name, fn in modes[1:]:
+        out = fn(labels, preds).numpy()
+        if not np.isclose(ref, out, rtol=1e-5):
+            print(ERROR, f'{name} loss {out:.6f} mismatch')
+            sys.exit(1)
+
+    """ loss and gradient step time """
+    result = {}
+    for name, fn in modes:
+        graph = tf.Graph()
+        with graph.as_default():
+            y_trues = [tf.placeholder(tf.float32, label.shape) for label in labels]
+            y_preds = [tf.placeholder(tf.float32, pred.shape) for pred in preds]
+            loss = fn(y_trues, y_preds)
+            grads = tf.gradients(loss, y_preds)
+            feed = dict(zip(y_trues + y_preds, labels + preds))
+            with tf.Session(graph=graph) as sess:
+                result[name] = timeit(lambda: sess.run([loss, grads], feed), args.repeat)
+        print(INFO, f'{name:12s}: {len(graph.get_operations()):6d} ops, step {result[name] * 1000:8.2f} ms '
+                    f'({result["layer"] / result[name]:.2f}x)')
+
+
+def tiny_model(h: Helper) -> keras.Model:
+    """ a small conv net with the yolo outputs of `h`, the step time is dominated by the framework overhead """
+    inputs = keras.Input(list(h.in_hw[0]) + [3])
+    x, heads = inputs, {}
+    while int(x.shape[1]) > np.min(h.out_hw[:, 0]):
+        x = keras.layers.Conv2D(16, 3, 2, 'same', activation='relu')(x)
+        for l in range(h.output_number):
+            if [int(d) for d in x.shape[1:3]] == list(h.out_hw[l]):
+                y = keras.layers.Conv2D(len(h.anchors[l]) * (h.class_num + 5), 1)(x)
+                heads[l] = keras.layers.Reshape(list(h.out_hw[l]) + [len(h.anchors[l]), h.class_num + 5])(y)
+    return keras.Model(inputs, [heads[l] for l in range(h.output_number)])
+
+
+def bench_train(args):
+    h = make_helper(args.class_num, args.anchor_num, args.in_hw, args.out_hw, args.anchors)
+    h.batch_size = args.batch_size
+    rand = np.random.RandomState(args.rand_seed)
+    labels, _ = random_label_pred(h, args.batch_size, args.max_box, rand)
+    img = rand.uniform(0, 1, [args.batch_size] + list(h.in_hw[0]) + [3]).astype('float32')
+    dataset = tf.data.Dataset.from_tensors((img, tuple(labels))).repeat()
+
+    def make_loss():
+        return [create_loss_fn(h, .7, .5, 5., .5, .5, l) for l in range(h.output_number)]
+
+    def make_metrics():
+        return [Yolo_Precision(.7, name='p'), Yolo_Recall(.7, name='r')]
+
+    result = {}
+    for name in ['keras', 'custom']:
+        model = tiny_model(h)
+        optimizer = keras.optimizers.Adam(lr=1e-4)
+        if name == 'keras':
+            model.compile(optimizer, loss=make_loss(), metrics=make_metrics())
+            model.fit(dataset, epochs=1, steps_per_epoch=args.warmup, verbose=0)  # warm up
+            start = time.perf_counter()
+            model.fit(dataset, epochs=1, steps_per_epoch=args.step, verbose=0)
+        else:
+            trainer = Trainer(model, optimizer, make_loss(), make_metrics())
+            trainer.fit(dataset, 1, args.warmup)  # warm up
+            start = time.perf_counter()
+            trainer.fit(dataset, 1, args.step)
+        result[name] = (time.perf_counter() - start) / args.step
+        print(INFO, f'{name:6s}: {result[name] * 1000:8.2f} ms/step ({result["keras"] / result[name]:.2f}x)')
+
+
+def make_ann_helper(args) -> Helper:
+    """ make a Helper with annotation, all the annotation are used as train list """
+    return Helper(args.image_ann, args.class_num, args.anchors,
+                  np.reshape(np.array(args.in_hw), (-1, 2)), np.reshape(np.array(args.out_hw), (-1, 2)), 0.)
+
+
+def dataset_speed(dataset: tf.data.Dataset, batch_size: int, step: int) -> float:
+    """ iterate the dataset, return the img/s """
+    it = iter(dataset)
+    next(it)  # warm up
+    start = time.perf_counter()
+    for _ in range(step):
+        next(it)
+    return step * batch_size / (time.perf_counter() - start)
+
+
+def bench_parser(args):
+    h = make_ann_helper(args)
+
+    """ check the native parser with numpy parser """
+    max_diff, label_diff = 0, 0
+    for img_path, true_box, _ in h.train_list[:args.check_num]:
+        np_img, np_box = h._process_img(h._read_img(img_path), np.copy(true_box), False, True)
+        np_labels = h.box_to_label(np_box)
+        tf_img = tf.image.decode_jpeg(read_file(img_path), channels=3)
+        tf_img, tf_box = h._tf_process_img(tf_img, tf.constant(true_box, tf.float32), False, True)
+        tf_labels = tf_box_to_label(tf_box, h)
+        max_diff = max(max_diff, np.max(np.abs(np_img * 255 - tf_img.numpy() * 255)))
+        label_diff = max(label_diff, max([np.max(np.abs(a - b.numpy())) for a, b in zip(np_labels, tf_labels)]))
+    print(INFO, f'max pixel diff {max_diff:.2f}, max label diff {label_diff:.6f}')
+    if max_diff > args.tolerance:
+        print(ERROR, f'pixel diff over tolerance {args.tolerance}')
+        sys.exit(1)
+
+    """ speed """
+    for parser in ['py', 'native']:
+        dataset = h._create_dataset(h.train_list, args.batch_size, args.rand_seed, False, True, parser=parser)
+        print(INFO, f'{parser:6s}: {dataset_speed(dataset, args.batch_size, args.step):10.1f} img/s')
+
+
+def bench_dtype(args):
+    h = make_ann_helper(args)
+    for parser in ['py', 'native']:
+        for image_dtype in ['float32', 'uint8']:
+            dataset = h._create_dataset(h.train_list, args.batch_size, args.rand_seed, False, True, parser=parser,
+                                        image_dtype=image_dtype)
+            img, _ = next(iter(dataset))
+            print(INFO, f'{parser:6s} {image_dtype:7s}: {dataset_speed(dataset, args.batch_size, args.step):10.1f} img/s, '
+                        f'image {img.numpy().nbytes / 2**20:.2f} MB per batch')
+
+
+def letterbox_warp(h: Helper, img: np.ndarray) -> np.ndarray:
+    """ the skimage warp letterbox, used as reference """
+    img_wh = np.array([img.shape[1], img.shape[0]])
+    in_wh = h.in_hw[0][::-1]
+    scale = in_wh / img_wh
+    scale[:] = np.min(scale)
+    translation = ((in_wh - img_wh * scale) / 2).astype(int)
+    aff = skimage.transform.AffineTransform(scale=scale, translation=translation)
+    return skimage.transform.warp(img, aff.inverse, output_shape=h.in_hw[0], preserve_range=True).astype('uint8')
+
+
+def bench_letterbox(args):
+    h = make_helper(args.class_num, args.anchor_num, args.in_hw, args.out_hw, args.anchors)
+    rand = np.random.RandomState(args.rand_seed)
+    img = rand.randint(0, 256, (args.img_hw[0], args.img_hw[1], 3)).astype('uint8')
+    # NOTE smooth the noise image, or the interpolation diff is meaningless
+    img = skimage.transform.resize(img, (img.shape[0] // 8, img.shape[1] // 8), preserve_range=True)
+    img = skimage.transform.resize(img, args.img_hw, order=1, preserve_range=True).astype('uint8')
+    warp_t = timeit(lambda: letterbox_warp(h, img), args.repeat)
+    ref = letterbox_warp(h, img).astype('float32')
+    print(INFO, f'image {args.img_hw} -> {list(h.in_hw[0])}')
+    print(INFO, f'{"warp":9s}: {1 / warp_t:10.1f} img/s')
+    for interpolation in h.interp_method.keys():
+        h.interpolation = interpolation
+        t = timeit(lambda: h._resize_img(img, None), args.repeat)
+        diff = np.mean(np.abs(h._resize_img(img, None)[0] - ref))
+        print(INFO, f'{interpolation:9s}: {1 / t:10.1f} img/s ({warp_t / t:.1f}x) mean abs diff to warp {diff:.2f}')
+
+
+def bench_shuffle(args):
+    image_ann = make_synthetic(args.data_dir, args.num, [[64, 64]], args.class_num, 1, args.rand_seed)
+    args.image_ann = image_ann
+    h = make_ann_helper(args)
+    # NOTE the class column carry the sample id through the real pipeline
+    ann_list = np.empty((len(h.train_list), 3), object)
+    for i, (img_path, _, img_hw) in enumerate(h.train_list):
+        ann_list[i] = [img_path, np.array([[i, .5, .5, .1, .1]]), img_hw]
+    num = len(ann_list)
+
+    def sample_ids(shuffle_buffer: int) -> np.ndarray:
+        dataset = h._create_dataset(ann_list, args.batch_size, args.rand_seed, False, True, parser='native',
+                                    shuffle_buffer=shuffle_buffer, label_mode='box')
+        it, ids = iter(dataset), []
+        while len(ids) < num * args.epochs:
+            ids.extend(next(it)[1][:, 0, 0].numpy().astype('int64').tolist())
+        return np.array(ids[:num * args.epochs])
+
+    """ the full shuffle, every epoch is a permutation """
+    ids = sample_ids(0)
+    for epoch in range(args.epochs):
+        if not np.array_equal(np.sort(ids[epoch * num:(epoch + 1) * num]), np.arange(num)):
+            print(ERROR, f'full shuffle epoch {epoch} is not a permutation')
+            sys.exit(1)
+    print(INFO, f'full shuffle : {args.epochs} epochs are all permutation')
+
+    """ the streaming shuffle, the buffer only move the samples across the epoch boundary by at most `shuffle_buffer` """
+    ids = sample_ids(args.shuffle_buffer)
+    for epoch in range(1, args.epochs + 1):
+        count = np.bincount(ids[:epoch * num], minlength=num)
+        if len(count) != num or np.any(np.abs(count - epoch) > 1) or np.sum(count != epoch) > 2 * args.shuffle_buffer:
+            print(ERROR, f'streaming shuffle drop or repeat the samples before epoch {epoch} end')
+            sys.exit(1)
+    print(INFO, f'streaming shuffle : every sample appears once per epoch, buffer {args.shuffle_buffer}')
+    print(INFO, f'peak memory {h.shuffle_memory(args.shuffle_buffer, num) / 2**20:.1f} MB vs '
+                f'full shuffle {h.shuffle_memory(num, num) / 2**20:.1f} MB')
+
+
+def bench_feed(args):
+    h = make_helper(args.class_num, args.anchor_num, args.in_hw, args.out_hw, args.anchors)
+    rand = np.random.RandomState(args.rand_seed)
+    true_box, box_num = random_box(args.num, args.max_box, args.class_num, rand)
+    ann_list = np.empty((args.num, 3), object)
+    for i in range(args.num):
+        ann_list[i] = [f'/data/{i:08d}.jpg', true_box[i, :box_num[i]], np.array([480, 640])]
+
+    def gen():
+        while True:
+            for img_path, box, _ in ann_list:
+                yield img_path, np.copy(box)
+
+    generator = tf.data.Dataset.from_generator(gen, (tf.string, tf.float32), ([], [None, 5]))
+    ann_tensors = h._ann_tensors(ann_list)
+    ragged = (tf.data.Dataset.range(args.num).shuffle(args.num, args.rand_seed).repeat().
+              map(lambda i: h._tf_lookup_ann(ann_tensors, i), tf.data.experimental.AUTOTUNE))
+
+    """ the ragged lookup return the same annotation """
+    for i in rand.randint(0, args.num, args.check_num):
+        path, box = h._tf_lookup_ann(ann_tensors, i)
+        if path.numpy().decode() != ann_list[i][0] or not np.allclose(box.numpy(), ann_list[i][1]):
+            print(ERROR, f'annotation {i} is different')
+            sys.exit(1)
+    for name, dataset in [('generator', generator), ('ragged', ragged)]:
+        dataset = dataset.map(lambda img_path, box: tf.shape(box)[0]).batch(args.batch_size)
+        print(INFO, f'{name:9s}: {dataset_speed(dataset, args.batch_size, args.step):10.1f} elements/s')
+
+
+def make_synthetic(data_dir: str, num: int, img_hws: list, class_num: int, max_box: int, rand_seed: int) -> str:
+    """ generate a synthetic dataset offline : random jpegs, darknet labels, train.txt and the annotation npy
+
+    Parameters
+    ----------
+    data_dir : str
+
+    num : int
+        image num
+    img_hws : list
+        image sizes [[h, w], ...], the images use them in turn
+    class_num : int
+
+    max_box : int
+        max box num per image
+    rand_seed : int
+
+    Returns
+    -------
+    str
+        the annotation npy file path
+    """
+    image_ann = os.path.join(data_dir, 'synthetic_img_ann.npy')
+    if os.path.exists(image_ann):
+        return image_ann
+    for d in ['images', 'labels']:
+        os.makedirs(os.path.join(data_dir, d), exist_ok=True)
+    rand = np.random.RandomState(rand_seed)
+    paths = []
+    for i in range(num):
+        hw = img_hws[i % len(img_hws)]
+        # NOTE smooth noise, so the jpeg size is close to the natural image
+        img = rand.randint(0, 256, (hw[0] // 16 + 1, hw[1] // 16 + 1, 3)).astype('uint8')
+        img = Image.fromarray(img).resize((hw[1], hw[0]), Image.BILINEAR)
+        paths.append(os.path.abspath(os.path.join(data_dir, 'images', f'{i:07d}.jpg')))
+        img.save(paths[-1], quality=90)
+        true_box, box_num = random_box(1, max_box, class_num, rand)
+        np.savetxt(os.path.join(data_dir, 'labels', f'{i:07d}.txt'), true_box[0, :box_num[0]], fmt='%g')
+        if (i + 1) % 100 == 0 or i + 1 == num:
+            print(f'\r{i + 1}/{num}', end='', flush=True)
+    print()
+    with open(os.path.join(data_dir, 'train.txt'), 'w') as f:
+        f.write('\n'.join(paths) + '\n')
+    make_voc_list.main(os.path.join(data_dir, 'train.txt'), image_ann, os.cpu_count(), False, 'stat')
+    return image_ann
+
+
+def bench_suite(args):
+    image_ann = make_synthetic(args.data_dir, args.num, np.reshape(args.img_hw, (-1, 2)).tolist(),
+                               args.class_num, args.max_box, args.rand_seed)
+    if args.anchors is None:
+        args.anchors = make_anchors(args.anchor_num, args.out_hw)
+    args.image_ann = image_ann
+    h = make_ann_helper(args)
+    ann = h.train_list[:args.stage_num]
+    results = {}
+
+    """ every stage on its own """
+    imgs = [h._read_img(img_path) for img_path, _, _ in ann]
+    boxes = [h._process_img(img, np.copy(box), False, True)[1] for img, (_, box, _) in zip(imgs, ann)]
+    stages = {'stage/read': lambda: [h._read_img(img_path) for img_path, _, _ in ann],
+              'stage/process': lambda: [h._process_img(img, np.copy(box), False, True) for img, (_, box, _) in zip(imgs, ann)],
+              'stage/label': lambda: [h.box_to_label(box) for box in boxes]}
+    for name, fn in stages.items():
+        results[name] = len(ann) / timeit(fn, args.repeat)
+
+    """ Helper.generator """
+    def run_generator():
+        for _ in h.generator(False, True, True, ann):
+            pass
+    results['generator'] = len(ann) / timeit(run_generator, args.repeat)
+
+    """ _create_dataset """
+    for parser in ['py', 'native']:
+        for batch_size in args.batch_sizes:
+            dataset = h._create_dataset(h.train_list, batch_size, args.rand_seed, False, True, parser=parser)
+            results[f'dataset/{parser}/batch_{batch_size}'] = dataset_speed(dataset, batch_size, args.step)
+
+    for name, v in results.items():
+        print(INFO, f'{name:28s}: {v:10.1f} img/s')
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        commit = None
+    output = {'commit': commit, 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'config': {k: v for k, v in vars(args).items() if k != 'func'}, 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(INFO, f'Save results to {args.output}')
+
+    """ regression check """
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        slow = [name for name in results if name in baseline and results[name] < baseline[name] * (1 - args.threshold)]
+        for name in slow:
+            print(ERROR, f'{name} slow down {(1 - results[name] / baseline[name]) * 100:.1f}% '
+                         f'({baseline[name]:.1f} -> {results[name]:.1f} img/s)')
+        if slow:
+            sys.exit(1)
+        print(INFO, f'No regression over {args.threshold * 100:.0f}% compare to {args.baseline}')
+
+
+def bench_decode(args):
+    h = make_helper(args.class_num, args.anchor_num, args.in_hw, args.out_hw, args.anchors)
+    rand = np.random.RandomState(args.rand_seed)
+    img_path = os.path.join(tempfile.mkdtemp(), 'decode.jpg')
+    img = rand.randint(0, 256, (args.img_hw[0] // 16, args.img_hw[1] // 16, 3)).astype('uint8')
+    Image.fromarray(img).resize((args.img_hw[1], args.img_hw[0]), Image.BILINEAR).save(img_path, quality=90)
+    true_box, box_num = random_box(1, 10, args.class_num, rand)
+    true_box = true_box[0, :box_num[0]]
+
+    res = {}
+    for reduce_decode in [False, True]:
+        h.reduce_decode = reduce_decode
+        t = timeit(lambda: h._read_img(img_path), args.repeat)
+        src = h._read_img(img_path)
+        res[reduce_decode] = h._resize_img(src, np.copy(true_box))
+        print(INFO, f'reduce_decode {str(reduce_decode):5s}: decode {list(src.shape[:2])} {1 / t:8.1f} img/s, {src.nbytes / 2**20:.1f} MB')
+    print(INFO, f'letterbox mean abs diff {np.mean(np.abs(res[False][0].astype(float) - res[True][0])):.2f}, '
+                f'max box diff {np.max(np.abs(res[False][1] - res[True][1])) * np.max(h.in_hw[0]):.2f} pixel')
+
+
+def bench_augment(args):
+    h = make_helper(args.class_num, args.anchor_num, args.in_hw, args.out_hw, args.anchors)
+    rand = np.random.RandomState(args.rand_seed)
+    img = rand.randint(0, 256, (args.img_hw[0] // 16, args.img_hw[1] // 16, 3)).astype('uint8')
+    img = np.asarray(Image.fromarray(img).resize((args.img_hw[1], args.img_hw[0]), Image.BILINEAR))
+    true_box, box_num = random_box(1, 10, args.class_num, rand)
+    true_box = true_box[0, :box_num[0]]
+
+    """ check the fused box with the warped box pixels """
+    max_diff = 0
+    for i in range(args.check_num):
+        mask = np.zeros_like(img)
+        xyxy = h.center_to_corner(true_box[0:1, 1:], False)[0] * np.tile(args.img_hw[::-1], 2)
+        mask[int(xyxy[1]):int(xyxy[3]), int(xyxy[0]):int(xyxy[2])] = 255
+        np.random.seed(i)
+        out, box = h._augment_img(mask, np.copy(true_box[0:1]), True)
+        ys, xs = np.nonzero(out[..., 0] > 127)
+        if len(box) == 0 or len(xs) == 0:
+            continue
+        pix = np.array([xs.min(), ys.min(), xs.max() + 1, ys.max() + 1])
+        max_diff = max(max_diff, np.max(np.abs(pix - h.center_to_corner(box[:, 1:])[0])))
+    print(INFO, f'fused box max diff to the warped pixels {max_diff:.2f} pixel')
+    if max_diff > args.tolerance:
+        print(ERROR, f'fused box diff over tolerance {args.tolerance}')
+        sys.exit(1)
+
+    def two_stage():
+        im, box = h._resize_img(img, np.copy(true_box))
+        return h.data_augmenter(im, box)
+
+    two_t = timeit(two_stage, args.repeat)
+    fused_t = timeit(lambda: h._augment_img(img, np.copy(true_box), True), args.repeat)
+    print(INFO, f'image {args.img_hw} -> {list(h.in_hw[0])}')
+    print(INFO, f'two stage : {1 / two_t:10.1f} img/s')
+    print(INFO, f'fused     : {1 / fused_t:10.1f} img/s ({two_t / fused_t:.1f}x)')
+
+    """ in the dataset, py_function augmenter vs graph augmenter in parallel map """
+    source = tf.data.Dataset.from_tensors((img, true_box.astype('float32'))).repeat()
+
+    def py_augment(im, box):
+        im, box = tf.py_function(lambda im, box: h._augment_img(im.numpy(), box.numpy(), True), [im, box], [tf.uint8, tf.float32])
+        return im, box
+
+    for name, fn in [('py fused', py_augment), ('graph', lambda im, box: h._tf_augment_img(im, box, True))]:
+        dataset = source.map(fn, tf.data.experimental.AUTOTUNE).map(lambda im, box: im).batch(args.batch_size)
+        print(INFO, f'dataset {name:8s}: {dataset_speed(dataset, args.batch_size, args.step):10.1f} img/s')
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='bench')
+    sub.required = True
+
+    def add_common(p: argparse.ArgumentParser):
+        p.add_argument('--class_num', type=int, help='class num', default=20)
+        p.add_argument('--anchors', type=str, help='anchor file, default use linspace anchors', default=None)
+        p.add_argument('--anchor_num', type=int, help='single layer anchor nums', default=3)
+        p.add_argument('--in_hw', type=int, help='net work input image size', default=(224, 320), nargs='+')
+        p.add_argument('--out_hw', type=int, help='net work output image size', default=(7, 10, 14, 20), nargs='+')
+        p.add_argument('--batch_size', type=int, help='batch size', default=64)
+        p.add_argument('--rand_seed', type=int, help='random seed', default=6)
+        p.add_argument('--repeat', type=int, help='repeat times', default=20)
+
+    p = sub.add_parser('label', help='Helper.box_to_label loop vs Helper.box_to_label_batch vs tf_batch_box_to_label')
+    add_common(p)
+    p.add_argument('--max_box', type=int, help='max box num per image', default=40)
+    p.set_defaults(func=bench_label)
+
+    p = sub.add_parser('ignore', help='per-image loop vs batch-vectorized chunked calc_ignore_mask')
+    add_common(p)
+    p.add_argument('--batch_sizes', type=int, help='batch sizes to compare', default=(16, 64, 128), nargs='+')
+    p.add_argument('--max_box', type=int, help='max box num per image', default=40)
+    p.add_argument('--obj_thresh', type=float, help='obj mask thresh', default=0.7)
+    p.add_argument('--iou_thresh', type=float, help='iou mask thresh', default=0.5)
+    p.add_argument('--box_chunk', type=int, help='true box number of one iou loop', default=16)
+    p.set_defaults(func=bench_ignore)
+
+    p = sub.add_parser('loss', help='per layer vs fused loss function, dense vs sparse positive cells')
+    add_common(p)
+    p.add_argument('--max_box', type=int, help='max box num per image', default=40)
+    p.add_argument('--obj_thresh', type=float, help='obj mask thresh', default=0.7)
+    p.add_argument('--iou_thresh', type=float, help='iou mask thresh', default=0.5)
+    p.add_argument('--obj_weight', type=float, help='obj loss weight', default=5.0)
+    p.add_argument('--noobj_weight', type=float, help='noobj loss weight', default=0.5)
+    p.add_argument('--wh_weight', type=float, help='wh loss weight', default=0.5)
+    p.set_defaults(func=bench_loss)
+
+    p = sub.add_parser('train', help='keras Model.fit vs tf.function custom trainer step time on a tiny model')
+    add_common(p)
+    p.add_argument('--max_box', type=int, help='max box num per image', default=40)
+    p.add_argument('--warmup', type=int, help='warm up step num', default=5)
+    p.add_argument('--step', type=int, help='step num for speed test', default=50)
+    p.set_defaults(func=bench_train)
+
+    p = sub.add_parser('parser', help='py parser vs native parser')
+    add_common(p)
+    p.add_argument('image_ann', type=str, help='annotation npy file, such as data/voc_img_ann.npy')
+    p.add_argument('--check_num', type=int, help='number of image to check', default=50)
+    p.add_argument('--tolerance', type=float, help='max pixel diff', default=2.)
+    p.add_argument('--step', type=int, help='batch num for speed test', default=20)
+    p.set_defaults(func=bench_parser)
+
+    p = sub.add_parser('dtype', help='float32 vs uint8 image transport')
+    add_common(p)
+    p.add_argument('image_ann', type=str, help='annotation npy file, such as data/voc_img_ann.npy')
+    p.add_argument('--step', type=int, help='batch num for speed test', default=20)
+    p.set_defaults(func=bench_dtype)
+
+    p = sub.add_parser('letterbox', help='skimage warp vs Helper._resize_img')
+    add_common(p)
+    p.add_argument('--img_hw', type=int, help='source image size', default=(1080, 1920), nargs=2)
+    p.set_defaults(func=bench_letterbox)
+
+    p = sub.add_parser('shuffle', help='streaming shuffle quality and memory')
+    add_common(p)
+    p.add_argument('--data_dir', type=str, help='synthetic dataset dir, generate when not exists', default='/tmp/yolo_shuffle_data')
+    p.add_argument('--num', type=int, help='synthetic image num', default=2000)
+    p.add_argument('--epochs', type=int, help='epoch num', default=3)
+    p.add_argument('--shuffle_buffer', type=int, help='decoded sample buffer size', default=256)
+    p.set_defaults(func=bench_shuffle)
+
+    p = sub.add_parser('feed', help='from_generator vs ragged tensor annotation feeding')
+    add_common(p)
+    p.add_argument('--num', type=int, help='annotation num', default=10000)
+    p.add_argument('--max_box', type=int, help='max box num per image', default=40)
+    p.add_argument('--check_num', type=int, help='number of annotation to check', default=50)
+    p.add_argument('--step', type=int, help='batch num for speed test', default=200)
+    p.set_defaults(func=bench_feed)
+
+    p = sub.add_parser('decode', help='full vs reduced resolution jpeg decode')
+    add_common(p)
+    p.add_argument('--img_hw', type=int, help='source image size', default=(3000, 4000), nargs=2)
+    p.set_defaults(func=bench_decode)
+
+    p = sub.add_parser('augment', help='letterbox + imgaug two stage vs fused affine augment vs graph augment')
+    add_common(p)
+    p.add_argument('--img_hw', type=int, help='source image size', default=(1080, 1920), nargs=2)
+    p.add_argument('--check_num', type=int, help='random augment number to check the box', default=50)
+    p.add_argument('--tolerance', type=float, help='max box diff in pixel', default=2.)
+    p.add_argument('--step', type=int, help='batch num for dataset speed', default=10)
+    p.set_defaults(func=bench_augment)
+
+    p = sub.add_parser('suite', help='data loader benchmark suite on a synthetic dataset, save JSON and check regression')
+    add_common(p)
+    p.add_argument('--data_dir', type=str, help='synthetic dataset dir, generate when not exists', default='/tmp/yolo_bench_data')
+    p.add_argument('--num', type=int, help='synthetic image num', default=512)
+    p.add_argument('--img_hw', type=int, help='synthetic image sizes, h w h w ...', default=(480, 640, 720, 1280), nargs='+')
+    p.add_argument('--max_box', type=int, help='max box num per image', default=10)
+    p.add_argument('--stage_num', type=int, help='image num for the stage and generator speed', default=64)
+    p.add_argument('--batch_sizes', type=int, help='batch sizes for the dataset speed', default=(8, 16, 32, 64), nargs='+')
+    p.add_argument('--step', type=int, help='batch num for dataset speed', default=10)
+    p.add_argument('--output', type=str, help='result JSON file', default='bench_results.json')
+    p.add_argument('--baseline', type=str, help='baseline result JSON file to compare', default=None)
+    p.add_argument('--threshold', type=float, help='slow down ratio flagged as regression', default=0.1)
+    p.set_defaults(func=bench_suite)
+
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    tf.enable_eager_execution()
+    args = parse_arguments(sys.argv[1:])
+    args.func(args)
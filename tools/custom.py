@@ -6,6 +6,7 @@ from tensorflow.python.keras.utils import metrics_utils
 from tensorflow.python.keras.metrics import Metric
 from tensorflow.python.keras import backend as K
 from tensorflow.python.ops import state_ops
+from tensorflow.python.ops import control_flow_ops
 from tensorflow.python.ops.resource_variable_ops import ResourceVariable
 import numpy as np
 
@@ -42,6 +43,11 @@ class Yolo_Precision(Metric):
     def result(self):
         return math_ops.div_no_nan(self.true_positives, (math_ops.add(self.true_positives, self.false_positives)))
 
+    def get_config(self):
+        config = {'thresholds': self.init_thresholds}
+        base_config = super().get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
 
 class Yolo_Recall(Metric):
     def __init__(self, thresholds=None, name=None, dtype=None):
@@ -73,3 +79,22 @@ class Yolo_Recall(Metric):
 
     def result(self):
         return math_ops.div_no_nan(self.true_positives, (math_ops.add(self.true_positives, self.false_negatives)))
+
+    def get_config(self):
+        config = {'thresholds': self.init_thresholds}
+        base_config = super().get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+class Yolo_LossTerm(keras.metrics.Mean):
+    def __init__(self, name=None, dtype=None):
+        """ the mean of one loss term, the loss function update it by `update_term` when it compute the term,
+            so the term is not computed again for the metric. keras `update_state` do nothing.
+        """
+        super(Yolo_LossTerm, self).__init__(name=name, dtype=dtype)
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        return control_flow_ops.no_op()
+
+    def update_term(self, value):
+        return super(Yolo_LossTerm, self).update_state(value)
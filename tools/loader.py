@@ -0,0 +1,166 @@
+import numpy as np
+import multiprocessing as mp
+import queue
+import traceback
+import cv2
+import imgaug as ia
+
+
+def _shared_array(ctx, shape: tuple) -> np.ndarray:
+    """ float32 array in shared memory, the forked workers write it in place """
+    buf = ctx.RawArray('f', int(np.prod(shape)))
+    return np.frombuffer(buf, np.float32).reshape(shape)
+
+
+def _worker(h, ann_list: np.ndarray, is_training: bool, is_resize: bool, rand_seed: int,
+            img: np.ndarray, labels: list, task_q: mp.Queue, done_q: mp.Queue):
+    """ read -> `_process_img` -> `box_to_label` , write result into the shared slot """
+    # NOTE avoid cv2 thread pool oversubscription in every worker
+    cv2.setNumThreads(1)
+    while True:
+        task = task_q.get()
+        if task is None:
+            break
+        generation, seq, slot, epoch, i = task
+        try:
+            # NOTE the random state only depend on (seed, epoch, index), so the result is deterministic
+            np.random.seed([rand_seed, epoch, i])
+            # NOTE the forked workers inherit the same imgaug random state, reseed it from the sample seed
+            ia.seed(np.random.randint(2**31))
+            img_path, true_box, _ = ann_list[i]
+            im, true_box = h._process_img(h._read_img(img_path), np.copy(true_box), is_training, is_resize)
+            img[slot] = im
+            h.box_to_label_batch(true_box[np.newaxis, ...], np.array([len(true_box)]),
+                                 [label[slot:slot + 1] for label in labels])
+            done_q.put((generation, seq, slot, None))
+        except Exception:
+            done_q.put((generation, seq, slot, traceback.format_exc()))
+
+
+class ProcessLoader(object):
+    def __init__(self, h, ann_list: np.ndarray, is_training: bool, is_resize: bool, rand_seed: int,
+                 num_workers: int, shuffle=True, epochs=None, slot_num=None):
+        """ multi-process sample loader, the workers return [image, labels] by shared memory slots,
+            so the parent never pickle the large float array.
+
+            NOTE the samples order only depend on `rand_seed`, every `iter()` restart from epoch 0,
+            only one iterator can be used at the same time.
+
+        Parameters
+        ----------
+        h : Helper
+
+        ann_list : np.ndarray
+            annotation list, value = [n*[image path, box, image shape]]
+        is_training : bool
+            wether to use data augmenter
+        is_resize : bool
+            wether to resize the image
+        rand_seed : int
+            random seed of the sample order and the worker random state
+        num_workers : int
+            worker process number
+        shuffle : bool
+            shuffle the sample order every epoch
+        epochs : int
+            epoch number, None for infinite
+        slot_num : int
+            shared memory slot number, default `num_workers * 4`
+        """
+        self.ann_list = ann_list
+        self.rand_seed = rand_seed
+        self.shuffle = shuffle
+        self.epochs = epochs
+        self.slot_num = slot_num if slot_num else num_workers * 4
+
+        ctx = mp.get_context('fork')
+        self.img = _shared_array(ctx, (self.slot_num, h.in_hw[0][0], h.in_hw[0][1], 3))
+        self.labels = [_shared_array(ctx, (self.slot_num, h.out_hw[i][0], h.out_hw[i][1], len(h.anchors[i]), 5 + h.class_num))
+                       for i in range(h.output_number)]
+        self.task_q = ctx.Queue()
+        self.done_q = ctx.Queue()
+        self.workers = [ctx.Process(target=_worker, daemon=True,
+                                    args=(h, ann_list, is_training, is_resize, rand_seed,
+                                          self.img, self.labels, self.task_q, self.done_q))
+                        for _ in range(num_workers)]
+        for w in self.workers:
+            w.start()
+        self.generation = 0
+        self.pending = set()  # the slots submitted but not received
+
+    def __len__(self) -> int:
+        return len(self.ann_list)
+
+    def _tasks(self):
+        epoch = 0
+        while self.epochs is None or epoch < self.epochs:
+            if self.shuffle:
+                order = np.random.RandomState(self.rand_seed + epoch).permutation(len(self.ann_list))
+            else:
+                order = np.arange(len(self.ann_list))
+            for i in order:
+                yield epoch, i
+            epoch += 1
+
+    def _get_done(self) -> tuple:
+        while True:
+            try:
+                generation, seq, slot, err = self.done_q.get(timeout=1.)
+            except queue.Empty:
+                if not all([w.is_alive() for w in self.workers]):
+                    raise RuntimeError('loader worker exit unexpectedly')
+                continue
+            self.pending.discard(slot)
+            if err is not None:
+                raise RuntimeError(f'loader worker error:\n{err}')
+            return generation, seq, slot
+
+    def __iter__(self):
+        self.generation += 1
+        generation = self.generation
+        tasks = self._tasks()
+        # NOTE the slots of the last iterator may still in the workers
+        free = [slot for slot in range(self.slot_num) if slot not in self.pending]
+        while not free:
+            free.append(self._get_done()[2])
+        done = {}
+        submit_seq, yield_seq = 0, 0
+
+        def submit():
+            nonlocal submit_seq
+            while free:
+                task = next(tasks, None)
+                if task is None:
+                    return
+                slot = free.pop()
+                self.pending.add(slot)
+                self.task_q.put((generation, submit_seq, slot) + task)
+                submit_seq += 1
+
+        submit()
+        while yield_seq < submit_seq:
+            while yield_seq not in done:
+                g, seq, slot = self._get_done()
+                if g != generation:
+                    free.append(slot)
+                    submit()
+                else:
+                    done[seq] = slot
+            slot = done.pop(yield_seq)
+            yield_seq += 1
+            item = (np.copy(self.img[slot]), tuple([np.copy(label[slot]) for label in self.labels]))
+            free.append(slot)
+            submit()
+            yield item
+
+    def close(self):
+        for _ in self.workers:
+            self.task_q.put(None)
+        for w in self.workers:
+            w.join(1.)
+            if w.is_alive():
+                w.terminate()
+        self.workers = []
+
+    def __del__(self):
+        self.close()
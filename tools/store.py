@@ -0,0 +1,187 @@
+import numpy as np
+import os
+
+
+class ImageStore(object):
+    def __init__(self, prefix: str):
+        """ memory-mapped uint8 images with the boxes, the files are :
+
+            {prefix}_img.npy     : uint8 image, shape = [n, h, w, 3]
+            {prefix}_box.npy     : float32 boxes of all image, shape = [total box num, 5]
+            {prefix}_box_idx.npy : int64 box offset of every image, shape = [n + 1]
+
+        Parameters
+        ----------
+        prefix : str
+            store file prefix
+        """
+        self.img = np.load(prefix + '_img.npy', mmap_mode='r')  # type:np.memmap
+        self.box = np.load(prefix + '_box.npy', mmap_mode='r')  # type:np.memmap
+        self.box_idx = np.load(prefix + '_box_idx.npy')  # type:np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.img)
+
+    def __getitem__(self, i: int) -> [np.ndarray, np.ndarray]:
+        """ get [image, box], NOTE the image is read only memmap, the box is a copy """
+        return self.img[i], np.array(self.box[self.box_idx[i]:self.box_idx[i + 1]])
+
+    @staticmethod
+    def files(prefix: str) -> list:
+        return [prefix + '_img.npy', prefix + '_box.npy', prefix + '_box_idx.npy']
+
+    @staticmethod
+    def exists(prefix: str) -> bool:
+        return all([os.path.exists(f) for f in ImageStore.files(prefix)])
+
+    @staticmethod
+    def build(prefix: str, num: int, hw: tuple, fn, verbose=True) -> 'ImageStore':
+        """ build the store, write into temp files and rename when finish, so a broken build never be loaded
+
+        Parameters
+        ----------
+        prefix : str
+            store file prefix
+        num : int
+            image number
+        hw : tuple
+            image [h, w]
+        fn : function
+            fn(i) return [uint8 image shape = [h, w, 3], box shape = [?, 5]]
+
+        Returns
+        -------
+        ImageStore
+        """
+        img_f, box_f, box_idx_f = ImageStore.files(prefix)
+        img = np.lib.format.open_memmap(img_f + '.tmp', 'w+', np.uint8, (num, hw[0], hw[1], 3))
+        boxes = []
+        box_idx = np.zeros(num + 1, np.int64)
+        for i in range(num):
+            img[i], box = fn(i)
+            boxes.append(np.reshape(box, (-1, 5)).astype('float32'))
+            box_idx[i + 1] = box_idx[i] + len(boxes[-1])
+            if verbose and (i + 1) % 1000 == 0:
+                print(f'\r{i + 1}/{num}', end='', flush=True)
+        if verbose:
+            print(f'\r{num}/{num}')
+        img.flush()
+        del img
+        np.save(box_f + '.tmp.npy', np.vstack(boxes) if num > 0 else np.zeros((0, 5), np.float32))
+        np.save(box_idx_f + '.tmp.npy', box_idx)
+        os.replace(box_f + '.tmp.npy', box_f)
+        os.replace(box_idx_f + '.tmp.npy', box_idx_f)
+        os.replace(img_f + '.tmp', img_f)
+        return ImageStore(prefix)
+
+
+class AnnStore(object):
+    def __init__(self, prefix: str, index: np.ndarray = None):
+        """ columnar memory-mapped annotation list, replace the pickled `[path, box, shape]` object array, the files are :
+
+            {prefix}_path.npy    : uint8 utf-8 bytes of all image path, shape = [total path bytes]
+            {prefix}_path_idx.npy : int64 path byte offset of every image, shape = [n + 1]
+            {prefix}_box.npy     : float32 boxes of all image, shape = [total box num, 5]
+            {prefix}_box_idx.npy : int64 box offset of every image, shape = [n + 1]
+            {prefix}_shape.npy   : int32 image [h, w], shape = [n, 2]
+
+            index the store with array or slice get a sub store view, iterate or index it with int get
+            `[path, box, shape]` same as the object array row.
+
+        Parameters
+        ----------
+        prefix : str
+            store file prefix
+        index : np.ndarray
+            the rows of the view, None for all rows
+        """
+        self.prefix = prefix
+        self.path = np.load(prefix + '_path.npy', mmap_mode='r')  # type:np.memmap
+        self.path_idx = np.load(prefix + '_path_idx.npy', mmap_mode='r')  # type:np.memmap
+        self.box = np.load(prefix + '_box.npy', mmap_mode='r')  # type:np.memmap
+        self.box_idx = np.load(prefix + '_box_idx.npy', mmap_mode='r')  # type:np.memmap
+        self.shape = np.load(prefix + '_shape.npy', mmap_mode='r')  # type:np.memmap
+        self.index = np.arange(len(self.path_idx) - 1) if index is None else np.asarray(index, np.int64)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, i):
+        if isinstance(i, (int, np.integer)):
+            j = self.index[i]
+            return [self.path[self.path_idx[j]:self.path_idx[j + 1]].tobytes().decode(), np.array(self.box[self.box_idx[j]:self.box_idx[j + 1]]), np.array(self.shape[j])]
+        return AnnStore(self.prefix, self.index[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getstate__(self) -> dict:
+        # NOTE the worker processes reopen the memmap, only pickle the prefix and the view index
+        return {'prefix': self.prefix, 'index': self.index}
+
+    def __setstate__(self, state: dict):
+        self.__init__(state['prefix'], state['index'])
+
+    def boxes(self) -> [np.ndarray, np.ndarray]:
+        """ all the boxes of the view and the image shape of every box
+
+        Returns
+        -------
+        [np.ndarray, np.ndarray]
+            box shape = [total box num, 5] , image [h, w] shape = [total box num, 2]
+        """
+        start, end = self.box_idx[self.index], self.box_idx[self.index + 1]
+        rows = np.concatenate([np.arange(s, e) for s, e in zip(start, end)]) if len(self.index) > 0 else np.zeros(0, np.int64)
+        return np.array(self.box[rows]), np.repeat(np.array(self.shape[self.index]), end - start, axis=0)
+
+    def paths(self) -> [bytes, np.ndarray, np.ndarray]:
+        """ the utf-8 bytes of all path and the byte range of every path in the view, no python str per path
+
+        Returns
+        -------
+        [bytes, np.ndarray, np.ndarray]
+            path bytes , start shape = [n] , length shape = [n]
+        """
+        start, end = self.path_idx[self.index], self.path_idx[self.index + 1]
+        return self.path.tobytes(), np.array(start), np.array(end - start)
+
+    @staticmethod
+    def files(prefix: str) -> list:
+        return [prefix + '_path.npy', prefix + '_box.npy', prefix + '_box_idx.npy', prefix + '_shape.npy', prefix + '_path_idx.npy']
+
+    @staticmethod
+    def exists(prefix: str) -> bool:
+        return all([os.path.exists(f) for f in AnnStore.files(prefix)])
+
+    @staticmethod
+    def build(prefix: str, ann_list: np.ndarray) -> 'AnnStore':
+        """ build the store from the annotation list, write into temp files and rename when finish
+
+        Parameters
+        ----------
+        prefix : str
+            store file prefix
+        ann_list : np.ndarray
+            annotation list, value = [n*[image path, box, image shape]]
+
+        Returns
+        -------
+        AnnStore
+        """
+        boxes = [np.reshape(box, (-1, 5)).astype('float32') for _, box, _ in ann_list]
+        box_idx = np.zeros(len(ann_list) + 1, np.int64)
+        box_idx[1:] = np.cumsum([len(box) for box in boxes])
+        paths = [str(path).encode() for path, _, _ in ann_list]
+        path_idx = np.zeros(len(ann_list) + 1, np.int64)
+        path_idx[1:] = np.cumsum([len(path) for path in paths])
+        columns = [np.frombuffer(b''.join(paths), np.uint8),
+                   np.vstack(boxes) if len(boxes) > 0 else np.zeros((0, 5), np.float32),
+                   box_idx,
+                   np.array([shape for _, _, shape in ann_list], np.int32).reshape((-1, 2)),
+                   path_idx]
+        for f, column in zip(AnnStore.files(prefix), columns):
+            np.save(f + '.tmp.npy', column)
+        for f in AnnStore.files(prefix):
+            os.replace(f + '.tmp.npy', f)
+        return AnnStore(prefix)
@@ -0,0 +1,160 @@
+import tensorflow.python as tf
+from tensorflow.python import keras
+from tensorflow.python.keras.callbacks import CallbackList
+from tensorflow.python.keras.utils import Progbar
+import time
+from tools.utils import INFO
+
+
+class Trainer(object):
+    def __init__(self, model: keras.Model, optimizer: keras.optimizers.Optimizer, loss, metrics: list, callbacks: list = None,
+                 label_fn=None):
+        """ custom training loop, the train step and the test step are compiled by `tf.function`,
+            the dataset is iterated explicitly. it is an alternative of `keras.Model.fit` with the same
+            losses, metrics and callbacks, the python overhead per step is one function call.
+
+            NOTE when the loss function have `metrics` (see `create_fused_loss_fn`), the loss terms are logged
+
+        Parameters
+        ----------
+        model : keras.Model
+            train model
+        optimizer : keras.optimizers.Optimizer
+
+        loss : function or list
+            loss function (y_true, y_pred) of the single output, or the list of the loss function of every output
+        metrics : list
+            keras `Metric` list, such as `Yolo_Precision`. same as `keras.Model.compile`, when the model have
+            many outputs, every output use its own copy named `<output name>_<metric name>`
+        callbacks : list
+            keras callback list, such as `TensorBoard`, `sparsity.UpdatePruningStep`
+        label_fn : function
+            build the labels from the dataset labels in the compiled step, such as `tf_batch_box_to_label`
+            for the dataset element (img, true_box, box_num), so the dense labels never cross the input pipeline
+        """
+        self.model = model
+        self.optimizer = optimizer
+        # NOTE the callbacks read `model.optimizer`, such as `sparsity.UpdatePruningStep`
+        self.model.optimizer = optimizer
+        self.loss = loss if isinstance(loss, list) else [loss]
+        if len(model.outputs) == 1:
+            self.metrics = [metrics]
+        else:
+            self.metrics = [[metric.__class__.from_config(dict(metric.get_config(), name=f'{name}_{metric.name}'))
+                             for metric in metrics] for name in model.output_names]
+        # NOTE the loss function update its term metrics
+        self.term_metrics = sum([getattr(fn, 'metrics', []) for fn in self.loss], [])
+        self.loss_metric = keras.metrics.Mean('loss')
+        self.label_fn = label_fn
+        self.callbacks = CallbackList(callbacks if callbacks else [])
+        self.callbacks.set_model(model)
+        self.model.stop_training = False
+        self.train_step = tf.function(self._train_step)
+        self.test_step = tf.function(self._test_step)
+
+    def _calc_loss(self, labels, outputs) -> tf.Tensor:
+        """ the total loss of all outputs, update the metrics """
+        if self.label_fn is not None:
+            labels = self.label_fn(*labels)
+        outputs = outputs if isinstance(outputs, list) else [outputs]
+        labels = list(labels) if isinstance(labels, (list, tuple)) else [labels]
+        loss = tf.add_n([fn(y_true, y_pred) for fn, y_true, y_pred in zip(self.loss, labels, outputs)])
+        if self.model.losses:
+            loss += tf.add_n(self.model.losses)
+        for output_metrics, y_true, y_pred in zip(self.metrics, labels, outputs):
+            for metric in output_metrics:
+                metric.update_state(y_true, y_pred)
+        self.loss_metric.update_state(loss)
+        return loss
+
+    def _train_step(self, img: tf.Tensor, labels) -> tf.Tensor:
+        with tf.GradientTape() as tape:
+            loss = self._calc_loss(labels, self.model(img, training=True))
+        grads = tape.gradient(loss, self.model.trainable_variables)
+        self.optimizer.apply_gradients(zip(grads, self.model.trainable_variables))
+        return loss
+
+    def _test_step(self, img: tf.Tensor, labels) -> tf.Tensor:
+        return self._calc_loss(labels, self.model(img, training=False))
+
+    def _split(self, element: tuple) -> tuple:
+        """ the dataset element to (img, labels) """
+        if self.label_fn is not None:
+            return element[0], tuple(element[1:])
+        return element
+
+    def _all_metrics(self) -> list:
+        return [self.loss_metric] + sum(self.metrics, []) + self.term_metrics
+
+    def _logs(self, prefix: str = '') -> dict:
+        return {prefix + metric.name: float(metric.result().numpy()) for metric in self._all_metrics()}
+
+    def _reset(self):
+        for metric in self._all_metrics():
+            metric.reset_states()
+
+    def fit(self, dataset: tf.data.Dataset, epochs: int, steps_per_epoch: int,
+            validation_data: tf.data.Dataset = None, validation_steps: int = None, log_freq: int = 10) -> list:
+        """ train the model, same as `keras.Model.fit` with the repeated dataset
+
+        Parameters
+        ----------
+        dataset : tf.data.Dataset
+            repeated train dataset, element = (img, labels), or (img, *inputs of `label_fn`)
+        epochs : int
+
+        steps_per_epoch : int
+
+        validation_data : tf.data.Dataset
+            repeated test dataset, evaluate at every epoch end
+        validation_steps : int
+
+        log_freq : int
+            read the metrics every `log_freq` steps and at the epoch end,
+            NOTE read the metric value will wait the device, so don't read it every step
+
+        Returns
+        -------
+        list
+            the epoch logs
+        """
+        names = [metric.name for metric in self._all_metrics()]
+        self.callbacks.set_params({'epochs': epochs, 'steps': steps_per_epoch, 'verbose': 1,
+                                   'do_validation': validation_data is not None,
+                                   'metrics': names + ['val_' + name for name in names]})
+        train_it = iter(dataset)
+        test_it = iter(validation_data) if validation_data is not None else None
+        history = []
+        self.callbacks.on_train_begin()
+        for epoch in range(epochs):
+            print(f'Epoch {epoch + 1}/{epochs}')
+            self._reset()
+            self.callbacks.on_epoch_begin(epoch)
+            progbar = Progbar(steps_per_epoch, stateful_metrics=names)
+            start = time.perf_counter()
+            for step in range(steps_per_epoch):
+                img, labels = self._split(next(train_it))
+                batch_logs = {'batch': step, 'size': int(img.shape[0])}
+                self.callbacks.on_train_batch_begin(step, batch_logs)
+                self.train_step(img, labels)
+                if (step + 1) % log_freq == 0 or step + 1 == steps_per_epoch:
+                    batch_logs.update(self._logs())
+                    progbar.update(step + 1, [(name, batch_logs[name]) for name in names])
+                self.callbacks.on_train_batch_end(step, batch_logs)
+                if self.model.stop_training:
+                    break
+            epoch_logs = self._logs()
+            step_time = (time.perf_counter() - start) / (step + 1)
+
+            if test_it is not None:
+                self._reset()
+                for _ in range(validation_steps):
+                    self.test_step(*self._split(next(test_it)))
+                epoch_logs.update(self._logs('val_'))
+            print(INFO, ' '.join([f'{k} {v:.4f}' for k, v in epoch_logs.items()]) + f' {step_time * 1000:.1f} ms/step')
+            self.callbacks.on_epoch_end(epoch, epoch_logs)
+            history.append(epoch_logs)
+            if self.model.stop_training:
+                break
+        self.callbacks.on_train_end()
+        return history
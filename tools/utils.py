@@ -9,8 +9,26 @@ from math import cos, sin
 from imgaug import augmenters as iaa
 import imgaug as ia
 from tensorflow import py_function
+from tensorflow.python.ops.io_ops import read_file
+from tensorflow.python.ops.parsing_ops import parse_single_example, FixedLenFeature, VarLenFeature
+from tensorflow.python.ops.sparse_ops import sparse_tensor_to_dense
+from tensorflow.contrib.image import transform as image_transform
 import pickle
+from PIL import Image
+import hashlib
+import glob
+import json
+import time
+import threading
+import contextlib
+import multiprocessing as mp
 from termcolor import colored
+from tensorflow.python.keras.callbacks import Callback
+from tensorflow.python.ops import summary_ops_v2
+from tensorflow.python.util import nest
+from tools.store import ImageStore, AnnStore
+from tools.loader import ProcessLoader
+from tools.custom import Yolo_LossTerm
 
 INFO = colored('[ INFO  ]', 'blue')
 ERROR = colored('[ ERROR ]', 'red')
@@ -50,22 +68,219 @@ def write_arguments_to_file(args, filename):
             f.write('%s: %s\n' % (key, str(value)))
 
 
+_bank_helper = None  # type:tuple
+
+
+def _bank_init(h, index: np.ndarray, rand_seed: int):
+    """ the augmentation bank build worker keep the forked Helper """
+    global _bank_helper
+    cv2.setNumThreads(1)
+    _bank_helper = (h, index, rand_seed)
+
+
+def _bank_fn(j: int) -> [np.ndarray, np.ndarray]:
+    h, index, rand_seed = _bank_helper
+    return h._bank_sample(j, index, rand_seed)
+
+
+class StageTimer(object):
+    def __init__(self, edges: np.ndarray = np.logspace(-2, 4, 61)):
+        """ thread safe per-stage counter and latency histogram of the data pipeline,
+            the `py_function` parsers run in many threads.
+
+            pipeline stages : 'read' , 'process' , 'label' ( py parser only , native parser is graph ops )
+            'batch' : the interval between two batches the pipeline produce
+            'step' : the model step time, record by `StageTimerCallback`
+
+        Parameters
+        ----------
+        edges : np.ndarray
+            histogram bin edges (ms), default 0.01ms ~ 10s
+        """
+        self.edges = edges
+        self.lock = threading.Lock()
+        self.count = {}  # type:dict
+        self.total = {}  # type:dict
+        self.hist = {}  # type:dict
+        self.produced = {}  # type:dict
+        self.last_batch = {}  # type:dict
+        self.consumed = 0
+        self.occupancy = []  # type:list
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float):
+        i = np.searchsorted(self.edges, seconds * 1000.)
+        with self.lock:
+            if name not in self.count:
+                self.count[name] = 0
+                self.total[name] = 0.
+                self.hist[name] = np.zeros(len(self.edges) + 1, np.int64)
+            self.count[name] += 1
+            self.total[name] += seconds
+            self.hist[name][i] += 1
+
+    def mark_batch(self, tag: str) -> int:
+        """ the pipeline produce one batch of `tag` dataset, return the produced num """
+        now = time.perf_counter()
+        with self.lock:
+            self.produced[tag] = self.produced.get(tag, 0) + 1
+            last, self.last_batch[tag] = self.last_batch.get(tag), now
+            num = self.produced[tag]
+        if last is not None and tag == 'train':
+            self.record('batch', now - last)
+        return num
+
+    def mark_consume(self):
+        """ the model finish one train step, record how many batches are ready before the next fetch
+
+            NOTE don't sample at the step begin, `keras.Model.fit` and `Trainer.fit` already fetch the batch there
+        """
+        with self.lock:
+            self.consumed += 1
+            self.occupancy.append(self.produced.get('train', 0) - self.consumed)
+
+    def percentile(self, name: str, q: float) -> float:
+        """ the approximate percentile (ms) from the histogram, use the bin upper edge """
+        cum = np.cumsum(self.hist[name])
+        i = min(np.searchsorted(cum, cum[-1] * q / 100.), len(self.edges) - 1)
+        return float(self.edges[i])
+
+    def summary(self) -> dict:
+        """ per-stage statistics and the verdict
+
+            the model ask the next batch when the pipeline have no ready batch ( occupancy <= 0 ), the model wait the input.
+            when most steps wait the input, the run is input-bound, otherwise is compute-bound.
+        """
+        with self.lock:
+            stages = {name: {'count': self.count[name],
+                             'total_s': self.total[name],
+                             'mean_ms': self.total[name] / self.count[name] * 1000.,
+                             'p50_ms': self.percentile(name, 50),
+                             'p90_ms': self.percentile(name, 90),
+                             'p99_ms': self.percentile(name, 99)} for name in self.count}
+            occupancy = np.array(self.occupancy)
+        result = {'stages': stages}
+        if len(occupancy) > 0:
+            wait = float(np.mean(occupancy <= 0))
+            result['input_wait_ratio'] = wait
+            result['mean_ready_batches'] = float(np.mean(occupancy))
+            result['verdict'] = 'input-bound' if wait > 0.5 else 'compute-bound'
+        return result
+
+
+class StageTimerCallback(Callback):
+    def __init__(self, timer: StageTimer, log_dir: str, period=100):
+        """ record the model step time, write the `StageTimer` to TensorBoard and `{log_dir}/pipeline.json` every `period` steps
+
+        Parameters
+        ----------
+        timer : StageTimer
+
+        log_dir : str
+
+        period : int
+            write period (steps)
+        """
+        super().__init__()
+        self.timer = timer
+        self.log_dir = log_dir
+        self.period = period
+        self.step = 0
+        self.writer = summary_ops_v2.create_file_writer(os.path.join(log_dir, 'pipeline'))
+        self.last_hist = {}  # type:dict
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.timer.record('step', time.perf_counter() - self.start)
+        self.timer.mark_consume()
+        self.step += 1
+        if self.step % self.period == 0:
+            self.write()
+
+    def on_train_end(self, logs=None):
+        self.write()
+        result = self.timer.summary()
+        if 'verdict' in result:
+            print(INFO, f'pipeline input wait ratio {result["input_wait_ratio"]:.2f}, the run is {result["verdict"]}')
+
+    def write(self):
+        result = self.timer.summary()
+        with open(os.path.join(self.log_dir, 'pipeline.json'), 'w') as f:
+            json.dump(result, f, indent=2)
+        centers = np.concatenate([[self.timer.edges[0]], np.sqrt(self.timer.edges[1:] * self.timer.edges[:-1]), [self.timer.edges[-1]]])
+        with self.writer.as_default(), summary_ops_v2.always_record_summaries():
+            for name, stat in result['stages'].items():
+                summary_ops_v2.scalar(f'pipeline/{name}_mean_ms', stat['mean_ms'], step=self.step)
+                # NOTE only write the new records since last write
+                hist = np.copy(self.timer.hist[name])
+                delta = hist - self.last_hist.get(name, 0)
+                self.last_hist[name] = hist
+                if np.sum(delta) > 0:
+                    summary_ops_v2.histogram(f'pipeline/{name}_ms', np.repeat(centers, delta), step=self.step)
+            if 'verdict' in result:
+                summary_ops_v2.scalar('pipeline/input_wait_ratio', result['input_wait_ratio'], step=self.step)
+        self.writer.flush()
+
+
 class Helper(object):
-    def __init__(self, image_ann: str, class_num: int, anchors: str, in_hw: tuple, out_hw: tuple, validation_split=0.1):
+    def __init__(self, image_ann: str, class_num: int, anchors: str, in_hw: tuple, out_hw: tuple, validation_split=0.1,
+                 interpolation='bilinear', reduce_decode=False, augment_mode='none', split_seed=None):
         self.in_hw = np.array(in_hw)
         assert self.in_hw.ndim == 2
         self.out_hw = np.array(out_hw)
         assert self.out_hw.ndim == 2
         self.validation_split = validation_split  # type:float
+        self.interp_method = {'nearest': cv2.INTER_NEAREST, 'bilinear': cv2.INTER_LINEAR,
+                              'area': cv2.INTER_AREA, 'bicubic': cv2.INTER_CUBIC}
+        assert interpolation in self.interp_method, f'unknown interpolation {interpolation}'
+        self.interpolation = interpolation  # type:str
+        # NOTE decode jpeg at reduced resolution by the DCT scaling, the box is relative so keep correct
+        self.reduce_decode = reduce_decode  # type:bool
+        assert augment_mode in ['none', 'iaa', 'fused'], f'unknown augment mode {augment_mode}'
+        self.augment_mode = augment_mode  # type:str
+        self.image_ann = image_ann
+        self.cache = None  # type:ImageStore
+        self.bank = None  # type:ImageStore
+        self.loaders = []  # type:list
+        self.tfrecord = None  # type:dict
+        self.timer = None  # type:StageTimer
         if image_ann == None:
             self.train_list = None
             self.test_list = None
+        elif image_ann.endswith('.json'):
+            """ tfrecord shards index from make_tfrecord.py, the split is done in the shards """
+            with open(image_ann) as f:
+                self.tfrecord = json.load(f)
+            for k in ['train', 'test']:
+                self.tfrecord[k]['shards'] = [os.path.join(os.path.dirname(image_ann), shard) for shard in self.tfrecord[k]['shards']]
+            self.train_list = self.tfrecord['train']['shards']  # type:list
+            self.test_list = self.tfrecord['test']['shards']  # type:list
+            self.train_total_data = self.tfrecord['train']['num']  # type:int
+            self.test_total_data = self.tfrecord['test']['num']  # type:int
         else:
-            img_ann_list = np.load(image_ann, allow_pickle=True)
-            np.random.shuffle(img_ann_list)
-            num = int(len(img_ann_list) * self.validation_split)
-            self.train_list = img_ann_list[num:]  # type:np.ndarray
-            self.test_list = img_ann_list[:num]  # type:np.ndarray
+            if AnnStore.exists(image_ann):
+                """ columnar annotation store from make_ann_store.py, memory-mapped so near-zero startup """
+                self.ann_list = AnnStore(image_ann)  # type:AnnStore
+            else:
+                self.ann_list = np.load(image_ann, allow_pickle=True)  # type:np.ndarray
+            # NOTE keep the index of the annotation file, the cache use it
+            # NOTE with `split_seed` the split is reproducible, the augmentation bank of the train split can be reused
+            ann_index = (np.random.permutation(len(self.ann_list)) if split_seed is None else
+                         np.random.RandomState(split_seed).permutation(len(self.ann_list)))
+            num = int(len(self.ann_list) * self.validation_split)
+            self.train_index = ann_index[num:]  # type:np.ndarray
+            self.test_index = ann_index[:num]  # type:np.ndarray
+            self.train_list = self.ann_list[self.train_index]  # type:np.ndarray
+            self.test_list = self.ann_list[self.test_index]  # type:np.ndarray
             self.train_total_data = len(self.train_list)  # type:int
             self.test_total_data = len(self.test_list)  # type:int
         self.grid_wh = (1 / self.out_hw)[:, [1, 0]]  # hw 转 wh 需要交换两列
@@ -218,15 +433,65 @@ class Helper(object):
         tuple
             labels list value :[output_number*[out_h,out_w,anchor_num,class+5]]
         """
-        labels = [np.zeros((self.out_hw[i][0], self.out_hw[i][1], len(self.anchors[i]),
-                            5 + self.class_num), dtype='float32') for i in range(self.output_number)]
-        for box in true_box:
-            # NOTE box [x y w h] are relative to the size of the entire image [0~1]
-            l, n = self._get_anchor_index(box[3:5])  # [layer index, anchor index]
-            idx, idy = self._xy_grid_index(box[1:3], l)  # [x index , y index]
-            labels[l][idy, idx, n, 0:4] = np.clip(box[1:5], 1e-8, 1.)
-            labels[l][idy, idx, n, 4] = 1.
-            labels[l][idy, idx, n, 5 + int(box[0])] = 1.
+        labels = self.box_to_label_batch(true_box[np.newaxis, ...], np.array([len(true_box)]))
+        return [label[0] for label in labels]
+
+    def box_to_label_batch(self, true_box: np.ndarray, box_num: np.ndarray = None, labels: list = None) -> list:
+        """convert a batch of padded annotaion to yolo v3 label, same result as `box_to_label` for every image
+
+        Parameters
+        ----------
+        true_box : np.ndarray
+            annotation shape :[batch,max_box,5] value :[batch*[max_box*[p,x,y,w,h]]]
+        box_num : np.ndarray
+            vaild box number of every image, shape :[batch]
+            when None, the box with w or h == 0 will be treated as padding
+        labels : list
+            preallocated labels list, will be fill zero and reuse.
+            value :[output_number*[batch,out_h,out_w,anchor_num,class+5]]
+
+        Returns
+        -------
+        list
+            labels list value :[output_number*[batch,out_h,out_w,anchor_num,class+5]]
+        """
+        batch, max_box = true_box.shape[0:2]
+        if labels is None:
+            labels = [np.zeros((batch, self.out_hw[i][0], self.out_hw[i][1], len(self.anchors[i]),
+                                5 + self.class_num), dtype='float32') for i in range(self.output_number)]
+        else:
+            for label in labels:
+                label.fill(0.)
+
+        if box_num is None:
+            vaild = np.all(true_box[..., 3:5] > 0, axis=-1)
+        else:
+            vaild = np.arange(max_box) < np.reshape(box_num, (-1, 1))
+        # NOTE np.nonzero is row-major, so the box order in every image is kept
+        bc, _ = np.nonzero(vaild)
+        box = true_box[vaild]  # [n,5]
+        if len(box) == 0:
+            return labels
+
+        # NOTE box [x y w h] are relative to the size of the entire image [0~1]
+        iou = Helper._fake_iou(box[:, np.newaxis, np.newaxis, 3:5], self.anchors[np.newaxis, ...])
+        l, n = np.unravel_index(np.argmax(np.reshape(iou, (len(box), -1)), axis=-1), self.anchors.shape[0:2])
+
+        for i in range(self.output_number):
+            m = l == i
+            if not np.any(m):
+                continue
+            layer_bc, layer_n, layer_box = bc[m], n[m], box[m]
+            idx, idy = np.floor(layer_box[:, 1:3] * self.out_hw[i][::-1]).astype('int').T  # [x index , y index]
+
+            """ when many boxes in one cell, the last box overwrite the xywh like the loop version """
+            cell = np.ravel_multi_index((layer_bc, idy, idx, layer_n), labels[i].shape[0:4])
+            _, last = np.unique(cell[::-1], return_index=True)
+            last = len(cell) - 1 - last
+            labels[i][layer_bc[last], idy[last], idx[last], layer_n[last], 0:4] = np.clip(layer_box[last, 1:5], 1e-8, 1.)
+            labels[i][layer_bc[last], idy[last], idx[last], layer_n[last], 4] = 1.
+            # NOTE the class one-hot is never cleared, so every box in the cell keep it's class
+            labels[i][layer_bc, idy, idx, layer_n, 5 + layer_box[:, 0].astype('int')] = 1.
 
         return labels
 
@@ -330,11 +595,13 @@ class Helper(object):
 
         image_aug = seq_det.augment_images([img])[0]
         bbs_aug = seq_det.augment_bounding_boxes([bbs])[0]
+        # NOTE keep the class of the remain boxes
+        keep = [not bb.is_out_of_image(img.shape, fully=True, partly=False) for bb in bbs_aug.bounding_boxes]
         bbs_aug = bbs_aug.remove_out_of_image().clip_out_of_image()
 
         xyxy_box = bbs_aug.to_xyxy_array()
         new_box = self.corner_to_center(xyxy_box)
-        new_box = np.hstack((p[0:new_box.shape[0], :], new_box))
+        new_box = np.hstack((p[np.array(keep, bool)], new_box))
         return image_aug, new_box
 
     def _read_img(self, img_path: str) -> np.ndarray:
@@ -350,12 +617,156 @@ class Helper(object):
         np.ndarray
             image src
         """
+        if self.reduce_decode:
+            with Image.open(img_path) as im:
+                if im.format == 'JPEG':
+                    """ decode at the smallest 1/2^n scale still cover the letterbox size """
+                    new_wh, _, _ = self.letterbox_param(np.array(im.size[::-1]), self.in_hw[0])
+                    im.draft('RGB', tuple(new_wh))
+                    return np.asarray(im.convert('RGB'))
         img = skimage.io.imread(img_path)
         if len(img.shape) != 3:
             img = skimage.color.gray2rgb(img)
         return img[..., :3]
 
-    def _process_img(self, img: np.ndarray, true_box: np.ndarray, is_training: bool, is_resize: bool) -> tuple:
+    @staticmethod
+    def letterbox_param(img_hw: np.ndarray, in_hw: np.ndarray) -> [np.ndarray, np.ndarray, np.ndarray]:
+        """ calculate the letterbox parameter, resize image to `new_wh` then put it at `translation`
+
+        Parameters
+        ----------
+        img_hw : np.ndarray
+            image [h, w] or many images [n, [h, w]]
+        in_hw : np.ndarray
+            network input [h, w]
+
+        Returns
+        -------
+        [np.ndarray, np.ndarray, np.ndarray]
+            new_wh : scaled region [w, h]
+            scale : the exact scale used, = new_wh / img_wh, [w, h]
+            translation : scaled region offset, [w offset, h offset]
+        """
+        img_wh = np.array(img_hw, 'float64')[..., 1::-1]
+        in_wh = np.array(in_hw)[1::-1]
+        new_wh = np.clip(np.round(img_wh * np.min(in_wh / img_wh, axis=-1, keepdims=True)), 1, in_wh).astype(int)
+        translation = (in_wh - new_wh) // 2
+        return new_wh, new_wh / img_wh, translation
+
+    def _resize_img(self, img: np.ndarray, true_box: np.ndarray) -> tuple:
+        """ resize image to network input size and keep ratio, the box will be transformed
+
+        Parameters
+        ----------
+        img : np.ndarray
+            image src
+        true_box : np.ndarray
+            box
+
+        Returns
+        -------
+        tuple
+            uint8 image src , true box
+        """
+        new_wh, _, translation = Helper.letterbox_param(img.shape[0:2], self.in_hw[0])
+        in_wh = self.in_hw[0][::-1]
+
+        """ calculate the box transform """
+        if isinstance(true_box, np.ndarray):
+            true_box[:, 1:3] = (true_box[:, 1:3] * new_wh + translation) / in_wh
+            true_box[:, 3:5] = (true_box[:, 3:5] * new_wh) / in_wh
+        elif isinstance(true_box, tf.Tensor):
+            # NOTE use concat replace item assign
+            true_box = tf.concat((true_box[:, 0:1],
+                                  (true_box[:, 1:3] * new_wh + translation) / in_wh,
+                                  (true_box[:, 3:5] * new_wh) / in_wh), axis=1)
+
+        """ resize the scaled region into the zero canvas """
+        canvas = np.zeros((self.in_hw[0][0], self.in_hw[0][1], 3), 'uint8')
+        canvas[translation[1]:translation[1] + new_wh[1], translation[0]:translation[0] + new_wh[0]] = cv2.resize(
+            np.ascontiguousarray(img, 'uint8'), tuple(new_wh), interpolation=self.interp_method[self.interpolation])
+        return canvas, true_box
+
+    def _augment_matrix(self, out_wh: np.ndarray) -> np.ndarray:
+        """ random affine matrix of the same augmenter family as `self.iaaseq` :
+            one of [50% fliplr, rotate (-10, 10) degree around the center, translate (-10%, 10%)]
+
+        Parameters
+        ----------
+        out_wh : np.ndarray
+            output image [w, h]
+
+        Returns
+        -------
+        np.ndarray
+            3x3 affine matrix, in the continuous coordinate (pixel i cover [i, i+1])
+        """
+        w, h = out_wh
+        choice = np.random.randint(3)
+        if choice == 0:
+            if np.random.rand() < 0.5:
+                return np.array([[-1., 0., w], [0., 1., 0.], [0., 0., 1.]])
+            return np.eye(3)
+        elif choice == 1:
+            theta = np.deg2rad(np.random.uniform(-10, 10))
+            c, s = cos(theta), sin(theta)
+            cx, cy = w / 2, h / 2
+            return np.array([[c, -s, cx - c * cx + s * cy], [s, c, cy - s * cx - c * cy], [0., 0., 1.]])
+        else:
+            return np.array([[1., 0., np.random.uniform(-.1, .1) * w], [0., 1., np.random.uniform(-.1, .1) * h], [0., 0., 1.]])
+
+    def _augment_img(self, img: np.ndarray, true_box: np.ndarray, is_resize: bool) -> tuple:
+        """ compose the letterbox and the random augmenter in one affine matrix, warp the image once,
+            transform the box corners by the same matrix, the box clipping is same as
+            `remove_out_of_image().clip_out_of_image()`
+
+        Parameters
+        ----------
+        img : np.ndarray
+            image src
+        true_box : np.ndarray
+            box
+        is_resize : bool
+            wether to letterbox the image to network input size
+
+        Returns
+        -------
+        tuple
+            uint8 image src , true box
+        """
+        img_wh = np.array(img.shape[1::-1])
+        if is_resize:
+            new_wh, scale, translation = Helper.letterbox_param(img.shape[0:2], self.in_hw[0])
+            out_wh = self.in_hw[0][::-1]
+            mat = np.array([[scale[0], 0., translation[0]], [0., scale[1], translation[1]], [0., 0., 1.]])
+        else:
+            out_wh = img_wh
+            mat = np.eye(3)
+        mat = self._augment_matrix(out_wh) @ mat
+
+        """ cv2 use the pixel center coordinate, shift half pixel """
+        shift = np.array([[1., 0., .5], [0., 1., .5], [0., 0., 1.]])
+        pix_mat = np.linalg.inv(shift) @ mat @ shift
+        # NOTE warpAffine not support area interpolation
+        interp = self.interp_method[self.interpolation] if self.interpolation != 'area' else cv2.INTER_LINEAR
+        img = cv2.warpAffine(np.ascontiguousarray(img, 'uint8'), pix_mat[:2], tuple(int(v) for v in out_wh),
+                             flags=interp, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+        if true_box is not None and len(true_box) > 0:
+            """ transform 4 corners of every box, use the outer rectangle """
+            xy1 = (true_box[:, 1:3] - true_box[:, 3:5] / 2) * img_wh
+            xy2 = (true_box[:, 1:3] + true_box[:, 3:5] / 2) * img_wh
+            corners = np.stack([xy1, np.hstack([xy2[:, 0:1], xy1[:, 1:2]]), np.hstack([xy1[:, 0:1], xy2[:, 1:2]]), xy2], 1)
+            corners = corners @ mat[:2, :2].T + mat[:2, 2]
+            xy1, xy2 = corners.min(1), corners.max(1)
+            """ remove the box fully out of image, then clip """
+            keep = np.all(xy2 > 0, 1) & np.all(xy1 < out_wh, 1)
+            xy1, xy2 = np.clip(xy1[keep], 0, out_wh), np.clip(xy2[keep], 0, out_wh)
+            true_box = np.hstack([true_box[keep, 0:1], (xy1 + xy2) / 2 / out_wh, (xy2 - xy1) / out_wh])
+        return img, true_box
+
+    def _process_img(self, img: np.ndarray, true_box: np.ndarray, is_training: bool, is_resize: bool,
+                     is_normlize=True) -> tuple:
         """ process image and true box , if is training then use data augmenter
 
         Parameters
@@ -368,86 +779,622 @@ class Helper(object):
             wether to use data augmenter
         is_resize : bool
             wether to resize the image
+        is_normlize : bool
+            wether to normlize the image by the image max, when False keep the uint8 image
 
         Returns
         -------
         tuple
             image src , true box
         """
-        if is_resize:
-            """ resize image and keep ratio """
-            img_wh = np.array([img.shape[1], img.shape[0]])
-            in_wh = self.in_hw[0][::-1]
-
-            """ calculate the affine transform factor """
-            scale = in_wh / img_wh  # NOTE affine tranform sacle is [w,h]
-            scale[:] = np.min(scale)
-            # NOTE translation is [w offset,h offset]
-            translation = ((in_wh - img_wh * scale) / 2).astype(int)
-
-            """ calculate the box transform matrix """
-            if isinstance(true_box, np.ndarray):
-                true_box[:, 1:3] = (true_box[:, 1:3] * img_wh * scale + translation) / in_wh
-                true_box[:, 3:5] = (true_box[:, 3:5] * img_wh * scale) / in_wh
-            elif isinstance(true_box, tf.Tensor):
-                # NOTE use concat replace item assign
-                true_box = tf.concat((true_box[:, 0:1],
-                                      (true_box[:, 1:3] * img_wh * scale + translation) / in_wh,
-                                      (true_box[:, 3:5] * img_wh * scale) / in_wh), axis=1)
-
-            """ apply Affine Transform """
-            aff = skimage.transform.AffineTransform(scale=scale, translation=translation)
-            img = skimage.transform.warp(img, aff.inverse, output_shape=self.in_hw[0], preserve_range=True).astype('uint8')
+        if is_training and self.augment_mode == 'fused':
+            """ letterbox and augmenter in one warp """
+            img, true_box = self._augment_img(img, true_box, is_resize)
+        else:
+            if is_resize:
+                img, true_box = self._resize_img(img, true_box)
 
-        if is_training:
-            pass
-            # img, true_box = self.data_augmenter(img, true_box) <<<<<<<<<<<<<<<<<<<<<<<<<
+            if is_training and self.augment_mode == 'iaa':
+                img, true_box = self.data_augmenter(img, true_box)
 
         # normlize image
-        img = img / np.max(img)
+        if is_normlize:
+            img = img / np.max(img)
         return img, true_box
 
-    def generator(self, is_training=True, is_resize=True, is_make_lable=True, train_list=True):
-        for image_path, true_box in train_list:
+    def generator(self, is_training=True, is_resize=True, is_make_lable=True, train_list=True, num_workers=0, rand_seed=0):
+        if is_make_lable and num_workers > 0:
+            """ use worker processes, the order is same as train_list """
+            loader = ProcessLoader(self, train_list, is_training, is_resize, rand_seed, num_workers, shuffle=False, epochs=1)
+            try:
+                yield from loader
+            finally:
+                loader.close()
+            return
+
+        for image_path, true_box, _ in train_list:
             img = self._read_img(image_path)
-            img, true_box = self._process_img(img, true_box, is_training, is_resize)
+            img, true_box = self._process_img(img, np.copy(true_box), is_training, is_resize)
+            # NOTE same dtype as the worker processes output
+            img = img.astype('float32')
             if is_make_lable:
-                yield img, self.box_to_label(true_box)
+                yield img, tuple([label.astype('float32') for label in self.box_to_label(true_box)])
             else:
                 yield img, true_box
 
-    def _create_dataset(self, image_ann_list: np.ndarray, batch_size: int, rand_seed: int, is_training: bool, is_resize: bool) -> tf.data.Dataset:
+    def _cache_prefix(self, bank_num: int = 0, index: np.ndarray = None) -> str:
+        """ the cache file prefix, keyed by the annotation file hash, `in_hw`, `interpolation` and `reduce_decode`,
+            when `bank_num` > 0 the augmentation bank prefix, also keyed by `augment_mode`, `bank_num` and the bank `index`
+        """
+        sha = hashlib.sha1()
+        for ann_file in (AnnStore.files(self.image_ann) if isinstance(self.ann_list, AnnStore) else [self.image_ann]):
+            with open(ann_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(chunk)
+        sha.update(self.in_hw[0].astype('int64').tobytes())
+        sha.update(self.interpolation.encode())
+        if self.reduce_decode:
+            sha.update(b'reduce_decode')
+        if bank_num > 0:
+            sha.update(self.augment_mode.encode())
+            sha.update(np.int64(bank_num).tobytes())
+            sha.update(np.asarray(index, 'int64').tobytes())
+            return os.path.splitext(self.image_ann)[0] + '_bank_' + sha.hexdigest()[:16]
+        return os.path.splitext(self.image_ann)[0] + '_cache_' + sha.hexdigest()[:16]
+
+    def _load_cache(self) -> ImageStore:
+        """ load the pre-letterboxed image cache, build it when the annotation file or `in_hw` changed """
+        prefix = self._cache_prefix()
+        if not ImageStore.exists(prefix):
+            for f in glob.glob(os.path.splitext(self.image_ann)[0] + '_cache_*'):
+                if not f.startswith(prefix):
+                    print(NOTE, f'Remove stale cache {f}')
+                    os.remove(f)
+
+            def fn(i: int):
+                img_path, true_box, _ = self.ann_list[i]
+                return self._resize_img(self._read_img(img_path), np.copy(true_box))
+
+            print(INFO, f'Build image cache {prefix}')
+            ImageStore.build(prefix, len(self.ann_list), self.in_hw[0], fn)
+        print(INFO, f'Load image cache {prefix}')
+        return ImageStore(prefix)
+
+    def _bank_sample(self, j: int, index: np.ndarray, rand_seed: int) -> [np.ndarray, np.ndarray]:
+        """ the bank row `j` : the variant `j // m` of the annotation `index[j % m]`, letterboxed and augmented uint8 image """
+        k, r = divmod(j, len(index))
+        i = index[r]
+        # NOTE the random state only depend on (seed, variant, index), so the bank is same with any worker number
+        np.random.seed([rand_seed, k, i])
+        ia.seed(np.random.randint(2**31))
+        img_path, true_box, _ = self.ann_list[i]
+        return self._process_img(self._read_img(img_path), np.copy(true_box), True, True, False)
+
+    def build_bank(self, bank_num: int, rand_seed: int = 0, num_workers: int = 0, index: np.ndarray = None) -> ImageStore:
+        """ load the augmentation bank, build it when the annotation file, `in_hw`, augment setting or `index` changed.
+            the bank store `bank_num` augmented variants of the annotations `index` at the network input size,
+            the row `k * m + r` is the variant `k` of the annotation `index[r]`.
+
+        Parameters
+        ----------
+        bank_num : int
+            augmented variant number of every image
+        index : np.ndarray
+            the annotation index to augment, default `train_index`, the validation images are never sampled
+        rand_seed : int
+            random seed of the augmentation, only used when build
+        num_workers : int
+            build process number, 0 for build in this process
+
+        Returns
+        -------
+        ImageStore
+            the bank
+        """
+        assert self.augment_mode != 'none', 'augmentation bank need augment_mode iaa or fused'
+        index = self.train_index if index is None else index
+        prefix = self._cache_prefix(bank_num, index)
+        if not ImageStore.exists(prefix):
+            for f in glob.glob(os.path.splitext(self.image_ann)[0] + '_bank_*'):
+                if not f.startswith(prefix):
+                    print(NOTE, f'Remove stale bank {f}')
+                    os.remove(f)
+
+            num = bank_num * len(index)
+            print(INFO, f'Build augmentation bank {prefix}, {bank_num} variants of {len(index)} images')
+            if num_workers > 0:
+                with mp.get_context('fork').Pool(num_workers, _bank_init, (self, index, rand_seed)) as pool:
+                    it = pool.imap(_bank_fn, range(num), chunksize=16)
+                    ImageStore.build(prefix, num, self.in_hw[0], lambda j: next(it))
+            else:
+                ImageStore.build(prefix, num, self.in_hw[0], lambda j: self._bank_sample(j, index, rand_seed))
+        print(INFO, f'Load augmentation bank {prefix}')
+        return ImageStore(prefix)
+
+    def _tf_resize_img(self, img: tf.Tensor, true_box: tf.Tensor) -> [tf.Tensor, tf.Tensor]:
+        """ graph version of `_resize_img`, resize image to network input size and keep ratio
+
+        Parameters
+        ----------
+        img : tf.Tensor
+            uint8 image src, shape = [h, w, 3]
+        true_box : tf.Tensor
+            box, shape = [?, 5]
+
+        Returns
+        -------
+        [tf.Tensor, tf.Tensor]
+            uint8 image src , true box
+        """
+        with tf.name_scope('resize_img'):
+            img_wh = tf.cast(tf.shape(img)[1::-1], tf.float64)
+            in_wh = tf.constant(self.in_hw[0][::-1], tf.float64)
+
+            """ same as `letterbox_param` """
+            new_wh = tf.clip_by_value(tf.round(img_wh * tf.reduce_min(in_wh / img_wh)), 1, in_wh)
+            translation = tf.floor((in_wh - new_wh) / 2)
+
+            """ calculate the box transform """
+            new_wh_f, translation_f, in_wh_f = [tf.cast(t, tf.float32) for t in [new_wh, translation, in_wh]]
+            true_box = tf.concat((true_box[:, 0:1],
+                                  (true_box[:, 1:3] * new_wh_f + translation_f) / in_wh_f,
+                                  (true_box[:, 3:5] * new_wh_f) / in_wh_f), axis=1)
+
+            """ resize the scaled region and pad it to network input size """
+            new_wh = tf.cast(new_wh, tf.int32)
+            translation = tf.cast(translation, tf.int32)
+            img = img[tf.newaxis, ...]
+            # NOTE use half pixel centers, same as cv2.resize
+            if self.interpolation == 'nearest':
+                img = tf.image.resize_nearest_neighbor(img, new_wh[::-1], half_pixel_centers=True)
+            elif self.interpolation == 'area':
+                img = tf.image.resize_area(img, new_wh[::-1])
+            elif self.interpolation == 'bicubic':
+                img = tf.image.resize_bicubic(img, new_wh[::-1], half_pixel_centers=True)
+            else:
+                img = tf.image.resize_bilinear(img, new_wh[::-1], half_pixel_centers=True)
+            img = tf.cast(tf.clip_by_value(tf.round(tf.cast(img[0], tf.float32)), 0, 255), tf.uint8)
+            img = tf.image.pad_to_bounding_box(img, translation[1], translation[0], self.in_hw[0][0], self.in_hw[0][1])
+        return img, true_box
+
+    def _tf_decode_jpeg(self, contents: tf.Tensor) -> tf.Tensor:
+        """ graph version of `_read_img`, decode the jpeg, when `reduce_decode` use the largest `ratio`
+            which decoded image still cover the letterbox size
+
+        Parameters
+        ----------
+        contents : tf.Tensor
+            jpeg bytes
+
+        Returns
+        -------
+        tf.Tensor
+            uint8 image src, shape = [h, w, 3]
+        """
+        if not self.reduce_decode:
+            return tf.image.decode_jpeg(contents, channels=3)
+        with tf.name_scope('reduce_decode'):
+            img_hw = tf.cast(tf.image.extract_jpeg_shape(contents)[:2], tf.float32)
+            in_hw = tf.constant(self.in_hw[0], tf.float32)
+            new_hw = tf.clip_by_value(tf.round(img_hw * tf.reduce_min(in_hw / img_hw)), 1, in_hw)
+            # NOTE the decoded size with ratio r is ceil(hw / r)
+            pred_fn = [(tf.reduce_all(tf.ceil(img_hw / r) >= new_hw),
+                        lambda r=r: tf.image.decode_jpeg(contents, channels=3, ratio=r)) for r in [8, 4, 2]]
+            return tf.case(pred_fn, lambda: tf.image.decode_jpeg(contents, channels=3))
+
+    def _tf_augment_matrix(self, out_wh: tf.Tensor, rand_seed: int = None) -> tf.Tensor:
+        """ graph version of `_augment_matrix`
+
+        Parameters
+        ----------
+        out_wh : tf.Tensor
+            output image [w, h]
+        rand_seed : int
+            op level random seed, every random op use its own offset
+
+        Returns
+        -------
+        tf.Tensor
+            3x3 affine matrix, in the continuous coordinate (pixel i cover [i, i+1])
+        """
+        w, h = out_wh[0], out_wh[1]
+        zero, one = tf.constant(0.), tf.constant(1.)
+
+        def seed(i: int) -> int:
+            return None if rand_seed is None else rand_seed + i
+
+        def flip():
+            return tf.cond(tf.random.uniform([], seed=seed(1)) < 0.5,
+                           lambda: tf.stack([[-one, zero, w], [zero, one, zero], [zero, zero, one]]),
+                           lambda: tf.eye(3))
+
+        def rotate():
+            theta = tf.random.uniform([], -10., 10., seed=seed(2)) * np.pi / 180.
+            c, s = tf.cos(theta), tf.sin(theta)
+            cx, cy = w / 2, h / 2
+            return tf.stack([[c, -s, cx - c * cx + s * cy], [s, c, cy - s * cx - c * cy], [zero, zero, one]])
+
+        def translate():
+            return tf.stack([[one, zero, tf.random.uniform([], -.1, .1, seed=seed(3)) * w],
+                             [zero, one, tf.random.uniform([], -.1, .1, seed=seed(4)) * h], [zero, zero, one]])
+
+        choice = tf.random.uniform([], 0, 3, tf.int32, seed=seed(0))
+        return tf.case([(tf.equal(choice, 0), flip), (tf.equal(choice, 1), rotate)], translate)
+
+    def _tf_augment_img(self, img: tf.Tensor, true_box: tf.Tensor, is_resize: bool, rand_seed: int = None) -> [tf.Tensor, tf.Tensor]:
+        """ graph version of `_augment_img`, the map can run the augmenter in parallel
+
+            NOTE only support 'nearest' and 'bilinear' interpolation
+
+        Parameters
+        ----------
+        img : tf.Tensor
+            uint8 image src, shape = [h, w, 3]
+        true_box : tf.Tensor
+            box, shape = [?, 5]
+        is_resize : bool
+            wether to letterbox the image to network input size
+        rand_seed : int
+            random seed of the augment ops
+
+        Returns
+        -------
+        [tf.Tensor, tf.Tensor]
+            uint8 image src , true box
+        """
+        assert self.interpolation in ['nearest', 'bilinear'], f'graph augment not support {self.interpolation} interpolation'
+        with tf.name_scope('augment_img'):
+            true_box = tf.cast(true_box, tf.float32)
+            img_wh = tf.cast(tf.shape(img)[1::-1], tf.float32)
+            if is_resize:
+                out_wh = tf.constant(self.in_hw[0][::-1], tf.float32)
+                new_wh = tf.clip_by_value(tf.round(img_wh * tf.reduce_min(out_wh / img_wh)), 1, out_wh)
+                scale = new_wh / img_wh
+                translation = tf.floor((out_wh - new_wh) / 2)
+                mat = tf.stack([tf.stack([scale[0], 0., translation[0]]),
+                                tf.stack([0., scale[1], translation[1]]),
+                                tf.constant([0., 0., 1.])])
+            else:
+                out_wh = img_wh
+                mat = tf.eye(3)
+            mat = tf.matmul(self._tf_augment_matrix(out_wh, rand_seed), mat)
+
+            """ the transform op map output pixel to input pixel, use the inverse matrix in pixel center coordinate """
+            shift = tf.constant([[1., 0., .5], [0., 1., .5], [0., 0., 1.]])
+            pix_mat = tf.matmul(tf.matmul(tf.linalg.inv(shift), mat), shift)
+            inv_mat = tf.linalg.inv(pix_mat)
+            transforms = tf.reshape(inv_mat, [-1])[:8] / inv_mat[2, 2]
+            out_hw = tf.cast(out_wh[::-1], tf.int32)
+            img = image_transform(tf.cast(img, tf.float32)[tf.newaxis, ...], transforms[tf.newaxis, ...],
+                                  'NEAREST' if self.interpolation == 'nearest' else 'BILINEAR', out_hw)[0]
+            img = tf.cast(tf.clip_by_value(tf.round(img), 0, 255), tf.uint8)
+            if is_resize:
+                img.set_shape(list(self.in_hw[0]) + [3])
+
+            """ transform 4 corners of every box, use the outer rectangle """
+            xy1 = (true_box[:, 1:3] - true_box[:, 3:5] / 2) * img_wh
+            xy2 = (true_box[:, 1:3] + true_box[:, 3:5] / 2) * img_wh
+            corners = tf.stack([xy1, tf.stack([xy2[:, 0], xy1[:, 1]], -1), tf.stack([xy1[:, 0], xy2[:, 1]], -1), xy2], 1)
+            corners = tf.tensordot(corners, tf.transpose(mat[:2, :2]), 1) + mat[:2, 2]
+            xy1, xy2 = tf.reduce_min(corners, 1), tf.reduce_max(corners, 1)
+            """ remove the box fully out of image, then clip """
+            keep = tf.logical_and(tf.reduce_all(xy2 > 0, 1), tf.reduce_all(xy1 < out_wh, 1))
+            xy1 = tf.clip_by_value(tf.boolean_mask(xy1, keep), 0, out_wh)
+            xy2 = tf.clip_by_value(tf.boolean_mask(xy2, keep), 0, out_wh)
+            true_box = tf.concat([tf.boolean_mask(true_box[:, 0:1], keep), (xy1 + xy2) / 2 / out_wh, (xy2 - xy1) / out_wh], 1)
+        return img, true_box
+
+    def _tf_process_img(self, img: tf.Tensor, true_box: tf.Tensor, is_training: bool, is_resize: bool,
+                        is_normlize=True, rand_seed: int = None) -> [tf.Tensor, tf.Tensor]:
+        """ graph version of `_process_img`
+
+        Parameters
+        ----------
+        img : tf.Tensor
+            uint8 image src, shape = [h, w, 3]
+        true_box : tf.Tensor
+            box, shape = [?, 5]
+        is_training : bool
+            wether to use data augmenter
+        is_resize : bool
+            wether to resize the image
+        is_normlize : bool
+            wether to normlize the image by the image max, when False keep the uint8 image
+        rand_seed : int
+            random seed of the graph augmenter
+
+        Returns
+        -------
+        [tf.Tensor, tf.Tensor]
+            float32 image src , true box
+        """
+        assert not (is_training and self.augment_mode == 'iaa'), 'imgaug augmenter only support py parser'
+        if is_training and self.augment_mode == 'fused':
+            """ letterbox and augmenter in one warp by graph ops """
+            img, true_box = self._tf_augment_img(img, true_box, is_resize, rand_seed)
+        elif is_resize:
+            img, true_box = self._tf_resize_img(img, true_box)
+
+        # normlize image
+        if is_normlize:
+            img = tf.cast(img, tf.float32) / tf.cast(tf.reduce_max(img), tf.float32)
+        return img, true_box
+
+    def _stage(self, name: str):
+        """ time the pipeline stage when the timer is set, see `StageTimer` """
+        return self.timer.stage(name) if self.timer is not None else contextlib.nullcontext()
+
+    @staticmethod
+    def _ann_tensors(image_ann_list) -> [tf.Tensor, tf.Tensor, tf.RaggedTensor]:
+        """ load the annotation list once as the path bytes tensor and the ragged box tensor,
+            so the dataset only shuffle the index and look up the annotation by graph ops.
+            the path `i` is `tf.strings.substr(path, path_range[i, 0], path_range[i, 1])`, see `_tf_lookup_ann`.
+
+        Parameters
+        ----------
+        image_ann_list : np.ndarray or AnnStore
+            annotation list, value = [n*[image path, box, image shape]]
+
+        Returns
+        -------
+        [tf.Tensor, tf.Tensor, tf.RaggedTensor]
+            path bytes shape = [] , path range [start, length] shape = [n, 2] , box shape = [n, None, 5]
+        """
+        if isinstance(image_ann_list, AnnStore):
+            box, _ = image_ann_list.boxes()
+            box_num = image_ann_list.box_idx[image_ann_list.index + 1] - image_ann_list.box_idx[image_ann_list.index]
+            path, start, length = image_ann_list.paths()
+        else:
+            boxes = [np.reshape(box, (-1, 5)) for _, box, _ in image_ann_list]
+            box_num = [len(box) for box in boxes]
+            box = np.vstack(boxes) if len(boxes) > 0 else np.zeros((0, 5))
+            paths = [str(path).encode() for path, _, _ in image_ann_list]
+            path, length = b''.join(paths), np.array([len(p) for p in paths], np.int64)
+            start = np.cumsum(length) - length
+        return (tf.constant(path, tf.string, []),
+                tf.constant(np.stack([start, length], -1).reshape((-1, 2)), tf.int64),
+                tf.RaggedTensor.from_row_lengths(tf.constant(box, tf.float32), tf.constant(box_num, tf.int64)))
+
+    @staticmethod
+    def _tf_lookup_ann(ann_tensors: list, i: tf.Tensor) -> [tf.Tensor, tf.Tensor]:
+        """ look up the annotation `i` from `_ann_tensors`, return [path, box] """
+        path, path_range, boxes = ann_tensors
+        return tf.strings.substr(path, path_range[i, 0], path_range[i, 1]), boxes[i]
+
+    def shuffle_memory(self, shuffle_buffer: int, num: int) -> int:
+        """ the peak bytes of the streaming shuffle : epoch index + decoded samples in the shuffle buffer """
+        sample = np.prod(self.in_hw[0]) * 3 * 4 + sum([np.prod(shape[1:]) * 4 for shape in self.output_shapes])
+        return int(num * 8 + shuffle_buffer * sample)
+
+    def _create_dataset(self, image_ann_list: np.ndarray, batch_size: int, rand_seed: int, is_training: bool, is_resize: bool,
+                        cache_index: np.ndarray = None, parser: str = 'py', num_workers: int = 0,
+                        shuffle_buffer: int = 0, label_mode: str = 'dense', image_dtype: str = 'float32',
+                        tag: str = 'train', bank_num: int = 0) -> tf.data.Dataset:
         print(INFO, 'data augment is ', str(is_training))
+        # NOTE uint8 image is normlized by the model first layer
+        is_normlize = image_dtype == 'float32'
+        img_dtype = tf.float32 if is_normlize else tf.uint8
+
+        if label_mode == 'box':
+            """ the samples only carry the boxes, the labels are scattered in the train step by `tf_batch_box_to_label` """
+            def _make_label(true_box: tf.Tensor):
+                return tf.cast(true_box, tf.float32)
+
+            def _batch(dataset: tf.data.Dataset) -> tf.data.Dataset:
+                return (dataset.
+                        map(lambda img, true_box: (img, true_box, tf.shape(true_box)[0])).
+                        padded_batch(batch_size, (list(self.in_hw[0]) + [3], [None, 5], []), drop_remainder=True))
+        else:
+            def _make_label(true_box: tf.Tensor):
+                return tuple(tf_box_to_label(true_box, self))
+
+            def _batch(dataset: tf.data.Dataset) -> tf.data.Dataset:
+                return dataset.batch(batch_size, True)
+
+        def _prefetch(dataset: tf.data.Dataset) -> tf.data.Dataset:
+            if self.timer is not None:
+                """ count the produced batch before prefetch """
+                def _mark(*batch):
+                    num = py_function(lambda: self.timer.mark_batch(tag), [], tf.int32)
+                    with tf.control_dependencies([num]):
+                        return nest.map_structure(tf.identity, batch)
+
+                dataset = dataset.map(_mark)
+            return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+        if self.tfrecord is not None:
+            """ interleave read the shards, then parse by graph ops """
+            assert len(image_ann_list) > 0, f'the {tag} split have no tfrecord shard'
+            def _parser_wrapper(record: tf.Tensor):
+                features = parse_single_example(record, {'image': FixedLenFeature([], tf.string),
+                                                         'box': VarLenFeature(tf.float32),
+                                                         'shape': FixedLenFeature([2], tf.int64)})
+                true_box = tf.reshape(sparse_tensor_to_dense(features['box']), (-1, 5))
+                img = self._tf_decode_jpeg(features['image'])
+                img, true_box = self._tf_process_img(img, true_box, is_training, is_resize, is_normlize, rand_seed)
+                return img, _make_label(true_box)
+
+            dataset = (tf.data.Dataset.from_tensor_slices(image_ann_list).
+                       shuffle(len(image_ann_list), rand_seed).repeat().
+                       interleave(lambda f: tf.data.TFRecordDataset(f, buffer_size=8 << 20),
+                                  min(len(image_ann_list), 8), 1, tf.data.experimental.AUTOTUNE).
+                       # NOTE the records are in fixed order in shards, mix them across the shards
+                       shuffle(batch_size * 50 if is_training == True else batch_size * 5, rand_seed).
+                       map(_parser_wrapper, tf.data.experimental.AUTOTUNE))
+            return _prefetch(_batch(dataset))
+
+        if num_workers > 0:
+            """ the worker processes read, letterbox and make label, the loader shuffle every epoch """
+            loader = ProcessLoader(self, image_ann_list, is_training, is_resize, rand_seed, num_workers)
+            self.loaders.append(loader)
+            dataset = tf.data.Dataset.from_generator(
+                lambda: iter(loader), (tf.float32, tuple([tf.float32] * self.output_number)),
+                (tf.TensorShape(list(self.in_hw[0]) + [3]), tuple([shape[1:] for shape in self.output_shapes])))
+            return _prefetch(dataset.batch(batch_size, True))
+
+        if bank_num > 0:
+            """ augmentation bank : every epoch permute the samples and pick one stored variant, the sample is already augmented """
+            dataset = (tf.data.Dataset.from_tensor_slices(cache_index).shuffle(len(cache_index), rand_seed).repeat().
+                       map(lambda r: tf.random.uniform([], 0, bank_num, tf.int64, seed=rand_seed) * len(cache_index) + r))
+        elif shuffle_buffer > 0:
+            """ streaming shuffle : the index is permuted every epoch, the small buffer mix the decoded samples """
+            num = len(image_ann_list) if cache_index is None else len(cache_index)
+            print(INFO, f'streaming shuffle buffer {shuffle_buffer}, peak memory {self.shuffle_memory(shuffle_buffer, num) / 2**20:.1f} MB')
+            if cache_index is None:
+                # NOTE the index shuffle buffer hold the whole epoch index
+                dataset = tf.data.Dataset.range(num).shuffle(num, rand_seed).repeat()
+            else:
+                dataset = tf.data.Dataset.from_tensor_slices(cache_index).shuffle(num, rand_seed).repeat()
+        elif cache_index is None:
+            dataset = tf.data.Dataset.range(len(image_ann_list))
+        else:
+            dataset = tf.data.Dataset.from_tensor_slices(cache_index)
 
-        def _dataset_parser(img_path: str, true_box: np.ndarray):
-            img = self._read_img(img_path.numpy().decode())
-            img, true_box = self._process_img(img, true_box, is_training, is_resize) # is_training <- data_augment
-            labels = self.box_to_label(true_box)
-            return (img.astype('float32'), *labels)
-
-        @tf.function
-        def _parser_wrapper(img_path: str, true_box: np.ndarray):
-            img, *labels = py_function(_dataset_parser, [img_path, true_box], [tf.float32] * (len(self.anchors) + 1))
-            # NOTE use wrapper function and dynamic list construct (x,(y_1,y_2,...))
-            return img, tuple(labels)
-
-        def gen():
-            while True:
-                for img_path, true_box, _ in image_ann_list:
-                    # NOTE use copy avoid change the annotaion value !
-                    yield img_path, np.copy(true_box)
-
-        dataset = (tf.data.Dataset.from_generator(gen, (tf.framework_ops.dtypes.string, tf.float32), ([], [None, 5])).
+        if cache_index is None:
+            """ the annotation is loaded once, no python code run per element before the parser """
+            ann_tensors = self._ann_tensors(image_ann_list)
+
+            def _lookup(i: tf.Tensor):
+                return self._tf_lookup_ann(ann_tensors, i)
+
+        if parser == 'native':
+            """ only graph ops, so the map can run in parallel """
+            def _parser_wrapper(img_path: tf.Tensor, true_box: tf.Tensor):
+                img = self._tf_decode_jpeg(read_file(img_path))
+                img, true_box = self._tf_process_img(img, true_box, is_training, is_resize, is_normlize, rand_seed)
+                return img, _make_label(true_box)
+        else:
+            if cache_index is None:
+                def _dataset_parser(img_path: str, true_box: np.ndarray):
+                    with self._stage('read'):
+                        img = self._read_img(img_path.numpy().decode())
+                    with self._stage('process'):
+                        img, true_box = self._process_img(img, true_box, is_training, is_resize, is_normlize) # is_training <- data_augment
+                    if label_mode == 'box':
+                        return img.astype(image_dtype), true_box.astype('float32')
+                    with self._stage('label'):
+                        labels = self.box_to_label(true_box)
+                    return (img.astype(image_dtype), *labels)
+            else:
+                # NOTE the bank image already augmented
+                store = self.bank if bank_num > 0 else self.cache
+
+                def _dataset_parser(i: int):
+                    # NOTE the cache image already resized, copy it from memmap
+                    with self._stage('read'):
+                        img, true_box = store[i.numpy()]
+                        img = np.array(img)
+                    with self._stage('process'):
+                        img, true_box = self._process_img(img, true_box, is_training and bank_num == 0, False, is_normlize)
+                    if label_mode == 'box':
+                        return img.astype(image_dtype), true_box.astype('float32')
+                    with self._stage('label'):
+                        labels = self.box_to_label(true_box)
+                    return (img.astype(image_dtype), *labels)
+
+            if label_mode == 'box':
+                @tf.function
+                def _parser_wrapper(*inputs):
+                    img, true_box = py_function(_dataset_parser, list(inputs), [img_dtype, tf.float32])
+                    img.set_shape(list(self.in_hw[0]) + [3])
+                    true_box.set_shape([None, 5])
+                    return img, true_box
+            else:
+                @tf.function
+                def _parser_wrapper(*inputs):
+                    img, *labels = py_function(_dataset_parser, list(inputs), [img_dtype] + [tf.float32] * len(self.anchors))
+                    # NOTE use wrapper function and dynamic list construct (x,(y_1,y_2,...))
+                    return img, tuple(labels)
+
+        if shuffle_buffer > 0 or bank_num > 0:
+            if cache_index is None:
+                dataset = dataset.map(_lookup, tf.data.experimental.AUTOTUNE)
+            dataset = dataset.map(_parser_wrapper, tf.data.experimental.AUTOTUNE)
+            if shuffle_buffer > 0:
+                dataset = dataset.shuffle(shuffle_buffer, rand_seed)
+            return _prefetch(_batch(dataset))
+
+        dataset = (dataset.
                    # shuffle(batch_size * 500 if is_training == True else batch_size * 50, rand_seed).repeat().
-                   shuffle(self.train_total_data if is_training == True else self.test_total_data, rand_seed).repeat().
-                   map(_parser_wrapper, tf.data.experimental.AUTOTUNE).
-                   batch(batch_size, True).prefetch(tf.data.experimental.AUTOTUNE))
+                   # NOTE only the index is shuffled, so the buffer hold the whole epoch index
+                   shuffle(len(image_ann_list) if cache_index is None else len(cache_index), rand_seed).repeat())
+        if cache_index is None:
+            dataset = dataset.map(_lookup, tf.data.experimental.AUTOTUNE)
+        dataset = dataset.map(_parser_wrapper, tf.data.experimental.AUTOTUNE)
+
+        return _prefetch(_batch(dataset))
 
-        return dataset
+    def set_dataset(self, batch_size, rand_seed, data_augment=True, is_resize=True, is_cache=False, parser='py', num_workers=0,
+                    shuffle_buffer=0, label_mode='dense', image_dtype='float32', bank_num=0):
+        """ set the train and test dataset
 
-    def set_dataset(self, batch_size, rand_seed, data_augment=True, is_resize=True):
-        self.train_dataset = self._create_dataset(self.train_list, batch_size, rand_seed, data_augment, is_resize)
-        self.test_dataset = self._create_dataset(self.test_list, batch_size, rand_seed, False, is_resize)
+            NOTE set `self.timer = StageTimer()` before to time the pipeline stages
+
+        Parameters
+        ----------
+        is_cache : bool
+            letterbox the images once and save them in a memmap cache beside the annotation file,
+            later epochs and later runs read the cache. NOTE need `is_resize`
+        parser : str
+            'py' : decode and letterbox in python by `py_function`
+            'native' : decode and letterbox by graph ops, the map can run in parallel,
+                       when `augment_mode` is 'fused', augment by graph ops `_tf_augment_img`
+        num_workers : int
+            when > 0, use `ProcessLoader` with `num_workers` processes for the py parser
+
+            NOTE when the annotation is tfrecord index, always use graph ops to parse.
+            the graph ops can't run imgaug, so `augment_mode` 'iaa' with `data_augment` need py parser
+            and not support tfrecord
+        shuffle_buffer : int
+            when > 0, use streaming shuffle : permute the sample index every epoch,
+            then mix the decoded samples in a `shuffle_buffer` size buffer.
+            peak memory is `8 * sample num + shuffle_buffer * decoded sample bytes`, see `shuffle_memory`.
+            when 0, only permute the sample index every epoch, the decoded samples are not mixed.
+
+            NOTE the worker processes and tfrecord already shuffle with bounded memory
+        label_mode : str
+            'dense' : every sample carry the dense labels from `box_to_label`
+            'box' : every sample only carry the boxes, the batch element is (img, padded boxes, box num),
+                    the labels are scattered by `tf_batch_box_to_label` in the train step, so the host never build
+                    and copy the dense labels. NOTE need `tools.trainer.Trainer` with `label_fn`, not support worker processes
+        image_dtype : str
+            'float32' : the image is normlized by the image max in the pipeline
+            'uint8' : keep the uint8 image in the pipeline, 1/4 bytes of float32,
+                      the model must normlize it, see `models.yolonet.uint8_input`.
+                      NOTE not support worker processes
+        bank_num : int
+            when > 0, the train dataset read the augmentation bank from `build_bank`, every epoch use one
+            of the `bank_num` stored variants of every image, so augment cost nothing per epoch.
+            the test dataset is not changed, the bank only hold the train split, keyed by `train_index`.
+            NOTE need `data_augment`, `is_resize` and py parser
+        """
+        assert parser in ['py', 'native'], f'unknown parser {parser}'
+        assert label_mode in ['dense', 'box'], f'unknown label mode {label_mode}'
+        assert image_dtype in ['float32', 'uint8'], f'unknown image dtype {image_dtype}'
+        if self.tfrecord is not None:
+            assert not is_cache and num_workers == 0, 'tfrecord not support cache and worker processes'
+        if data_augment and self.augment_mode == 'iaa':
+            assert parser == 'py' and self.tfrecord is None, 'imgaug augmenter only support py parser without tfrecord'
+        if data_augment and self.augment_mode == 'fused' and (parser == 'native' or self.tfrecord is not None):
+            assert self.interpolation in ['nearest', 'bilinear'], f'graph augment not support {self.interpolation} interpolation'
+        if num_workers > 0:
+            assert parser == 'py' and not is_cache, 'worker processes only support py parser without cache'
+            assert label_mode == 'dense' and image_dtype == 'float32', 'worker processes only support dense label and float32 image'
+        if is_cache:
+            assert is_resize, 'image cache need resize'
+            assert parser == 'py', 'image cache only support py parser'
+            self.cache = self._load_cache()
+        if bank_num > 0:
+            assert self.tfrecord is None and num_workers == 0, 'augmentation bank not support tfrecord and worker processes'
+            assert data_augment and is_resize and parser == 'py', 'augmentation bank need data augment, resize and py parser'
+            self.bank = self.build_bank(bank_num, rand_seed)
+        self.train_dataset = self._create_dataset(self.train_list, batch_size, rand_seed, data_augment, is_resize,
+                                                  np.arange(len(self.train_index)) if bank_num > 0 else
+                                                  self.train_index if is_cache else None, parser, num_workers,
+                                                  shuffle_buffer, label_mode, image_dtype, 'train', bank_num)
+        self.test_dataset = self._create_dataset(self.test_list, batch_size, rand_seed, False, is_resize,
+                                                 self.test_index if is_cache else None, parser, num_workers, shuffle_buffer,
+                                                 label_mode, image_dtype, 'test')
         self.batch_size = batch_size
         self.train_epoch_step = self.train_total_data // self.batch_size
         self.test_epoch_step = self.test_total_data // self.batch_size
@@ -524,6 +1471,107 @@ class Helper(object):
         return true_box
 
 
+def tf_box_to_label(true_box: tf.Tensor, h: Helper) -> list:
+    """ graph version of `Helper.box_to_label`, convert the annotaion to yolo v3 label
+
+    Parameters
+    ----------
+    true_box : tf.Tensor
+        annotation shape :[n,5] value :[n*[p,x,y,w,h]]
+    h : Helper
+
+
+    Returns
+    -------
+    list
+        labels list value :[output_number*[out_h,out_w,anchor_num,class+5]]
+    """
+    with tf.name_scope('box_to_label'):
+        labels = tf_scatter_label(tf.zeros_like(true_box[:, 0], tf.int32), true_box, 1, h)
+    return [label[0] for label in labels]
+
+
+def tf_batch_box_to_label(true_box: tf.Tensor, box_num: tf.Tensor, h: Helper) -> list:
+    """ graph version of `Helper.box_to_label_batch`, scatter the padded boxes to yolo v3 label,
+        can be used in the dataset or in the training step
+
+    Parameters
+    ----------
+    true_box : tf.Tensor
+        padded annotation shape :[batch,max box,5] value :[batch*[max box*[p,x,y,w,h]]]
+    box_num : tf.Tensor
+        vaild box num of every image shape :[batch]
+    h : Helper
+
+
+    Returns
+    -------
+    list
+        labels list value :[output_number*[batch,out_h,out_w,anchor_num,class+5]]
+    """
+    with tf.name_scope('batch_box_to_label'):
+        mask = tf.sequence_mask(box_num, tf.shape(true_box)[1])
+        bc = tf.cast(tf.where(mask)[:, 0], tf.int32)
+        labels = tf_scatter_label(bc, tf.boolean_mask(true_box, mask), tf.shape(true_box)[0], h)
+    return labels
+
+
+def tf_scatter_label(bc: tf.Tensor, true_box: tf.Tensor, batch_size: int, h: Helper) -> list:
+    """ scatter the boxes into the label grids, the same rule as `Helper.box_to_label_batch`
+
+    Parameters
+    ----------
+    bc : tf.Tensor
+        batch index of every box, shape = [n]
+    true_box : tf.Tensor
+        vaild annotation shape :[n,5] value :[n*[p,x,y,w,h]]
+    batch_size : int or tf.Tensor
+
+    h : Helper
+
+
+    Returns
+    -------
+    list
+        labels list value :[output_number*[batch_size,out_h,out_w,anchor_num,class+5]]
+    """
+    true_box = tf.cast(true_box, tf.float32)
+    """ get the max iou anchor index """
+    anchors = tf.constant(h.anchors, tf.float32)  # [layers,anchor num,2]
+    wh = true_box[:, tf.newaxis, tf.newaxis, 3:5]
+    # NOTE the box and anchor have same center, so the intersection wh is min(wh,anchor)
+    iner_area = tf.reduce_prod(tf.minimum(wh, anchors), -1)
+    iou = iner_area / (tf.reduce_prod(wh, -1) + tf.reduce_prod(anchors, -1) - iner_area)
+    best = tf.argmax(tf.reshape(iou, (-1, h.output_number * h.anchor_number)), -1, output_type=tf.int32)
+    layer, anchor = best // h.anchor_number, best % h.anchor_number
+
+    labels = []
+    for l in range(h.output_number):
+        out_h, out_w = int(h.out_hw[l][0]), int(h.out_hw[l][1])
+        mask = tf.equal(layer, l)
+        layer_bc = tf.boolean_mask(bc, mask)
+        layer_n = tf.boolean_mask(anchor, mask)
+        layer_box = tf.boolean_mask(true_box, mask)
+        xy_idx = tf.cast(tf.floor(layer_box[:, 1:3] * h.out_hw[l][::-1]), tf.int32)  # [x index , y index]
+        idx = tf.stack([layer_bc, xy_idx[:, 1], xy_idx[:, 0], layer_n], -1)
+
+        """ when many boxes in one cell, only keep the last box xywh """
+        cell = ((layer_bc * out_h + xy_idx[:, 1]) * out_w + xy_idx[:, 0]) * h.anchor_number + layer_n
+        order = tf.range(tf.shape(cell)[0])
+        winner = tf.math.unsorted_segment_max(order, cell, batch_size * out_h * out_w * h.anchor_number)
+        keep = tf.equal(order, tf.gather(winner, cell))
+        value = tf.concat([tf.clip_by_value(layer_box[:, 1:5], 1e-8, 1.), tf.ones_like(layer_box[:, 0:1])], -1)
+        xywhc = tf.scatter_nd(tf.boolean_mask(idx, keep), tf.boolean_mask(value, keep),
+                              [batch_size, out_h, out_w, h.anchor_number, 5])
+
+        """ the class one-hot of every box in the cell """
+        cls_idx = tf.concat([idx, tf.cast(layer_box[:, 0:1], tf.int32)], -1)
+        cls = tf.minimum(tf.scatter_nd(cls_idx, tf.ones_like(layer_box[:, 0]),
+                                       [batch_size, out_h, out_w, h.anchor_number, h.class_num]), 1.)
+        labels.append(tf.concat([xywhc, cls], -1))
+    return labels
+
+
 def tf_xywh_to_all(grid_pred_xy: tf.Tensor, grid_pred_wh: tf.Tensor, layer: int, h: Helper) -> [tf.Tensor, tf.Tensor]:
     """ rescale the pred raw [grid_pred_xy,grid_pred_wh] to [0~1]
 
@@ -575,46 +1623,25 @@ def tf_xywh_to_grid(all_true_xy: tf.Tensor, all_true_wh: tf.Tensor, layer: int,
     return grid_true_xy, grid_true_wh
 
 
-def tf_reshape_box(true_xy_A: tf.Tensor, true_wh_A: tf.Tensor, p_xy_A: tf.Tensor, p_wh_A: tf.Tensor, layer: int, helper: Helper) -> tuple:
-    """ reshape the xywh to [?,h,w,anchor_nums,true_box_nums,2]
-        NOTE  must use obj mask in atrue xywh !
-    Parameters
-    ----------
-    true_xy_A : tf.Tensor
-        shape will be [true_box_nums,2]
-
-    true_wh_A : tf.Tensor
-        shape will be [true_box_nums,2]
-
-    p_xy_A : tf.Tensor
-        shape will be [?,h,w,anhor_nums,2]
-
-    p_wh_A : tf.Tensor
-        shape will be [?,h,w,anhor_nums,2]
-
-    layer : int
-
-    helper : Helper
-
-
-    Returns
-    -------
-    tuple
-        true_cent, true_box_wh, pred_cent, pred_box_wh
-    """
-    with tf.name_scope('reshape_box_%d' % layer):
-        true_cent = true_xy_A[tf.newaxis, tf.newaxis, tf.newaxis, tf.newaxis, ...]
-        true_box_wh = true_wh_A[tf.newaxis, tf.newaxis, tf.newaxis, tf.newaxis, ...]
+def _tf_box_iou(b1_xy: tf.Tensor, b1_wh: tf.Tensor, b2_xy: tf.Tensor, b2_wh: tf.Tensor) -> tf.Tensor:
+    """ the iou of two box sets, the shapes must be broadcastable, return shape = broadcast shape[:-1] """
+    b1_wh_half = b1_wh / 2.
+    b1_mins = b1_xy - b1_wh_half
+    b1_maxes = b1_xy + b1_wh_half
 
-        true_cent = tf.tile(true_cent, [helper.batch_size, helper.out_hw[layer][0], helper.out_hw[layer][1], helper.anchor_number, 1, 1])
-        true_box_wh = tf.tile(true_box_wh, [helper.batch_size, helper.out_hw[layer][0], helper.out_hw[layer][1], helper.anchor_number, 1, 1])
+    b2_wh_half = b2_wh / 2.
+    b2_mins = b2_xy - b2_wh_half
+    b2_maxes = b2_xy + b2_wh_half
 
-        pred_cent = p_xy_A[..., tf.newaxis, :]
-        pred_box_wh = p_wh_A[..., tf.newaxis, :]
-        pred_cent = tf.tile(pred_cent, [1, 1, 1, 1, tf.shape(true_xy_A)[0], 1])
-        pred_box_wh = tf.tile(pred_box_wh, [1, 1, 1, 1, tf.shape(true_wh_A)[0], 1])
+    intersect_mins = tf.maximum(b1_mins, b2_mins)
+    intersect_maxes = tf.minimum(b1_maxes, b2_maxes)
+    intersect_wh = tf.maximum(intersect_maxes - intersect_mins, 0.)
+    intersect_area = intersect_wh[..., 0] * intersect_wh[..., 1]
+    b1_area = b1_wh[..., 0] * b1_wh[..., 1]
+    b2_area = b2_wh[..., 0] * b2_wh[..., 1]
+    iou = intersect_area / (b1_area + b2_area - intersect_area)
 
-    return true_cent, true_box_wh, pred_cent, pred_box_wh
+    return iou
 
 
 def tf_iou(pred_xy: tf.Tensor, pred_wh: tf.Tensor, vaild_xy: tf.Tensor, vaild_wh: tf.Tensor) -> tf.Tensor:
@@ -639,31 +1666,126 @@ def tf_iou(pred_xy: tf.Tensor, pred_wh: tf.Tensor, vaild_xy: tf.Tensor, vaild_wh
     tf.Tensor
         iou value shape = [out h, out w, anchor num ,?]
     """
-    b1_xy = tf.expand_dims(pred_xy, -2)
-    b1_wh = tf.expand_dims(pred_wh, -2)
-    b1_wh_half = b1_wh / 2.
-    b1_mins = b1_xy - b1_wh_half
-    b1_maxes = b1_xy + b1_wh_half
+    return _tf_box_iou(tf.expand_dims(pred_xy, -2), tf.expand_dims(pred_wh, -2),
+                       tf.expand_dims(vaild_xy, 0), tf.expand_dims(vaild_wh, 0))
 
-    b2_xy = tf.expand_dims(vaild_xy, 0)
-    b2_wh = tf.expand_dims(vaild_wh, 0)
-    b2_wh_half = b2_wh / 2.
-    b2_mins = b2_xy - b2_wh_half
-    b2_maxes = b2_xy + b2_wh_half
 
-    intersect_mins = tf.maximum(b1_mins, b2_mins)
-    intersect_maxes = tf.minimum(b1_maxes, b2_maxes)
-    intersect_wh = tf.maximum(intersect_maxes - intersect_mins, 0.)
-    intersect_area = intersect_wh[..., 0] * intersect_wh[..., 1]
-    b1_area = b1_wh[..., 0] * b1_wh[..., 1]
-    b2_area = b2_wh[..., 0] * b2_wh[..., 1]
-    iou = intersect_area / (b1_area + b2_area - intersect_area)
+def tf_batch_iou(pred_xy: tf.Tensor, pred_wh: tf.Tensor, true_xy: tf.Tensor, true_wh: tf.Tensor) -> tf.Tensor:
+    """ calc the iou form every pred box with every true box of the same image
 
-    return iou
+    Parameters
+    ----------
+    pred_xy : tf.Tensor
+        pred box shape = [batch size, pred num, 2]
+
+    pred_wh : tf.Tensor
+        pred box shape = [batch size, pred num, 2]
+
+    true_xy : tf.Tensor
+        true box shape = [batch size, true num, 2]
+
+    true_wh : tf.Tensor
+        true box shape = [batch size, true num, 2]
+
+    Returns
+    -------
+    tf.Tensor
+        iou value shape = [batch size, pred num, true num]
+    """
+    return _tf_box_iou(tf.expand_dims(pred_xy, -2), tf.expand_dims(pred_wh, -2),
+                       tf.expand_dims(true_xy, -3), tf.expand_dims(true_wh, -3))
 
 
-def calc_ignore_mask(t_xy_A: tf.Tensor, t_wh_A: tf.Tensor, p_xy: tf.Tensor, p_wh: tf.Tensor, obj_mask: tf.Tensor, iou_thresh: float, layer: int, helper: Helper) -> tf.Tensor:
-    """clac the ignore mask
+def tf_pad_true_box(t_xy_A: tf.Tensor, t_wh_A: tf.Tensor, obj_mask: tf.Tensor, cell_layer: tf.Tensor = None) -> list:
+    """ gather the true boxes of every image in the label to the padded boxes,
+        the order of the boxes in every image is same as `tf.boolean_mask`
+
+    Parameters
+    ----------
+    t_xy_A : tf.Tensor
+        raw ture xy,shape = [batch size,h,w,anchors,2]
+    t_wh_A : tf.Tensor
+        raw true wh,shape = [batch size,h,w,anchors,2]
+    obj_mask : tf.Tensor
+        bool obj mask,shape = [batch size,h,w,anchors]
+    cell_layer : tf.Tensor
+        the output layer of every cell in the flattened label, shape = [h*w*anchors], used by the fused loss
+
+    Returns
+    -------
+    list
+        true xy, true wh shape = [batch size, max box num, 2], vaild mask shape = [batch size, max box num],
+        when `cell_layer` is not None, append the true box layer shape = [batch size, max box num]
+    """
+    batch_size = tf.shape(obj_mask)[0]
+    mask = tf.cast(tf.reshape(obj_mask, (batch_size, -1)), tf.int32)
+    # NOTE the box position in the padded boxes is the obj cell number before it in the same image
+    pos = tf.cumsum(mask, axis=1, exclusive=True)
+    max_num = tf.reduce_max(tf.reduce_sum(mask, 1))
+    idx = tf.where(mask > 0)
+    scatter_idx = tf.stack([idx[:, 0], tf.cast(tf.gather_nd(pos, idx), tf.int64)], -1)
+    shape = tf.cast(tf.stack([batch_size, max_num, 2]), tf.int64)
+    true_xy = tf.scatter_nd(scatter_idx, tf.gather_nd(tf.reshape(t_xy_A, (batch_size, -1, 2)), idx), shape)
+    true_wh = tf.scatter_nd(scatter_idx, tf.gather_nd(tf.reshape(t_wh_A, (batch_size, -1, 2)), idx), shape)
+    vaild = tf.sequence_mask(tf.reduce_sum(mask, 1), max_num)
+    if cell_layer is not None:
+        true_layer = tf.scatter_nd(scatter_idx, tf.gather(cell_layer, idx[:, 1]), shape[:2])
+        return [true_xy, true_wh, vaild, true_layer]
+    return [true_xy, true_wh, vaild]
+
+
+def tf_best_iou(pred_xy: tf.Tensor, pred_wh: tf.Tensor, true_xy: tf.Tensor, true_wh: tf.Tensor, vaild: tf.Tensor,
+                box_chunk: int = 16, pred_layer: tf.Tensor = None, true_layer: tf.Tensor = None) -> tf.Tensor:
+    """ the best iou of every pred box with the vaild true boxes of the same image,
+        loop over the true boxes by `box_chunk` and keep the running max, so the peak memory is
+        `batch size * pred num * box_chunk` not depend on the true box number.
+
+    Parameters
+    ----------
+    pred_xy : tf.Tensor
+        pred box shape = [batch size, pred num, 2]
+    pred_wh : tf.Tensor
+        pred box shape = [batch size, pred num, 2]
+    true_xy : tf.Tensor
+        padded true box shape = [batch size, true num, 2]
+    true_wh : tf.Tensor
+        padded true box shape = [batch size, true num, 2]
+    vaild : tf.Tensor
+        bool vaild mask of the padded true box shape = [batch size, true num]
+    box_chunk : int
+        true box number of one loop
+    pred_layer : tf.Tensor
+        the output layer of the pred box shape = [pred num], when not None only compare the boxes of the same layer
+    true_layer : tf.Tensor
+        the output layer of the padded true box shape = [batch size, true num]
+
+    Returns
+    -------
+    tf.Tensor
+        best iou shape = [batch size, pred num], -inf when the image have no vaild box
+    """
+    max_num = tf.shape(true_xy)[1]
+
+    def body(i: tf.Tensor, best_iou: tf.Tensor):
+        end = tf.minimum(i + box_chunk, max_num)
+        iou_score = tf_batch_iou(pred_xy, pred_wh, true_xy[:, i:end], true_wh[:, i:end])
+        # NOTE the padded box iou is -inf, same as reduce max of the empty vaild boxes
+        chunk_vaild = tf.broadcast_to(vaild[:, tf.newaxis, i:end], tf.shape(iou_score))
+        if pred_layer is not None:
+            chunk_vaild = tf.logical_and(chunk_vaild, tf.equal(true_layer[:, tf.newaxis, i:end], pred_layer[tf.newaxis, :, tf.newaxis]))
+        iou_score = tf.where(chunk_vaild, iou_score, tf.fill(tf.shape(iou_score), -np.inf))
+        return end, tf.maximum(best_iou, tf.reduce_max(iou_score, axis=-1))
+
+    # NOTE parallel_iterations=1 so only one chunk is alive, the mask is not differentiable so no back prop
+    _, best_iou = tf.while_loop(lambda i, best_iou: i < max_num, body,
+                                [tf.constant(0), tf.fill(tf.shape(pred_xy)[:-1], -np.inf)],
+                                parallel_iterations=1, back_prop=False)
+    return best_iou
+
+
+def calc_ignore_mask(t_xy_A: tf.Tensor, t_wh_A: tf.Tensor, p_xy: tf.Tensor, p_wh: tf.Tensor, obj_mask: tf.Tensor, iou_thresh: float, layer: int, helper: Helper,
+                     box_chunk: int = 16) -> tf.Tensor:
+    """clac the ignore mask, the whole batch in one set of ops, the peak memory not depend on the box number
 
     Parameters
     ----------
@@ -681,6 +1803,8 @@ def calc_ignore_mask(t_xy_A: tf.Tensor, t_wh_A: tf.Tensor, p_xy: tf.Tensor, p_wh
         iou thresh 
     helper : Helper
         Helper obj
+    box_chunk : int
+        true box number of one iou loop, see `tf_best_iou`
 
     Returns
     -------
@@ -690,26 +1814,17 @@ def calc_ignore_mask(t_xy_A: tf.Tensor, t_wh_A: tf.Tensor, p_xy: tf.Tensor, p_wh
     """
     with tf.name_scope('calc_mask_%d' % layer):
         pred_xy, pred_wh = tf_xywh_to_all(p_xy, p_wh, layer, helper)
+        true_xy, true_wh, vaild = tf_pad_true_box(t_xy_A, t_wh_A, obj_mask)
 
-        # def lmba(bc):
-        #     vaild_xy = tf.boolean_mask(t_xy_A[bc], obj_mask[bc])
-        #     vaild_wh = tf.boolean_mask(t_wh_A[bc], obj_mask[bc])
-        #     iou_score = tf_iou(pred_xy[bc], pred_wh[bc], vaild_xy, vaild_wh)
-        #     best_iou = tf.reduce_max(iou_score, axis=-1, keepdims=True)
-        #     return tf.cast(best_iou < iou_thresh, tf.float32)
-        # return map_fn(lmba, tf.range(helper.batch_size), dtype=tf.float32)
-        ignore_mask = []
-        for bc in range(helper.batch_size):
-            vaild_xy = tf.boolean_mask(t_xy_A[bc], obj_mask[bc])
-            vaild_wh = tf.boolean_mask(t_wh_A[bc], obj_mask[bc])
-            iou_score = tf_iou(pred_xy[bc], pred_wh[bc], vaild_xy, vaild_wh)
-            best_iou = tf.reduce_max(iou_score, axis=-1, keepdims=True)
-            ignore_mask.append(tf.cast(best_iou < iou_thresh, tf.float32))
-    return tf.stack(ignore_mask)
+        batch_size = tf.shape(pred_xy)[0]
+        best_iou = tf_best_iou(tf.reshape(pred_xy, (batch_size, -1, 2)), tf.reshape(pred_wh, (batch_size, -1, 2)),
+                               true_xy, true_wh, vaild, box_chunk)
+        ignore_mask = tf.reshape(tf.cast(best_iou < iou_thresh, tf.float32), tf.concat([tf.shape(pred_xy)[:-1], [1]], 0))
+    return ignore_mask
 
 
 def create_loss_fn(h: Helper, obj_thresh: float, iou_thresh: float, obj_weight: float,
-                   noobj_weight: float, wh_weight: float, layer: int):
+                   noobj_weight: float, wh_weight: float, layer: int, box_chunk: int = 16, sparse: bool = False):
     """ create the yolo loss function
 
     Parameters
@@ -728,6 +1843,10 @@ def create_loss_fn(h: Helper, obj_thresh: float, iou_thresh: float, obj_weight:
 
     layer : int
         the current layer index
+    box_chunk : int
+        true box number of one ignore mask iou loop, see `tf_best_iou`
+    sparse : bool
+        compute the xy, wh, obj and cls terms only on the positive cells, see `tf_positive_loss`
 
     Returns
     -------
@@ -739,6 +1858,7 @@ def create_loss_fn(h: Helper, obj_thresh: float, iou_thresh: float, obj_weight:
             return : loss
     """
     shapes = [[-1] + list(h.out_hw[i]) + [len(h.anchors[i]), h.class_num + 5]for i in range(len(h.anchors))]
+    tables = _layer_tables(h, layer)
 
     # @tf.function
     def loss_fn(y_true: tf.Tensor, y_pred: tf.Tensor):
@@ -760,7 +1880,18 @@ def create_loss_fn(h: Helper, obj_thresh: float, iou_thresh: float, obj_weight:
 
         ignore_mask = calc_ignore_mask(all_true_xy, all_true_wh, grid_pred_xy,
                                        grid_pred_wh, obj_mask_bool,
-                                       iou_thresh, layer, h)
+                                       iou_thresh, layer, h, box_chunk)
+
+        noobj_loss = noobj_weight * tf.reduce_sum(
+            (1 - obj_mask) * ignore_mask * tf.nn.sigmoid_cross_entropy_with_logits(
+                labels=true_confidence, logits=pred_confidence)) / h.batch_size
+
+        if sparse:
+            """ only the positive cells, the noobj term stay dense """
+            positive = tf_positive_loss(tf_concat_layers([y_true]), tf_concat_layers([y_pred]),
+                                        tf.reshape(obj_mask_bool, (tf.shape(y_true)[0], -1)), *tables,
+                                        obj_weight, wh_weight, h.batch_size)
+            return tf.add_n(list(positive.values())) + noobj_loss
 
         grid_true_xy, grid_true_wh = tf_xywh_to_grid(all_true_xy, all_true_wh, layer, h)
         # NOTE When wh=0 , tf.log(0) = -inf, so use K.switch to avoid it
@@ -781,10 +1912,6 @@ def create_loss_fn(h: Helper, obj_thresh: float, iou_thresh: float, obj_weight:
             obj_mask * tf.nn.sigmoid_cross_entropy_with_logits(
                 labels=true_confidence, logits=pred_confidence)) / h.batch_size
 
-        noobj_loss = noobj_weight * tf.reduce_sum(
-            (1 - obj_mask) * ignore_mask * tf.nn.sigmoid_cross_entropy_with_logits(
-                labels=true_confidence, logits=pred_confidence)) / h.batch_size
-
         cls_loss = tf.reduce_sum(
             obj_mask * tf.nn.sigmoid_cross_entropy_with_logits(
                 labels=true_cls, logits=pred_cls)) / h.batch_size
@@ -794,3 +1921,198 @@ def create_loss_fn(h: Helper, obj_thresh: float, iou_thresh: float, obj_weight:
         return total_loss
 
     return loss_fn
+
+
+def tf_concat_layers(tensors: list) -> tf.Tensor:
+    """ flatten the grid of every output layer and concat them
+
+    Parameters
+    ----------
+    tensors : list
+        label or pred of every layer, value = [n x [batch size, h_n, w_n, anchors, class num + 5]]
+
+    Returns
+    -------
+    tf.Tensor
+        shape = [batch size, sum(h_n * w_n * anchors), class num + 5]
+    """
+    return tf.concat([tf.reshape(t, (tf.shape(t)[0], -1, t.shape[-1])) for t in tensors], 1)
+
+
+def _layer_tables(h: Helper, layer: int) -> [np.ndarray, np.ndarray, np.ndarray]:
+    """ the per cell xy offset, out wh, anchors of the flattened layer, shape = [h*w*anchors, 2] """
+    shape = list(h.out_hw[layer]) + [len(h.anchors[layer]), 2]
+    return [np.reshape(np.broadcast_to(table, shape), (-1, 2)).astype('float32')
+            for table in [h.xy_offset[layer], h.out_hw[layer][::-1], h.anchors[layer]]]
+
+
+def fused_tables(h: Helper) -> [np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """ the per cell tables of the concated layers, same order as `tf_concat_layers`
+
+    Returns
+    -------
+    [np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+        xy offset, out wh, anchors shape = [cells, 2] , layer index shape = [cells]
+    """
+    tables = [_layer_tables(h, l) for l in range(h.output_number)]
+    layer = [np.full(len(table[0]), l, np.int32) for l, table in enumerate(tables)]
+    return [np.vstack(t) for t in zip(*tables)] + [np.concatenate(layer)]
+
+
+def tf_positive_loss(y_true: tf.Tensor, y_pred: tf.Tensor, obj_mask: tf.Tensor, xy_offset: np.ndarray, out_wh: np.ndarray,
+                     anchors: np.ndarray, obj_weight: float, wh_weight: float, batch_size: int) -> dict:
+    """ the xy, wh, obj and cls loss terms, only gather and compute the positive cells.
+        the result is same as the dense terms multiplied by the obj mask, and no `tf.log` on the zero wh.
+
+    Parameters
+    ----------
+    y_true : tf.Tensor
+        flattened label shape = [batch size, cells, class num + 5]
+    y_pred : tf.Tensor
+        flattened pred shape = [batch size, cells, class num + 5]
+    obj_mask : tf.Tensor
+        bool positive mask shape = [batch size, cells]
+    xy_offset : np.ndarray
+        per cell table shape = [cells, 2], see `fused_tables`
+    out_wh : np.ndarray
+        per cell table shape = [cells, 2]
+    anchors : np.ndarray
+        per cell table shape = [cells, 2]
+    obj_weight : float
+
+    wh_weight : float
+
+    batch_size : int
+
+    Returns
+    -------
+    dict
+        {'xy', 'wh', 'obj', 'cls'} loss terms
+    """
+    with tf.name_scope('positive_loss'):
+        idx = tf.where(obj_mask)
+        t = tf.gather_nd(y_true, idx)
+        p = tf.gather_nd(y_pred, idx)
+        cell = idx[:, 1]
+        true_confidence = t[:, 4:5]
+
+        grid_true_xy = t[:, 0:2] * tf.gather(out_wh, cell) - tf.gather(xy_offset, cell)
+        grid_true_wh = tf.log(t[:, 2:4] / tf.gather(anchors, cell))
+        coord_weight = 2 - t[:, 2:3] * t[:, 3:4]
+
+        return {
+            'xy': tf.reduce_sum(
+                true_confidence * coord_weight * tf.nn.sigmoid_cross_entropy_with_logits(
+                    labels=grid_true_xy, logits=p[:, 0:2])) / batch_size,
+            'wh': tf.reduce_sum(
+                true_confidence * coord_weight * wh_weight * tf.square(tf.subtract(
+                    x=grid_true_wh, y=p[:, 2:4]))) / batch_size,
+            'obj': obj_weight * tf.reduce_sum(
+                true_confidence * tf.nn.sigmoid_cross_entropy_with_logits(
+                    labels=true_confidence, logits=p[:, 4:5])) / batch_size,
+            'cls': tf.reduce_sum(
+                true_confidence * tf.nn.sigmoid_cross_entropy_with_logits(
+                    labels=t[:, 5:], logits=p[:, 5:])) / batch_size}
+
+
+def create_fused_loss_fn(h: Helper, obj_thresh: float, iou_thresh: float, obj_weight: float,
+                         noobj_weight: float, wh_weight: float, box_chunk: int = 16, sparse: bool = False):
+    """ create the yolo loss function of all output layers, the label and pred are concated by `tf_concat_layers`,
+        every loss term is one set of ops for all layers, the sum is same as the per layer `create_loss_fn`.
+
+    Parameters
+    ----------
+    h : Helper
+
+    obj_thresh : float
+
+    iou_thresh : float
+
+    obj_weight : float
+
+    noobj_weight : float
+
+    wh_weight : float
+
+    box_chunk : int
+        true box number of one ignore mask iou loop, see `tf_best_iou`
+    sparse : bool
+        compute the xy, wh, obj and cls terms only on the positive cells, see `tf_positive_loss`
+
+    Returns
+    -------
+    function
+        the yolo loss function
+
+            param  : (y_true,y_pred)
+
+            return : loss
+
+        `loss_fn.terms(y_true, y_pred)` return the dict of the loss terms,
+        `loss_fn.metrics` are the `Yolo_LossTerm` of the loss terms for `keras.Model.compile`,
+        the loss function update them, so the terms are computed once per step
+    """
+    xy_offset, out_wh, anchors, cell_layer = fused_tables(h)
+
+    def terms(y_true: tf.Tensor, y_pred: tf.Tensor) -> dict:
+        """ split the label """
+        grid_pred_xy = y_pred[..., 0:2]
+        grid_pred_wh = y_pred[..., 2:4]
+        pred_confidence = y_pred[..., 4:5]
+        pred_cls = y_pred[..., 5:]
+
+        all_true_xy = y_true[..., 0:2]
+        all_true_wh = y_true[..., 2:4]
+        true_confidence = y_true[..., 4:5]
+        true_cls = y_true[..., 5:]
+
+        obj_mask = true_confidence
+        obj_mask_bool = y_true[..., 4] > obj_thresh
+
+        """ calc the ignore mask, only compare the boxes of the same layer """
+        with tf.name_scope('calc_mask_fused'):
+            pred_xy = (tf.sigmoid(grid_pred_xy) + xy_offset) / out_wh
+            pred_wh = tf.exp(grid_pred_wh) * anchors
+            true_xy, true_wh, vaild, true_layer = tf_pad_true_box(all_true_xy, all_true_wh, obj_mask_bool, cell_layer)
+            best_iou = tf_best_iou(pred_xy, pred_wh, true_xy, true_wh, vaild, box_chunk, cell_layer, true_layer)
+            ignore_mask = tf.cast(best_iou < iou_thresh, tf.float32)[..., tf.newaxis]
+
+        confidence_loss = tf.nn.sigmoid_cross_entropy_with_logits(labels=true_confidence, logits=pred_confidence)
+        noobj_loss = noobj_weight * tf.reduce_sum((1 - obj_mask) * ignore_mask * confidence_loss) / h.batch_size
+
+        if sparse:
+            """ only the positive cells, the noobj term stay dense """
+            result = tf_positive_loss(y_true, y_pred, obj_mask_bool, xy_offset, out_wh, anchors,
+                                      obj_weight, wh_weight, h.batch_size)
+            result['noobj'] = noobj_loss
+            return result
+
+        grid_true_xy = all_true_xy * out_wh - xy_offset
+        # NOTE When wh=0 , tf.log(0) = -inf, so use K.switch to avoid it
+        grid_true_wh = K.switch(obj_mask_bool, tf.log(all_true_wh / anchors), tf.zeros_like(all_true_wh))
+
+        """ define loss """
+        coord_weight = 2 - all_true_wh[..., 0:1] * all_true_wh[..., 1:2]
+
+        return {
+            'xy': tf.reduce_sum(
+                obj_mask * coord_weight * tf.nn.sigmoid_cross_entropy_with_logits(
+                    labels=grid_true_xy, logits=grid_pred_xy)) / h.batch_size,
+            'wh': tf.reduce_sum(
+                obj_mask * coord_weight * wh_weight * tf.square(tf.subtract(
+                    x=grid_true_wh, y=grid_pred_wh))) / h.batch_size,
+            'obj': obj_weight * tf.reduce_sum(obj_mask * confidence_loss) / h.batch_size,
+            'noobj': noobj_loss,
+            'cls': tf.reduce_sum(
+                obj_mask * tf.nn.sigmoid_cross_entropy_with_logits(
+                    labels=true_cls, logits=pred_cls)) / h.batch_size}
+
+    def loss_fn(y_true: tf.Tensor, y_pred: tf.Tensor):
+        result = terms(y_true, y_pred)
+        updates = [metric.update_term(result[metric.name]) for metric in loss_fn.metrics]
+        with tf.control_dependencies(updates):
+            return tf.add_n(list(result.values()))
+
+    loss_fn.terms = terms
+    loss_fn.metrics = [Yolo_LossTerm(name) for name in ['xy', 'wh', 'obj', 'noobj', 'cls']]
+    return loss_fn